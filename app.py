@@ -1,7 +1,24 @@
 from flask import Flask, render_template, jsonify, request
 import threading
-from listener import start_server
-from enhanced_alarm import add_alarm_routes, enhanced_log_alarm
+from listener import start_server, add_packet_handler
+from enhanced_alarm import add_alarm_routes, init_alarm_db, enhanced_log_alarm, acknowledge_alarm as acknowledge_alarm_log
+from pagination import parse_page_args, paginate
+from fuel_analytics import add_fuel_analytics_routes, init_fuel_analytics_db
+from report_jobs import add_report_job_routes
+from route_track import add_route_track_routes, init_route_track_db
+from speed_rules import load_speed_limits, update_speed_limit, evaluate_speed
+from geofence import add_geofence_routes, init_geofence_db, load_geofences, evaluate_geofences
+from idle_tracker import add_idle_routes, load_idle_status, evaluate_idle
+from offline_monitor import start_offline_monitor, record_heartbeat
+from driver_behavior import add_driver_behavior_routes, init_driver_behavior_db, evaluate_driving
+from route_plans import add_route_plan_routes, init_route_plan_db, load_route_plans, evaluate_route
+from live_positions import add_live_position_routes, load_live_positions, update_position, changes_response, parse_bbox
+from trip_assignment import add_trip_assignment_routes, init_trip_assignment_db
+from heatmap import add_heatmap_routes, init_heatmap_db, HEATMAP_MIN_ZOOM, HEATMAP_MAX_ZOOM
+from stop_places import add_stop_place_routes, init_stop_places_db, start_stop_place_job, get_place_ids
+from geocoder import load_gazetteer, reverse_geocode
+from report_stream import iter_query, wants_stream, stream_json_report, build_report, new_stats, update_stats, stats_average
+from report_format import init_report_format, report_json
 import sqlite3
 import datetime
 import math
@@ -9,6 +26,20 @@ import math
 app = Flask(__name__)
 DB = 'gps.db'
 
+def init_db():
+    """Create the indexes backing keyset pagination and per-vehicle range scans"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    
+    c.execute('CREATE INDEX IF NOT EXISTS idx_gps_data_vehicle_timestamp ON gps_data (vehicle_id, timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_gps_data_timestamp_id ON gps_data (timestamp, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_temperature_data_vehicle_timestamp ON temperature_data (vehicle_id, timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_trip_requests_date_id ON trip_requests (request_date, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_trip_requests_status_date_id ON trip_requests (status, request_date, id)')
+    
+    conn.commit()
+    conn.close()
+
 def save_gps(imei, timestamp, lat, lon, speed):
     # Get vehicle_id from IMEI
     vehicle_id = get_vehicle_id_from_imei(imei)
@@ -25,20 +56,34 @@ def save_gps(imei, timestamp, lat, lon, speed):
     conn.commit()
     conn.close()
     
-def get_latest(limit=100):
+def get_latest(limit=100, before=None):
+    """Get the most recent GPS points, newest first
+
+    `before` is a (timestamp, id) keyset position; only points strictly
+    older than it are returned, so each page is an index range seek.
+    """
     conn = sqlite3.connect(DB)
     c = conn.cursor()
-    c.execute('''
-        SELECT v.imei, v.license_plate, g.timestamp, g.latitude, g.longitude, g.speed 
+    
+    query = '''
+        SELECT g.id, v.imei, v.license_plate, g.timestamp, g.latitude, g.longitude, g.speed 
         FROM gps_data g
         JOIN vehicles v ON g.vehicle_id = v.id
         WHERE g.latitude IS NOT NULL AND g.longitude IS NOT NULL 
-        ORDER BY g.id DESC 
-        LIMIT ?
-    ''', (limit,))
+    '''
+    params = []
+    
+    if before:
+        query += ' AND (g.timestamp, g.id) < (?, ?)'
+        params.extend(before)
+    
+    query += ' ORDER BY g.timestamp DESC, g.id DESC LIMIT ?'
+    params.append(limit)
+    
+    c.execute(query, params)
     rows = c.fetchall()
     conn.close()
-    return [{'imei': r[0], 'license_plate': r[1], 'timestamp': r[2], 'lat': r[3], 'lon': r[4], 'speed': r[5]} for r in rows]
+    return [{'id': r[0], 'imei': r[1], 'license_plate': r[2], 'timestamp': r[3], 'lat': r[4], 'lon': r[5], 'speed': r[6]} for r in rows]
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     R = 6371  # Earth's radius in kilometers
@@ -49,14 +94,38 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     c = 2 * math.asin(math.sqrt(a))
     return R * c
 
-def detect_parking_events(imei, start_date=None, end_date=None):
+def _parking_event(vehicle_id, imei, stop, end_time):
+    start_time, start_lat, start_lon = stop
+    
+    # Calculate duration
+    start_dt = datetime.datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+    end_dt = datetime.datetime.fromisoformat(end_time.replace('Z', '+00:00'))
+    duration_minutes = int((end_dt - start_dt).total_seconds() / 60)
+    
+    # Determine if idling (engine on) or parked (engine off)
+    event_type = 'idling' if duration_minutes < 30 else 'parked'
+    
+    if duration_minutes < 5:  # Only record events longer than 5 minutes
+        return None
+    
+    return {
+        'vehicle_id': vehicle_id,
+        'imei': imei,
+        'start_time': start_time,
+        'end_time': end_time,
+        'latitude': start_lat,
+        'longitude': start_lon,
+        'duration_minutes': duration_minutes,
+        'event_type': event_type,
+        'location': reverse_geocode(start_lat, start_lon)
+    }
+
+def iter_parking_events(imei, start_date=None, end_date=None):
+    """Yield parking events while streaming GPS rows from the database"""
     # Get vehicle_id for normalization
     vehicle_id = get_vehicle_id_from_imei(imei)
     if not vehicle_id:
-        return []
-    
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
+        return
     
     query = '''
         SELECT g.timestamp, g.latitude, g.longitude, g.speed 
@@ -75,68 +144,40 @@ def detect_parking_events(imei, start_date=None, end_date=None):
     
     query += ' ORDER BY timestamp'
     
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
+    # Recurring place of each stop already clustered by stop_places
+    place_ids = get_place_ids(vehicle_id, start_date, end_date)
+    stop = None
+    last_timestamp = None
     
-    parking_events = []
-    if not rows:
-        return parking_events
-    
-    i = 0
-    while i < len(rows):
-        timestamp, lat, lon, speed = rows[i]
-        
+    for timestamp, lat, lon, speed in iter_query(DB, query, params):
         # Check if vehicle is stopped (speed < 1 km/h)
         if speed < 1.0:
-            start_time = timestamp
-            start_lat = lat
-            start_lon = lon
-            
-            # Find when vehicle starts moving again
-            j = i + 1
-            while j < len(rows) and rows[j][3] < 1.0:
-                j += 1
-            
-            if j < len(rows):
-                end_time = rows[j][0]
-            else:
-                end_time = rows[-1][0]
-            
-            # Calculate duration
-            start_dt = datetime.datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-            end_dt = datetime.datetime.fromisoformat(end_time.replace('Z', '+00:00'))
-            duration_minutes = int((end_dt - start_dt).total_seconds() / 60)
-            
-            # Determine if idling (engine on) or parked (engine off)
-            event_type = 'idling' if duration_minutes < 30 else 'parked'
-            
-            if duration_minutes >= 5:  # Only record events longer than 5 minutes
-                parking_events.append({
-                    'vehicle_id': vehicle_id,
-                    'imei': imei,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'latitude': start_lat,
-                    'longitude': start_lon,
-                    'duration_minutes': duration_minutes,
-                    'event_type': event_type
-                })
-            
-            i = j
-        else:
-            i += 1
-    
-    return parking_events
+            if stop is None:
+                stop = (timestamp, lat, lon)
+        elif stop is not None:
+            # Vehicle starts moving again
+            event = _parking_event(vehicle_id, imei, stop, timestamp)
+            if event:
+                event['place_id'] = place_ids.get(event['start_time'])
+                yield event
+            stop = None
+        last_timestamp = timestamp
+    
+    if stop is not None:
+        event = _parking_event(vehicle_id, imei, stop, last_timestamp)
+        if event:
+            event['place_id'] = place_ids.get(event['start_time'])
+            yield event
 
-def get_daily_mileage(imei, start_date=None, end_date=None):
+def detect_parking_events(imei, start_date=None, end_date=None):
+    return list(iter_parking_events(imei, start_date, end_date))
+
+def iter_daily_mileage(imei, start_date=None, end_date=None):
+    """Yield one mileage entry per day while streaming GPS rows"""
     # Get vehicle_id for normalization
     vehicle_id = get_vehicle_id_from_imei(imei)
     if not vehicle_id:
-        return []
-    
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
+        return
     
     query = '''
         SELECT DATE(g.timestamp) as date, g.latitude, g.longitude, g.speed
@@ -155,39 +196,69 @@ def get_daily_mileage(imei, start_date=None, end_date=None):
     
     query += ' ORDER BY timestamp'
     
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    
-    daily_mileage = {}
     current_date = None
+    current_km = 0.0
     last_pos = None
     
-    for row in rows:
-        date, lat, lon, speed = row
-        
-        if date not in daily_mileage:
-            daily_mileage[date] = 0.0
-        
-        if last_pos and date == current_date:
+    for date, lat, lon, speed in iter_query(DB, query, params):
+        if date != current_date:
+            if current_date is not None:
+                yield {'vehicle_id': vehicle_id, 'imei': imei, 'date': current_date, 'miles': round(current_km * 0.621371, 2)}
+            current_km = 0.0
+        elif last_pos:
             last_lat, last_lon = last_pos
             distance = calculate_distance(last_lat, last_lon, lat, lon)
             if speed > 1.0:  # Only count distance when vehicle is moving
-                daily_mileage[date] += distance
+                current_km += distance
         
         current_date = date
         last_pos = (lat, lon)
     
-    return [{'vehicle_id': vehicle_id, 'imei': imei, 'date': date, 'miles': round(km * 0.621371, 2)} for date, km in daily_mileage.items()]
+    if current_date is not None:
+        yield {'vehicle_id': vehicle_id, 'imei': imei, 'date': current_date, 'miles': round(current_km * 0.621371, 2)}
 
-def get_trip_summary(imei, start_date=None, end_date=None):
+def get_daily_mileage(imei, start_date=None, end_date=None):
+    return list(iter_daily_mileage(imei, start_date, end_date))
+
+def _trip_summary(vehicle_id, imei, trip, end_row):
+    end_time, end_lat, end_lon = end_row[0], end_row[1], end_row[2]
+    
+    # Calculate duration
+    start_dt = datetime.datetime.fromisoformat(trip['start_time'].replace('Z', '+00:00'))
+    end_dt = datetime.datetime.fromisoformat(end_time.replace('Z', '+00:00'))
+    duration_minutes = int((end_dt - start_dt).total_seconds() / 60)
+    
+    # Calculate average speed
+    avg_speed = trip['speed_total'] / trip['speed_count'] if trip['speed_count'] else 0
+    
+    if duration_minutes < 5:  # Only record trips longer than 5 minutes
+        return None
+    
+    total_distance = trip['distance']
+    return {
+        'vehicle_id': vehicle_id,
+        'imei': imei,
+        'start_time': trip['start_time'],
+        'end_time': end_time,
+        'start_lat': trip['start_lat'],
+        'start_lon': trip['start_lon'],
+        'end_lat': end_lat,
+        'end_lon': end_lon,
+        'start_location': reverse_geocode(trip['start_lat'], trip['start_lon']),
+        'end_location': reverse_geocode(end_lat, end_lon),
+        'distance_km': round(total_distance, 2),
+        'distance_miles': round(total_distance * 0.621371, 2),
+        'avg_speed': round(avg_speed, 2),
+        'max_speed': round(trip['max_speed'], 2),
+        'duration_minutes': duration_minutes
+    }
+
+def iter_trip_summary(imei, start_date=None, end_date=None):
+    """Yield trips while streaming GPS rows from the database"""
     # Get vehicle_id for normalization
     vehicle_id = get_vehicle_id_from_imei(imei)
     if not vehicle_id:
-        return []
-    
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
+        return
     
     query = '''
         SELECT g.timestamp, g.latitude, g.longitude, g.speed
@@ -206,79 +277,45 @@ def get_trip_summary(imei, start_date=None, end_date=None):
     
     query += ' ORDER BY timestamp'
     
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    
-    trips = []
-    if not rows:
-        return trips
+    trip = None
+    last_row = None
     
-    i = 0
-    while i < len(rows):
-        timestamp, lat, lon, speed = rows[i]
+    for row in iter_query(DB, query, params):
+        timestamp, lat, lon, speed = row
         
-        # Start of a trip (vehicle starts moving)
         if speed > 1.0:
-            start_time = timestamp
-            start_lat = lat
-            start_lon = lon
-            max_speed = speed
-            total_distance = 0.0
-            speed_readings = [speed]
-            
-            # Find when trip ends (vehicle stops)
-            j = i + 1
-            last_lat, last_lon = lat, lon
-            
-            while j < len(rows) and rows[j][3] > 1.0:
-                current_time, current_lat, current_lon, current_speed = rows[j]
-                distance = calculate_distance(last_lat, last_lon, current_lat, current_lon)
-                total_distance += distance
-                max_speed = max(max_speed, current_speed)
-                speed_readings.append(current_speed)
-                last_lat, last_lon = current_lat, current_lon
-                j += 1
-            
-            if j < len(rows):
-                end_time = rows[j][0]
-                end_lat = rows[j][1]
-                end_lon = rows[j][2]
+            if trip is None:
+                # Start of a trip (vehicle starts moving)
+                trip = {
+                    'start_time': timestamp,
+                    'start_lat': lat,
+                    'start_lon': lon,
+                    'max_speed': speed,
+                    'speed_total': speed,
+                    'speed_count': 1,
+                    'distance': 0.0
+                }
             else:
-                end_time = rows[-1][0]
-                end_lat = rows[-1][1]
-                end_lon = rows[-1][2]
-            
-            # Calculate duration
-            start_dt = datetime.datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-            end_dt = datetime.datetime.fromisoformat(end_time.replace('Z', '+00:00'))
-            duration_minutes = int((end_dt - start_dt).total_seconds() / 60)
-            
-            # Calculate average speed
-            avg_speed = sum(speed_readings) / len(speed_readings) if speed_readings else 0
-            
-            if duration_minutes >= 5:  # Only record trips longer than 5 minutes
-                trips.append({
-                    'vehicle_id': vehicle_id,
-                    'imei': imei,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'start_lat': start_lat,
-                    'start_lon': start_lon,
-                    'end_lat': end_lat,
-                    'end_lon': end_lon,
-                    'distance_km': round(total_distance, 2),
-                    'distance_miles': round(total_distance * 0.621371, 2),
-                    'avg_speed': round(avg_speed, 2),
-                    'max_speed': round(max_speed, 2),
-                    'duration_minutes': duration_minutes
-                })
-            
-            i = j
-        else:
-            i += 1
-    
-    return trips
+                last_lat, last_lon = last_row[1], last_row[2]
+                trip['distance'] += calculate_distance(last_lat, last_lon, lat, lon)
+                trip['max_speed'] = max(trip['max_speed'], speed)
+                trip['speed_total'] += speed
+                trip['speed_count'] += 1
+        elif trip is not None:
+            # Trip ends when the vehicle stops
+            summary = _trip_summary(vehicle_id, imei, trip, row)
+            if summary:
+                yield summary
+            trip = None
+        last_row = row
+    
+    if trip is not None:
+        summary = _trip_summary(vehicle_id, imei, trip, last_row)
+        if summary:
+            yield summary
+
+def get_trip_summary(imei, start_date=None, end_date=None):
+    return list(iter_trip_summary(imei, start_date, end_date))
 
 # Engine control functions
 def send_engine_command(vehicle_id, command):
@@ -380,6 +417,9 @@ def set_speed_limit(vehicle_id, speed_limit_kmh, set_by):
     conn.commit()
     conn.close()
     
+    # Keep the ingest rule engine's cached limit in step
+    update_speed_limit(vehicle_id, speed_limit_kmh)
+    
     return limit_id
 
 def get_speed_limit(vehicle_id):
@@ -438,44 +478,34 @@ def get_positioning_data(vehicle_id):
 
 def log_alarm(vehicle_id, alarm_type, message):
     """Log an alarm for a vehicle"""
+    return enhanced_log_alarm(vehicle_id, alarm_type, message)
+
+def get_alarm_logs(vehicle_id=None, limit=100, before=None):
+    """Get alarm logs, optionally filtered by vehicle and keyset position"""
     conn = sqlite3.connect(DB)
     c = conn.cursor()
     
-    c.execute('''
-        INSERT INTO alarm_logs (vehicle_id, alarm_type, message, timestamp)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (vehicle_id, alarm_type, message))
+    query = '''
+        SELECT a.id, a.vehicle_id, a.alarm_type, a.message, a.timestamp, a.acknowledged, a.acknowledged_by, a.acknowledged_at,
+               v.license_plate, v.imei
+        FROM alarm_logs a
+        JOIN vehicles v ON a.vehicle_id = v.id
+        WHERE 1=1
+    '''
+    params = []
     
-    alarm_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    if vehicle_id:
+        query += ' AND a.vehicle_id = ?'
+        params.append(vehicle_id)
     
-    return alarm_id
-
-def get_alarm_logs(vehicle_id=None, limit=100):
-    """Get alarm logs, optionally filtered by vehicle"""
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
+    if before:
+        query += ' AND (a.timestamp, a.id) < (?, ?)'
+        params.extend(before)
     
-    if vehicle_id:
-        c.execute('''
-            SELECT a.id, a.vehicle_id, a.alarm_type, a.message, a.timestamp, a.acknowledged, a.acknowledged_by, a.acknowledged_at,
-                   v.license_plate, v.imei
-            FROM alarm_logs a
-            JOIN vehicles v ON a.vehicle_id = v.id
-            WHERE a.vehicle_id = ?
-            ORDER BY a.timestamp DESC 
-            LIMIT ?
-        ''', (vehicle_id, limit))
-    else:
-        c.execute('''
-            SELECT a.id, a.vehicle_id, a.alarm_type, a.message, a.timestamp, a.acknowledged, a.acknowledged_by, a.acknowledged_at,
-                   v.license_plate, v.imei
-            FROM alarm_logs a
-            JOIN vehicles v ON a.vehicle_id = v.id
-            ORDER BY a.timestamp DESC 
-            LIMIT ?
-        ''', (limit,))
+    query += ' ORDER BY a.timestamp DESC, a.id DESC LIMIT ?'
+    params.append(limit)
+    
+    c.execute(query, params)
     
     alarms = []
     for row in c.fetchall():
@@ -495,16 +525,16 @@ def get_alarm_logs(vehicle_id=None, limit=100):
     conn.close()
     return alarms
 
-def create_trip_request(department, requester_name, purpose, destination):
+def create_trip_request(department, requester_name, purpose, destination, pickup_lat=None, pickup_lon=None):
     conn = sqlite3.connect(DB)
     c = conn.cursor()
     
     request_date = datetime.datetime.utcnow().isoformat()
     
     c.execute('''
-        INSERT INTO trip_requests (department, requester_name, request_date, purpose, destination)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (department, requester_name, request_date, purpose, destination))
+        INSERT INTO trip_requests (department, requester_name, request_date, purpose, destination, pickup_lat, pickup_lon)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (department, requester_name, request_date, purpose, destination, pickup_lat, pickup_lon))
     
     conn.commit()
     request_id = c.lastrowid
@@ -512,24 +542,34 @@ def create_trip_request(department, requester_name, purpose, destination):
     
     return request_id
 
-def get_trip_requests(status=None):
+def get_trip_requests(status=None, limit=None, before=None):
+    """Get trip requests newest first, optionally paged by (request_date, id)"""
     conn = sqlite3.connect(DB)
     c = conn.cursor()
     
+    query = '''
+        SELECT id, department, requester_name, request_date, purpose, destination, status, approved_by, approved_at, vehicle_assigned,
+               vehicle_id, pickup_lat, pickup_lon
+        FROM trip_requests 
+        WHERE 1=1
+    '''
+    params = []
+    
     if status:
-        c.execute('''
-            SELECT id, department, requester_name, request_date, purpose, destination, status, approved_by, approved_at, vehicle_assigned
-            FROM trip_requests 
-            WHERE status = ?
-            ORDER BY request_date DESC
-        ''', (status,))
-    else:
-        c.execute('''
-            SELECT id, department, requester_name, request_date, purpose, destination, status, approved_by, approved_at, vehicle_assigned
-            FROM trip_requests 
-            ORDER BY request_date DESC
-        ''')
+        query += ' AND status = ?'
+        params.append(status)
+    
+    if before:
+        query += ' AND (request_date, id) < (?, ?)'
+        params.extend(before)
+    
+    query += ' ORDER BY request_date DESC, id DESC'
+    
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
     
+    c.execute(query, params)
     rows = c.fetchall()
     conn.close()
     
@@ -543,7 +583,10 @@ def get_trip_requests(status=None):
         'status': row[6],
         'approved_by': row[7],
         'approved_at': row[8],
-        'vehicle_assigned': row[9]
+        'vehicle_assigned': row[9],
+        'vehicle_id': row[10],
+        'pickup_lat': row[11],
+        'pickup_lon': row[12]
     } for row in rows]
 
 # Vehicle CRUD functions
@@ -821,96 +864,71 @@ def get_vehicle_statistics():
 
 @app.route('/')
 def index():
-    return render_template('dashboard.html')
+    return render_template('dashboard.html', heatmap_min_zoom=HEATMAP_MIN_ZOOM, heatmap_max_zoom=HEATMAP_MAX_ZOOM)
 
 # API endpoint for latest GPS points
 @app.route('/api/latest')
 @app.route('/api/points')
 def api_points():
-    return jsonify(get_latest(200))
-
-# Park Report API
-@app.route('/api/reports/parking')
-def parking_report():
-    imei = request.args.get('imei')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    
-    if not imei:
-        return jsonify({'error': 'IMEI parameter is required'}), 400
+    # Live positions: delta polling since the client's version, optionally limited to a viewport
+    if 'since' in request.args or 'bbox' in request.args:
+        try:
+            bbox = parse_bbox(request.args.get('bbox'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return changes_response(request.args.get('since'), request.headers.get('If-None-Match'), bbox)
     
-    events = detect_parking_events(imei, start_date, end_date)
-    return jsonify({
-        'imei': imei,
-        'start_date': start_date,
-        'end_date': end_date,
-        'parking_events': events,
-        'total_events': len(events)
-    })
+    try:
+        limit, before = parse_page_args(request.args, default_limit=200)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    points, next_cursor = paginate(get_latest(limit + 1, before), limit)
+    response = jsonify(points)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
-# Daily Mileage Report API
-@app.route('/api/reports/mileage')
-def mileage_report():
-    imei = request.args.get('imei')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+def parking_report_parts(imei, start_date=None, end_date=None):
+    """Parking events plus a trailer with the running event count"""
+    totals = {'total_events': 0}
     
-    if not imei:
-        return jsonify({'error': 'IMEI parameter is required'}), 400
-    
-    mileage_data = get_daily_mileage(imei, start_date, end_date)
-    total_miles = sum(day['miles'] for day in mileage_data)
+    def events():
+        for event in iter_parking_events(imei, start_date, end_date):
+            totals['total_events'] += 1
+            yield event
     
-    return jsonify({
-        'imei': imei,
-        'start_date': start_date,
-        'end_date': end_date,
-        'daily_mileage': mileage_data,
-        'total_miles': round(total_miles, 2)
-    })
+    return 'parking_events', events(), lambda: totals
 
-# Trip Reports API
-@app.route('/api/reports/trips')
-def trips_report():
-    imei = request.args.get('imei')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    
-    if not imei:
-        return jsonify({'error': 'IMEI parameter is required'}), 400
+def mileage_report_parts(imei, start_date=None, end_date=None):
+    """Daily mileage plus a trailer with the running total"""
+    totals = {'total_miles': 0.0}
     
-    trips = get_trip_summary(imei, start_date, end_date)
-    total_distance = sum(trip['distance_miles'] for trip in trips)
-    total_duration = sum(trip['duration_minutes'] for trip in trips)
+    def days():
+        for day in iter_daily_mileage(imei, start_date, end_date):
+            totals['total_miles'] += day['miles']
+            yield day
     
-    return jsonify({
-        'imei': imei,
-        'start_date': start_date,
-        'end_date': end_date,
-        'trips': trips,
-        'total_trips': len(trips),
-        'total_distance_miles': round(total_distance, 2),
-        'total_duration_minutes': total_duration
-    })
+    return 'daily_mileage', days(), lambda: {'total_miles': round(totals['total_miles'], 2)}
 
-# Fuel Report API (placeholder for future fuel sensor integration)
-@app.route('/api/reports/fuel')
-def fuel_report():
-    imei = request.args.get('imei')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+def trips_report_parts(imei, start_date=None, end_date=None):
+    """Trips plus a trailer with running trip, distance and duration totals"""
+    totals = {'total_trips': 0, 'total_distance_miles': 0.0, 'total_duration_minutes': 0}
     
-    if not imei:
-        return jsonify({'error': 'IMEI parameter is required'}), 400
+    def trips():
+        for trip in iter_trip_summary(imei, start_date, end_date):
+            totals['total_trips'] += 1
+            totals['total_distance_miles'] += trip['distance_miles']
+            totals['total_duration_minutes'] += trip['duration_minutes']
+            yield trip
     
-    # Get vehicle_id from IMEI for normalization
-    vehicle_id = get_vehicle_id_from_imei(imei)
-    if not vehicle_id:
-        return jsonify({'error': 'Vehicle not found for IMEI'}), 404
-    
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
+    def trailer():
+        return {**totals, 'total_distance_miles': round(totals['total_distance_miles'], 2)}
     
+    return 'trips', trips(), trailer
+
+def iter_fuel_data(vehicle_id, start_date=None, end_date=None):
+    """Yield fuel readings for a vehicle in timestamp order"""
     query = '''
         SELECT timestamp, fuel_level, fuel_filled, fuel_drained, event_type
         FROM fuel_data 
@@ -927,39 +945,96 @@ def fuel_report():
     
     query += ' ORDER BY timestamp'
     
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    
-    fuel_data = []
-    total_filled = 0.0
-    total_drained = 0.0
-    
-    for row in rows:
-        timestamp, fuel_level, fuel_filled, fuel_drained, event_type = row
-        fuel_data.append({
+    for timestamp, fuel_level, fuel_filled, fuel_drained, event_type in iter_query(DB, query, params):
+        yield {
             'timestamp': timestamp,
             'fuel_level': fuel_level,
             'fuel_filled': fuel_filled,
             'fuel_drained': fuel_drained,
             'event_type': event_type
-        })
-        total_filled += fuel_filled or 0
-        total_drained += fuel_drained or 0
+        }
+
+def fuel_report_parts(imei, start_date=None, end_date=None):
+    """Fuel readings plus a trailer with running fill/drain totals"""
+    vehicle_id = get_vehicle_id_from_imei(imei)
+    totals = {'filled': 0.0, 'drained': 0.0}
     
-    return jsonify({
-        'imei': imei,
-        'start_date': start_date,
-        'end_date': end_date,
-        'fuel_data': fuel_data,
-        'total_filled': round(total_filled, 2),
-        'total_drained': round(total_drained, 2),
-        'net_consumption': round(total_filled - total_drained, 2)
-    })
+    def readings():
+        if not vehicle_id:
+            return
+        for reading in iter_fuel_data(vehicle_id, start_date, end_date):
+            totals['filled'] += reading['fuel_filled'] or 0
+            totals['drained'] += reading['fuel_drained'] or 0
+            yield reading
+    
+    def trailer():
+        return {
+            'total_filled': round(totals['filled'], 2),
+            'total_drained': round(totals['drained'], 2),
+            'net_consumption': round(totals['filled'] - totals['drained'], 2)
+        }
+    
+    return 'fuel_data', readings(), trailer
 
-# Temperature Report API (placeholder for future temperature sensor integration)
-@app.route('/api/reports/temperature')
-def temperature_report():
+def iter_temperature_data(vehicle_id, start_date=None, end_date=None):
+    """Yield temperature readings for a vehicle in timestamp order"""
+    query = '''
+        SELECT timestamp, temperature_celsius, sensor_id
+        FROM temperature_data 
+        WHERE vehicle_id = ?
+    '''
+    params = [vehicle_id]
+    
+    if start_date:
+        query += ' AND timestamp >= ?'
+        params.append(start_date)
+    if end_date:
+        query += ' AND timestamp <= ?'
+        params.append(end_date)
+    
+    query += ' ORDER BY timestamp'
+    
+    for timestamp, temp_celsius, sensor_id in iter_query(DB, query, params):
+        yield {
+            'timestamp': timestamp,
+            'temperature_celsius': temp_celsius,
+            'sensor_id': sensor_id
+        }
+
+def temperature_report_parts(imei, start_date=None, end_date=None):
+    """Temperature readings plus a trailer with running min/max/avg"""
+    vehicle_id = get_vehicle_id_from_imei(imei)
+    totals = {'count': 0, 'stats': new_stats()}
+    
+    def readings():
+        if not vehicle_id:
+            return
+        for reading in iter_temperature_data(vehicle_id, start_date, end_date):
+            totals['count'] += 1
+            update_stats(totals['stats'], reading['temperature_celsius'])
+            yield reading
+    
+    def trailer():
+        avg_temp = stats_average(totals['stats'])
+        return {
+            'readings_count': totals['count'],
+            'average_temperature': round(avg_temp, 2) if avg_temp else None,
+            'min_temperature': totals['stats']['min'],
+            'max_temperature': totals['stats']['max']
+        }
+    
+    return 'temperature_data', readings(), trailer
+
+# Report builders shared by the report routes and background report jobs
+REPORTS = {
+    'parking': parking_report_parts,
+    'mileage': mileage_report_parts,
+    'trips': trips_report_parts,
+    'fuel': fuel_report_parts,
+    'temperature': temperature_report_parts
+}
+
+def report_response(report, requires_vehicle=False):
     imei = request.args.get('imei')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
@@ -968,60 +1043,195 @@ def temperature_report():
         return jsonify({'error': 'IMEI parameter is required'}), 400
     
     # Get vehicle_id from IMEI for normalization
-    vehicle_id = get_vehicle_id_from_imei(imei)
-    if not vehicle_id:
+    if requires_vehicle and not get_vehicle_id_from_imei(imei):
         return jsonify({'error': 'Vehicle not found for IMEI'}), 404
     
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
+    header = {'imei': imei, 'start_date': start_date, 'end_date': end_date}
+    key, items, trailer = REPORTS[report](imei, start_date, end_date)
     
-    query = '''
-        SELECT timestamp, temperature_celsius, sensor_id
-        FROM temperature_data 
-        WHERE vehicle_id = ?
-    '''
+    if wants_stream():
+        return stream_json_report(header, key, items, trailer)
+    return report_json(build_report(header, key, items, trailer))
+
+# Park Report API
+@app.route('/api/reports/parking')
+def parking_report():
+    return report_response('parking')
+
+# Daily Mileage Report API
+@app.route('/api/reports/mileage')
+def mileage_report():
+    return report_response('mileage')
+
+# Trip Reports API
+@app.route('/api/reports/trips')
+def trips_report():
+    return report_response('trips')
+
+# Fuel Report API (placeholder for future fuel sensor integration)
+@app.route('/api/reports/fuel')
+def fuel_report():
+    return report_response('fuel', requires_vehicle=True)
+
+# Bucket sizes accepted by the temperature report, in seconds
+TEMPERATURE_BUCKETS = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600, '1d': 86400}
+
+def _temperature_filters(vehicle_id, start_date=None, end_date=None):
+    where = 'vehicle_id = ? AND temperature_celsius IS NOT NULL'
     params = [vehicle_id]
     
     if start_date:
-        query += ' AND timestamp >= ?'
+        where += ' AND timestamp >= ?'
         params.append(start_date)
     if end_date:
-        query += ' AND timestamp <= ?'
+        where += ' AND timestamp <= ?'
         params.append(end_date)
     
-    query += ' ORDER BY timestamp'
+    return where, params
+
+def get_temperature_buckets(vehicle_id, bucket_seconds, start_date=None, end_date=None):
+    """Min/max/avg/count per sensor and time bucket, aggregated in SQL"""
+    where, params = _temperature_filters(vehicle_id, start_date, end_date)
+    
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    
+    c.execute(f'''
+        SELECT sensor_id,
+               strftime('%Y-%m-%dT%H:%M:%S', CAST(strftime('%s', timestamp) AS INTEGER) / ? * ?, 'unixepoch') AS bucket,
+               MIN(temperature_celsius), MAX(temperature_celsius), AVG(temperature_celsius), COUNT(*)
+        FROM temperature_data
+        WHERE {where}
+        GROUP BY sensor_id, bucket
+        ORDER BY sensor_id, bucket
+    ''', [bucket_seconds, bucket_seconds] + params)
     
-    c.execute(query, params)
     rows = c.fetchall()
     conn.close()
     
-    temp_data = []
-    temps = []
-    
-    for row in rows:
-        timestamp, temp_celsius, sensor_id = row
-        temp_data.append({
-            'timestamp': timestamp,
-            'temperature_celsius': temp_celsius,
-            'sensor_id': sensor_id
+    sensors = {}
+    for sensor_id, bucket, min_temp, max_temp, avg_temp, count in rows:
+        sensors.setdefault(sensor_id, []).append({
+            'time': bucket,
+            'min': min_temp,
+            'max': max_temp,
+            'avg': round(avg_temp, 2),
+            'count': count
         })
-        if temp_celsius is not None:
-            temps.append(temp_celsius)
     
-    avg_temp = sum(temps) / len(temps) if temps else None
-    min_temp = min(temps) if temps else None
-    max_temp = max(temps) if temps else None
+    return sensors
+
+def get_temperature_excursions(vehicle_id, min_temp=None, max_temp=None, start_date=None, end_date=None):
+    """Periods each sensor spent outside [min_temp, max_temp]
+
+    Consecutive out-of-range readings are grouped in SQL (gaps and islands).
+    An excursion lasts from its first reading to the next in-range reading,
+    or to its last reading if the range ends while still outside.
+    """
+    where, params = _temperature_filters(vehicle_id, start_date, end_date)
+    low = min_temp if min_temp is not None else float('-inf')
+    high = max_temp if max_temp is not None else float('inf')
     
-    return jsonify({
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    
+    c.execute(f'''
+        WITH readings AS (
+            SELECT sensor_id, timestamp, temperature_celsius AS temp,
+                   CAST(strftime('%s', timestamp) AS INTEGER) AS ts,
+                   (temperature_celsius < ? OR temperature_celsius > ?) AS outside
+            FROM temperature_data
+            WHERE {where}
+        ), flagged AS (
+            SELECT *,
+                   LEAD(ts) OVER w AS next_ts,
+                   CASE WHEN outside != LAG(outside, 1, -1) OVER w THEN 1 ELSE 0 END AS run_start
+            FROM readings
+            WINDOW w AS (PARTITION BY sensor_id ORDER BY timestamp)
+        ), runs AS (
+            SELECT *, SUM(run_start) OVER (PARTITION BY sensor_id ORDER BY timestamp
+                                           ROWS UNBOUNDED PRECEDING) AS run_id
+            FROM flagged
+        )
+        SELECT sensor_id, MIN(timestamp), MAX(timestamp),
+               MAX(COALESCE(next_ts, ts)) - MIN(ts), MIN(temp), MAX(temp), COUNT(*)
+        FROM runs
+        WHERE outside
+        GROUP BY sensor_id, run_id
+        ORDER BY sensor_id, MIN(timestamp)
+    ''', [low, high] + params)
+    
+    rows = c.fetchall()
+    conn.close()
+    
+    return [{
+        'sensor_id': row[0],
+        'start_time': row[1],
+        'last_reading': row[2],
+        'duration_seconds': row[3],
+        'min_temperature': row[4],
+        'max_temperature': row[5],
+        'readings': row[6]
+    } for row in rows]
+
+def temperature_bucket_report(imei, start_date, end_date):
+    bucket = request.args.get('bucket')
+    if bucket not in TEMPERATURE_BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(TEMPERATURE_BUCKETS)}"}), 400
+    
+    try:
+        # type=float would silently turn a bad value into None
+        min_temp = float(request.args['min_temp']) if 'min_temp' in request.args else None
+        max_temp = float(request.args['max_temp']) if 'max_temp' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid temperature threshold'}), 400
+    
+    vehicle_id = get_vehicle_id_from_imei(imei)
+    sensors = get_temperature_buckets(vehicle_id, TEMPERATURE_BUCKETS[bucket], start_date, end_date)
+    
+    # Overall figures come from the buckets, not the raw readings
+    buckets = [b for series in sensors.values() for b in series]
+    readings_count = sum(b['count'] for b in buckets)
+    average = sum(b['avg'] * b['count'] for b in buckets) / readings_count if readings_count else None
+    
+    report = {
         'imei': imei,
         'start_date': start_date,
         'end_date': end_date,
-        'temperature_data': temp_data,
-        'readings_count': len(temp_data),
-        'average_temperature': round(avg_temp, 2) if avg_temp else None,
-        'min_temperature': min_temp,
-        'max_temperature': max_temp
-    })
+        'bucket': bucket,
+        'sensors': [{'sensor_id': sensor_id, 'buckets': series} for sensor_id, series in sensors.items()],
+        'readings_count': readings_count,
+        'average_temperature': round(average, 2) if average is not None else None,
+        'min_temperature': min((b['min'] for b in buckets), default=None),
+        'max_temperature': max((b['max'] for b in buckets), default=None)
+    }
+    
+    if request.args.get('min_temp') is not None or request.args.get('max_temp') is not None:
+        excursions = get_temperature_excursions(vehicle_id, min_temp, max_temp, start_date, end_date)
+        totals = {}
+        for excursion in excursions:
+            totals[excursion['sensor_id']] = totals.get(excursion['sensor_id'], 0) + excursion['duration_seconds']
+        report.update({
+            'min_temp': min_temp,
+            'max_temp': max_temp,
+            'excursions': excursions,
+            'excursion_seconds': [{'sensor_id': s, 'seconds': total} for s, total in totals.items()]
+        })
+    
+    return report_json(report)
+
+# Temperature Report API (placeholder for future temperature sensor integration)
+@app.route('/api/reports/temperature')
+def temperature_report():
+    if request.args.get('bucket'):
+        imei = request.args.get('imei')
+        if not imei:
+            return jsonify({'error': 'IMEI parameter is required'}), 400
+        if not get_vehicle_id_from_imei(imei):
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+        return temperature_bucket_report(imei, request.args.get('start_date'), request.args.get('end_date'))
+    
+    return report_response('temperature', requires_vehicle=True)
 
 # Engine Control APIs
 @app.route('/api/engine/cut', methods=['POST'])
@@ -1089,15 +1299,22 @@ def engine_status():
 # Speed Limit APIs
 @app.route('/api/speed_limit', methods=['POST'])
 def set_speed_limit_api():
-    data = request.get_json()
+    data = request.get_json() or {}
     imei = data.get('imei')
     speed_limit_kmh = data.get('speed_limit')
     set_by = data.get('user', 'system')
     
     if not imei:
         return jsonify({'error': 'IMEI parameter is required'}), 400
-    if not speed_limit_kmh:
+    if speed_limit_kmh is None or speed_limit_kmh == '':
         return jsonify({'error': 'Speed limit is required'}), 400
+    # Validate before storing: the active row is reloaded on every start
+    try:
+        speed_limit_kmh = float(speed_limit_kmh)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Speed limit must be a number'}), 400
+    if not math.isfinite(speed_limit_kmh) or speed_limit_kmh <= 0:
+        return jsonify({'error': 'Speed limit must be a positive number'}), 400
     
     # Get vehicle_id from IMEI for normalization
     vehicle = get_vehicle_by_imei(imei)
@@ -1143,22 +1360,21 @@ def get_speed_limit_api():
 @app.route('/api/alarms', methods=['GET'])
 def get_alarms():
     imei = request.args.get('imei')
-    limit = request.args.get('limit', 100)
-    
-    if not imei:
-        return jsonify({'error': 'IMEI parameter is required'}), 400
     
-    # Get vehicle_id from IMEI for normalization
-    vehicle = get_vehicle_by_imei(imei)
-    if not vehicle:
-        return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+    vehicle_id = None
+    if imei:
+        # Get vehicle_id from IMEI for normalization
+        vehicle = get_vehicle_by_imei(imei)
+        if not vehicle:
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+        vehicle_id = vehicle['id']
     
     try:
-        limit = int(limit)
-        alarms = get_alarm_logs(vehicle['id'], limit)
-        return jsonify({'alarms': alarms})
-    except ValueError:
-        return jsonify({'error': 'Invalid limit parameter'}), 400
+        limit, before = parse_page_args(request.args)
+        alarms, next_cursor = paginate(get_alarm_logs(vehicle_id, limit + 1, before), limit)
+        return jsonify({'alarms': alarms, 'next_cursor': next_cursor})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1197,25 +1413,59 @@ def acknowledge_alarm():
         return jsonify({'error': 'alarm_id and acknowledged_by are required'}), 400
     
     try:
-        conn = sqlite3.connect(DB)
-        c = conn.cursor()
-        
-        c.execute('''
-            UPDATE alarm_logs 
-            SET acknowledged = 1, acknowledged_by = ?, acknowledged_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (acknowledged_by, alarm_id))
-        
-        conn.commit()
-        conn.close()
-        
-        if c.rowcount > 0:
+        # Goes through the alarm module so counters and escalations stay in step
+        if acknowledge_alarm_log(alarm_id, acknowledged_by):
             return jsonify({'message': 'Alarm acknowledged successfully'})
         else:
             return jsonify({'error': 'Alarm not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Trip Request APIs
+@app.route('/api/trip_requests', methods=['GET', 'POST'])
+def trip_requests_api():
+    if request.method == 'POST':
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No data provided for trip request'}), 400
+        
+        for field in ['department', 'requester_name', 'purpose', 'destination']:
+            if not data.get(field):
+                return jsonify({'error': f'{field} is required'}), 400
+        
+        try:
+            pickup_lat = float(data['pickup_lat']) if data.get('pickup_lat') is not None else None
+            pickup_lon = float(data['pickup_lon']) if data.get('pickup_lon') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'pickup_lat and pickup_lon must be numbers'}), 400
+        
+        try:
+            request_id = create_trip_request(data['department'], data['requester_name'],
+                                             data['purpose'], data['destination'], pickup_lat, pickup_lon)
+            return jsonify({
+                'success': True,
+                'message': 'Trip request created successfully',
+                'request_id': request_id
+            }), 201
+        except Exception as e:
+            return jsonify({'error': 'Failed to create trip request: ' + str(e)}), 500
+    
+    else:  # GET
+        status = request.args.get('status')
+        
+        try:
+            limit, before = parse_page_args(request.args, default_limit=50)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            trip_requests, next_cursor = paginate(get_trip_requests(status, limit + 1, before), limit,
+                                                  timestamp_key='request_date')
+            return jsonify({'trip_requests': trip_requests, 'next_cursor': next_cursor})
+        except Exception as e:
+            return jsonify({'error': 'Failed to fetch trip requests: ' + str(e)}), 500
+
 @app.route('/api/vehicles', methods=['GET', 'POST'])
 def vehicles_api():
     if request.method == 'POST':
@@ -1331,10 +1581,47 @@ def get_vehicle_statistics_api():
     except Exception as e:
         return jsonify({'error': 'Failed to fetch vehicle statistics: ' + str(e)}), 500
 
-# Initialize alarm system
+# Initialize database indexes and alarm system
+init_db()
+init_alarm_db()
+init_route_track_db()
+init_fuel_analytics_db()
+init_geofence_db()
+init_driver_behavior_db()
+init_route_plan_db()
+init_trip_assignment_db()
+init_heatmap_db()
+init_stop_places_db()
+load_speed_limits()
+load_geofences()
+load_idle_status()
+load_route_plans()
+load_live_positions()
+load_gazetteer()
+add_packet_handler(update_position)
+add_packet_handler(evaluate_speed)
+add_packet_handler(evaluate_geofences)
+add_packet_handler(evaluate_idle)
+add_packet_handler(record_heartbeat)
+add_packet_handler(evaluate_driving)
+add_packet_handler(evaluate_route)
 add_alarm_routes(app)
+add_report_job_routes(app, REPORTS, get_vehicle_id_from_imei)
+add_route_track_routes(app, get_vehicle_id_from_imei)
+add_fuel_analytics_routes(app, get_vehicle_id_from_imei)
+add_geofence_routes(app, get_vehicle_id_from_imei)
+add_idle_routes(app, get_vehicle_id_from_imei)
+add_driver_behavior_routes(app, get_vehicle_id_from_imei)
+add_route_plan_routes(app)
+add_live_position_routes(app)
+add_trip_assignment_routes(app, get_vehicle_id_from_imei)
+add_heatmap_routes(app)
+init_report_format(app)
+add_stop_place_routes(app, iter_parking_events, get_vehicle_id_from_imei)
 
 if __name__ == '__main__':
     t = threading.Thread(target=start_server, daemon=True)
     t.start()
+    start_offline_monitor()
+    start_stop_place_job(iter_parking_events)
     app.run(host='0.0.0.0', port=8000, debug=False)
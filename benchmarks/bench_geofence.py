@@ -0,0 +1,98 @@
+# Geofence containment throughput: 10k zones x 5k vehicles at 1 Hz
+#
+#   python benchmarks/bench_geofence.py --zones 10000 --vehicles 5000 --seconds 10
+#
+# Runs the in-memory engine only (no database, no alarm writes), so the
+# result is the per-packet cost of the index, prefilter and exact tests.
+import os
+import sys
+import math
+import json
+import time
+import random
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import geofence
+
+# Area the zones and vehicles are spread over (about 55 x 55 km)
+CENTER = (9.0108, 38.7613)
+SPAN_DEG = 0.5
+
+def make_zones(count, rnd):
+    """Mixed circles, rectangles and polygons from 50 m to 2 km across"""
+    zones = []
+    for zone_id in range(1, count + 1):
+        lat = CENTER[0] + rnd.uniform(-SPAN_DEG / 2, SPAN_DEG / 2)
+        lon = CENTER[1] + rnd.uniform(-SPAN_DEG / 2, SPAN_DEG / 2)
+        size_m = rnd.uniform(50, 2000)
+        zone_type = geofence.ZONE_TYPES[zone_id % 3]
+
+        if zone_type == 'circle':
+            geometry = {'lat': lat, 'lon': lon, 'radius_m': size_m / 2}
+        elif zone_type == 'rectangle':
+            half = size_m / 2 / 111000
+            geometry = {'min_lat': lat - half, 'min_lon': lon - half, 'max_lat': lat + half, 'max_lon': lon + half}
+        else:
+            sides = rnd.randint(5, 12)
+            radius = size_m / 2 / 111000
+            geometry = {'points': [[lat + radius * rnd.uniform(0.6, 1.0) * math.sin(2 * math.pi * k / sides),
+                                    lon + radius * rnd.uniform(0.6, 1.0) * math.cos(2 * math.pi * k / sides)]
+                                   for k in range(sides)]}
+
+        zones.append({'id': zone_id, 'name': f'zone-{zone_id}', 'zone_type': zone_type,
+                      'geometry': geometry, 'vehicle_id': None, 'alarm_on': 'both', 'schedule': None})
+    return zones
+
+def run(zone_count, vehicle_count, seconds, seed=7):
+    rnd = random.Random(seed)
+
+    started = time.perf_counter()
+    geofence.build_index(make_zones(zone_count, rnd))
+    index_ms = (time.perf_counter() - started) * 1000
+
+    # Vehicles drive 0-25 m/s with a wandering heading, one fix per second
+    positions = [[CENTER[0] + rnd.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+                  CENTER[1] + rnd.uniform(-SPAN_DEG / 2, SPAN_DEG / 2),
+                  rnd.uniform(0, 2 * math.pi), rnd.uniform(0, 25)]
+                 for _ in range(vehicle_count)]
+
+    transitions = 0
+    evaluated = 0
+    elapsed = 0.0
+    for _ in range(seconds):
+        for vehicle_id, position in enumerate(positions):
+            position[2] += rnd.gauss(0, 0.1)
+            position[0] += position[3] * math.cos(position[2]) / 110540
+            position[1] += position[3] * math.sin(position[2]) / 111320
+
+            start = time.perf_counter()
+            transitions += len(geofence.update_vehicle_zones(vehicle_id, position[0], position[1]))
+            elapsed += time.perf_counter() - start
+            evaluated += 1
+
+    return {
+        'zones': zone_count,
+        'vehicles': vehicle_count,
+        'seconds_simulated': seconds,
+        'index_build_ms': round(index_ms, 1),
+        'grid_cells': len(geofence._index['grid']),
+        'packets': evaluated,
+        'transitions': transitions,
+        'us_per_packet': round(elapsed / evaluated * 1e6, 2),
+        'packets_per_second': round(evaluated / elapsed),
+        'required_packets_per_second': vehicle_count,
+        'realtime_headroom': round(evaluated / elapsed / vehicle_count, 1)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark geofence containment checks')
+    parser.add_argument('--zones', type=int, default=10000)
+    parser.add_argument('--vehicles', type=int, default=5000)
+    parser.add_argument('--seconds', type=int, default=10, help='Simulated seconds of 1 Hz traffic')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.zones, args.vehicles, args.seconds, args.seed), indent=2))
@@ -0,0 +1,328 @@
+# Notification dispatcher against local HTTP and SMTP stand-ins
+#
+#   python benchmarks/bench_notifications.py --alarms 200
+#   python benchmarks/bench_notifications.py --check
+#
+# Starts an http.server receiving the webhook and SMS gateway posts and a
+# minimal SMTP server on localhost, points notifications.py at them and
+# runs four scenarios: failed deliveries being retried, non-critical
+# alarms batched into a digest (including the NOTIFY_DIGEST_MAX cap),
+# escalation of unacknowledged critical alarms, and connection reuse for
+# a burst of critical alarms. Each reports what the stand-ins received
+# and how many TCP connections they accepted. With --check the results
+# are also compared against what the dispatcher promises (retry count,
+# backoff delays, digest cap, escalation recipients) and the script exits
+# with status 1 if any of them does not hold.
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import notifications
+
+class Recorder:
+    """What a stand-in received, shared with its request handlers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.messages = []
+            self.attempts = []      # HTTP: (monotonic time, path, status) of every request
+            self.fail_next = 0      # HTTP: answer this many requests with 503
+            self.drop_after = None  # SMTP: close a connection after this many messages
+
+    def add(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse is visible
+
+    def setup(self):
+        super().setup()
+        with self.server.recorder.lock:
+            self.server.recorder.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        recorder = self.server.recorder
+        with recorder.lock:
+            failing = recorder.fail_next > 0
+            recorder.fail_next -= failing
+        if failing:
+            status = 503
+        else:
+            status = 200
+            recorder.add({'path': self.path, 'body': json.loads(body)})
+        with recorder.lock:
+            recorder.attempts.append((time.monotonic(), self.path, status))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib.send_message: EHLO, MAIL, RCPT, DATA, RSET, QUIT"""
+
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        recorder = self.server.recorder
+        with recorder.lock:
+            recorder.connections += 1
+        sent = 0
+        recipients = []
+        self._reply('220 localhost stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self._reply('250-localhost')
+                self._reply('250 8BITMIME')
+            elif verb == 'MAIL':
+                recipients = []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip(' <>'))
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line.decode(errors='replace'))
+                subject = next((l[9:].strip() for l in data if l.startswith('Subject: ')), '')
+                recorder.add({'to': recipients, 'subject': subject})
+                self._reply('250 OK')
+                sent += 1
+                if recorder.drop_after and sent >= recorder.drop_after:
+                    return  # Like a server closing an idle connection; the client reconnects
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:  # HELO, RSET, NOOP
+                self._reply('250 OK')
+
+class ThreadingSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def _start(server):
+    server.recorder = Recorder()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+def _alarm(alarm_id, severity='critical', vehicle_id=1):
+    return {'id': alarm_id, 'vehicle_id': vehicle_id, 'alarm_type': 'sos' if severity == 'critical' else 'overspeed',
+            'message': f'alarm {alarm_id}', 'timestamp': '2025-01-01T08:00:00', 'severity': severity,
+            'category': 'safety', 'metadata': None}
+
+def _reset(http_server, smtp_server):
+    http_server.recorder.reset()
+    smtp_server.recorder.reset()
+    for channel in notifications.CHANNELS:
+        pool = notifications._connections[channel]
+        while not pool.empty():
+            pool.get_nowait().close()
+    for key in notifications.stats:
+        notifications.stats[key] = 0
+
+def _result(http_server, smtp_server, start, **extra):
+    return {
+        'seconds': round(time.monotonic() - start, 3),
+        'http_requests': len(http_server.recorder.messages),
+        'http_connections': http_server.recorder.connections,
+        'emails': len(smtp_server.recorder.messages),
+        'smtp_connections': smtp_server.recorder.connections,
+        'stats': dict(notifications.stats),
+        **extra
+    }
+
+def scenario_retries(http_server, smtp_server, failures):
+    """The webhook answers 503 a few times; the alarm must still arrive on every channel"""
+    http_server.recorder.fail_next = failures
+    start = time.monotonic()
+    notifications.notify_alarm(_alarm(1))
+    # Webhook and SMS share the stand-in, so both posts arrive once the failures are used up
+    delivered = _wait_for(lambda: len(http_server.recorder.messages) >= 2 and smtp_server.recorder.messages, 30)
+    # Gaps between consecutive posts of one channel, in attempt order
+    gaps = {}
+    for path in ('/webhook', '/sms'):
+        times = [t for t, p, status in http_server.recorder.attempts if p == path]
+        gaps[path] = [round(b - a, 3) for a, b in zip(times, times[1:])]
+    return _result(http_server, smtp_server, start, delivered=bool(delivered), failures=failures, gaps=gaps)
+
+def scenario_digest(http_server, smtp_server, count):
+    """Non-critical alarms go out as one digest per channel, listing at most NOTIFY_DIGEST_MAX"""
+    start = time.monotonic()
+    for alarm_id in range(count):
+        notifications.notify_alarm(_alarm(alarm_id, 'warning'))
+    delivered = _wait_for(lambda: http_server.recorder.messages and smtp_server.recorder.messages,
+                          notifications.NOTIFY_DIGEST_SECONDS + 10)
+    digest = http_server.recorder.messages[0]['body'] if delivered else {}
+    return _result(http_server, smtp_server, start, delivered=bool(delivered), count=count,
+                   listed=len(digest.get('alarms', [])), omitted=digest.get('omitted'),
+                   email_subject=smtp_server.recorder.messages[0]['subject'] if delivered else None)
+
+def scenario_escalation(http_server, smtp_server):
+    """Alarm 1 is never acknowledged and escalates; alarm 2 is acknowledged in time"""
+    start = time.monotonic()
+    notifications.notify_alarm(_alarm(1), is_acknowledged=lambda alarm_id: False)
+    notifications.notify_alarm(_alarm(2), is_acknowledged=lambda alarm_id: True)
+    notifications.notify_alarm(_alarm(3), is_acknowledged=lambda alarm_id: False)
+    notifications.cancel_escalation(3)
+    _wait_for(lambda: any(m['subject'].startswith('ESCALATION') for m in smtp_server.recorder.messages)
+              and any('ESCALATION' in m['body']['message'] for m in http_server.recorder.messages if m['path'] == '/sms'),
+              notifications.NOTIFY_ESCALATE_MINUTES * 60 + 10)
+    time.sleep(0.5)  # Give wrongly escalated alarms time to show up
+    escalated = sorted(m['body']['alarm']['id'] for m in http_server.recorder.messages
+                       if m['body'].get('type') == 'escalation')
+    return _result(http_server, smtp_server, start, escalated=escalated,
+                   escalation_emails=[m['to'] for m in smtp_server.recorder.messages
+                                      if m['subject'].startswith('ESCALATION')],
+                   escalation_sms=[m['body']['to'] for m in http_server.recorder.messages
+                                   if m['path'] == '/sms' and 'ESCALATION' in m['body']['message']])
+
+def scenario_reuse(http_server, smtp_server, count, drop_after):
+    """A burst of critical alarms over pooled connections; the SMTP server drops some of them"""
+    smtp_server.recorder.drop_after = drop_after
+    start = time.monotonic()
+    for alarm_id in range(count):
+        notifications.notify_alarm(_alarm(alarm_id, vehicle_id=alarm_id))
+    delivered = _wait_for(lambda: len(http_server.recorder.messages) >= 2 * count
+                          and len(smtp_server.recorder.messages) >= count, 60)
+    return _result(http_server, smtp_server, start, delivered=bool(delivered), alarms=count)
+
+def run(alarms, failures, digest_max, drop_after):
+    http_server = _start(ThreadingHTTPServer(('127.0.0.1', 0), WebhookHandler))
+    smtp_server = _start(ThreadingSMTPServer(('127.0.0.1', 0), SMTPHandler))
+    http_url = f'http://127.0.0.1:{http_server.server_address[1]}'
+    # Email addresses get the escalation email, the other entries the SMS
+    escalation_to = ['duty-manager@example.com', '+251911111111']
+
+    # Point the dispatcher at the stand-ins and shorten its timers
+    notifications.NOTIFY_WEBHOOK_URL = f'{http_url}/webhook'
+    notifications.NOTIFY_SMS_URL = f'{http_url}/sms'
+    notifications.NOTIFY_SMS_TO = ['+251900000000']
+    notifications.NOTIFY_SMTP_HOST = '127.0.0.1'
+    notifications.NOTIFY_SMTP_PORT = smtp_server.server_address[1]
+    notifications.NOTIFY_SMTP_STARTTLS = False
+    notifications.NOTIFY_SMTP_USER = ''
+    notifications.NOTIFY_EMAIL_TO = ['fleet@example.com']
+    notifications.NOTIFY_ESCALATION_TO = escalation_to
+    notifications.NOTIFY_RETRY_BASE_SECONDS = 0.05
+    notifications.NOTIFY_DIGEST_SECONDS = 0.5
+    notifications.NOTIFY_DIGEST_MAX = digest_max
+    notifications.NOTIFY_ESCALATE_MINUTES = 0  # Off until the escalation scenario
+
+    results = {}
+    try:
+        _reset(http_server, smtp_server)
+        results['retries'] = scenario_retries(http_server, smtp_server, failures)
+        _reset(http_server, smtp_server)
+        results['digest'] = scenario_digest(http_server, smtp_server, alarms)
+        _reset(http_server, smtp_server)
+        notifications.NOTIFY_ESCALATE_MINUTES = 0.01
+        results['escalation'] = scenario_escalation(http_server, smtp_server)
+        notifications.NOTIFY_ESCALATE_MINUTES = 0
+        _reset(http_server, smtp_server)
+        results['reuse'] = scenario_reuse(http_server, smtp_server, alarms, drop_after)
+    finally:
+        http_server.shutdown()
+        smtp_server.shutdown()
+    return results
+
+def check(results, max_retries):
+    """What the dispatcher promises, as a list of the checks that failed"""
+    problems = []
+
+    def expect(condition, message):
+        if not condition:
+            problems.append(message)
+
+    retries = results['retries']
+    expect(retries['delivered'], 'retries: alarm not delivered on every channel')
+    expect(retries['stats']['retried'] == retries['failures'],
+           f"retries: {retries['stats']['retried']} retries for {retries['failures']} failed posts")
+    channels = notifications.ROUTES['critical']
+    expect(retries['stats']['sent'] == len(channels) and retries['stats']['failed'] == 0,
+           f"retries: expected {len(channels)} sent and none failed, got {retries['stats']}")
+    base = notifications.NOTIFY_RETRY_BASE_SECONDS
+    for path, gaps in retries['gaps'].items():
+        expect(len(gaps) <= max_retries, f'retries: {path} posted {len(gaps) + 1} times')
+        for attempt, gap in enumerate(gaps):
+            # Backoff is base * 2^attempt with jitter between 0.5 and 1.5
+            low, high = base * 2 ** attempt * 0.5, base * 2 ** attempt * 1.5 + 0.5
+            expect(low <= gap <= high, f'retries: {path} waited {gap}s before retry {attempt + 1}, '
+                                       f'expected {low:.3f}-{high:.3f}s')
+
+    digest = results['digest']
+    listed = min(digest['count'], notifications.NOTIFY_DIGEST_MAX)
+    expect(digest['delivered'], 'digest: not delivered')
+    expect(digest['listed'] == listed and digest['omitted'] == digest['count'] - listed,
+           f"digest: listed {digest['listed']} and omitted {digest['omitted']} of {digest['count']} alarms")
+    channels = notifications.ROUTES['digest']
+    posts = sum(1 for channel in channels if channel != 'email')
+    expect(digest['http_requests'] == posts and digest['emails'] == channels.count('email'),
+           f"digest: expected {posts} posts and {channels.count('email')} emails, got {digest['http_requests']} "
+           f"posts and {digest['emails']} emails")
+
+    escalation = results['escalation']
+    emails = [r for r in notifications.NOTIFY_ESCALATION_TO if '@' in r]
+    phones = [r for r in notifications.NOTIFY_ESCALATION_TO if '@' not in r]
+    expect(escalation['escalated'] == [1], f"escalation: escalated alarms {escalation['escalated']}, expected [1]")
+    expect(escalation['escalation_emails'] == [emails],
+           f"escalation: emails went to {escalation['escalation_emails']}, expected [{emails}]")
+    expect(escalation['escalation_sms'] == [phones],
+           f"escalation: SMS went to {escalation['escalation_sms']}, expected [{phones}]")
+
+    reuse = results['reuse']
+    expect(reuse['delivered'], 'reuse: not every alarm was delivered')
+    expect(reuse['http_connections'] < reuse['http_requests'],
+           f"reuse: {reuse['http_connections']} HTTP connections for {reuse['http_requests']} posts")
+    return problems
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exercise the notification dispatcher against local stand-ins')
+    parser.add_argument('--alarms', type=int, default=200, help='Alarms in the digest and reuse scenarios')
+    parser.add_argument('--failures', type=int, default=3, help='503 answers before the webhook accepts posts')
+    parser.add_argument('--digest-max', type=int, default=50, help='NOTIFY_DIGEST_MAX for the digest scenario')
+    parser.add_argument('--drop-after', type=int, default=25, help='Emails per SMTP connection before the server drops it')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if the dispatcher misbehaves')
+    args = parser.parse_args()
+
+    results = run(args.alarms, args.failures, args.digest_max, args.drop_after)
+    print(json.dumps(results, indent=2))
+    if args.check:
+        problems = check(results, notifications.NOTIFY_MAX_RETRIES)
+        for problem in problems:
+            print(f'FAILED {problem}')
+        print('All checks passed' if not problems else f'{len(problems)} checks failed')
+        sys.exit(1 if problems else 0)
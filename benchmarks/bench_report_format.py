@@ -0,0 +1,100 @@
+# Report payload size and encoding time: row objects vs columnar, json vs orjson, gzip/brotli
+#
+#   python benchmarks/bench_report_format.py --vehicles 20 --days 7
+#
+# Builds the parking and trip reports of every vehicle in a synthetic
+# fleet, then times serialization and compression of the combined
+# payloads the way the report routes send them. orjson and brotli rows
+# are only reported when those packages are installed.
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fleet_generator import generate_fleet
+
+def _best_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, round(min(timings), 3)
+
+def _measure(payload, repeat):
+    import app
+    import report_format
+
+    encoders = {'json': None}
+    if report_format.orjson is not None:
+        encoders['orjson'] = report_format.orjson
+
+    results = []
+    with app.app.app_context():
+        body, ms = _best_ms(lambda: app.app.json.response(payload).get_data(), repeat)
+        results.append(({'format': 'rows', 'encoder': 'jsonify', 'bytes': len(body), 'encode_ms': ms}, body))
+
+        for layout in ('rows', 'columnar'):
+            for name, module in encoders.items():
+                report_format.orjson = module
+                encode = (lambda: report_format.dumps(report_format.columnar(payload))) if layout == 'columnar' \
+                    else (lambda: report_format.dumps(payload))
+                body, ms = _best_ms(encode, repeat)
+                results.append(({'format': layout, 'encoder': name, 'bytes': len(body), 'encode_ms': ms}, body))
+        report_format.orjson = encoders.get('orjson')
+
+    # Compression doesn't depend on the encoder, so only the json bodies are compressed
+    for entry, body in results:
+        if entry['encoder'] == 'orjson':
+            continue
+        packed, ms = _best_ms(lambda: gzip.compress(body, report_format.GZIP_LEVEL), repeat)
+        entry['gzip_bytes'], entry['gzip_ms'] = len(packed), ms
+        if report_format.brotli is not None:
+            packed, ms = _best_ms(lambda: report_format.brotli.compress(body, quality=report_format.BROTLI_QUALITY), repeat)
+            entry['brotli_bytes'], entry['brotli_ms'] = len(packed), ms
+    return [entry for entry, _ in results]
+
+def run(vehicles, days, repeat, work_dir=None):
+    base_dir = work_dir or tempfile.mkdtemp(prefix='gps-bench-format-')
+    original_dir = os.getcwd()
+    try:
+        counts = generate_fleet(os.path.join(base_dir, 'gps.db'), vehicles, days)
+        os.chdir(base_dir)
+        import app
+        import sqlite3
+
+        conn = sqlite3.connect('gps.db')
+        imeis = [row[0] for row in conn.execute('SELECT imei FROM vehicles ORDER BY id')]
+        conn.close()
+
+        results = {}
+        for report, key in (('parking', 'parking_events'), ('trips', 'trips')):
+            rows = []
+            for imei in imeis:
+                _, items, _ = app.REPORTS[report](imei)
+                rows.extend(items)
+            payload = {'start_date': None, 'end_date': None, key: rows, 'total': len(rows)}
+            results[report] = {'rows': len(rows), 'results': _measure(payload, repeat)}
+    finally:
+        os.chdir(original_dir)
+        if not work_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    return {'vehicles': vehicles, 'days': days, 'gps_rows': counts['gps_data'], 'reports': results}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark report payload formats and compression')
+    parser.add_argument('--vehicles', type=int, default=20)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--work-dir', help='Keep the generated database in this directory')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.vehicles, args.days, args.repeat, args.work_dir), indent=2))
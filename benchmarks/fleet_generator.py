@@ -0,0 +1,227 @@
+# Deterministic synthetic fleet history for benchmarks
+#
+#   python benchmarks/fleet_generator.py bench.db --vehicles 20 --days 7
+#
+# The schema is copied from the repository's gps.db, so the generated
+# database matches what the app expects; the app's init_* functions add
+# their indexes on top when it is opened.
+import os
+import sys
+import math
+import random
+import sqlite3
+import argparse
+import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from enhanced_alarm import ALARM_TYPES
+
+SCHEMA_DB = os.path.join(REPO_DIR, 'gps.db')
+
+DEFAULT_START = '2025-01-06'
+DEFAULT_INTERVAL = 30  # Seconds between GPS fixes
+
+# Fleet depots the synthetic vehicles start their days from
+DEPOTS = [(9.0108, 38.7613), (8.9806, 38.7578), (9.0348, 38.7520), (8.9950, 38.7900)]
+
+FUEL_CAPACITY = 80.0
+FUEL_PER_KM = 0.12
+FUEL_IDLE_PER_HOUR = 0.8
+
+def create_schema(path):
+    """Create an empty database with the same tables as the repository gps.db"""
+    source = sqlite3.connect(SCHEMA_DB)
+    statements = [row[0] for row in source.execute('''
+        SELECT sql FROM sqlite_master
+        WHERE type = 'table' AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+        ORDER BY rowid
+    ''')]
+    source.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    for statement in statements:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+def _insert_vehicles(conn, rnd, count, created_at):
+    rows = []
+    for i in range(count):
+        rows.append((
+            f'86{i:013d}',
+            f'BENCH-{i:04d}',
+            rnd.choice(['Toyota', 'Isuzu', 'Nissan']),
+            rnd.choice(['Hilux', 'NPR', 'Land Cruiser']),
+            rnd.randint(2012, 2024),
+            'reefer' if i % 3 == 0 else 'truck',
+            f'Driver {i}',
+            rnd.choice(['Logistics', 'Operations', 'Sales']),
+            FUEL_CAPACITY,
+            created_at,
+            created_at
+        ))
+    conn.executemany('''
+        INSERT INTO vehicles (imei, license_plate, make, model, year, vehicle_type,
+                              driver_name, department, fuel_capacity, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return [row[0] for row in conn.execute('SELECT id FROM vehicles ORDER BY id')]
+
+def _vehicle_day(rnd, vehicle_id, day_start, depot, interval):
+    """GPS fixes for one working day: alternating trips and stops
+
+    Returns (gps_rows, timeline) where the timeline has one
+    (time, km_since_last, moving) tuple per fix for the fuel model.
+    """
+    lat, lon = depot
+    t = day_start + datetime.timedelta(hours=rnd.uniform(6, 8))
+    day_end = day_start + datetime.timedelta(hours=rnd.uniform(17, 20))
+    heading = rnd.uniform(0, 360)
+    gps_rows = []
+    timeline = []
+    step = datetime.timedelta(seconds=interval)
+
+    while t < day_end:
+        # Trip: accelerate, cruise with noise, decelerate
+        cruise = rnd.uniform(30, 90)
+        trip_steps = max(3, int(rnd.uniform(10, 60) * 60 / interval))
+        for i in range(trip_steps):
+            ramp = min(1.0, (i + 1) / 4, (trip_steps - i) / 4)
+            speed = max(2.0, cruise * ramp + rnd.gauss(0, 4))
+            heading = (heading + rnd.gauss(0, 12)) % 360
+            km = speed * interval / 3600
+            lat += km / 110.54 * math.cos(math.radians(heading))
+            lon += km / (111.32 * math.cos(math.radians(lat))) * math.sin(math.radians(heading))
+            gps_rows.append((vehicle_id, t.isoformat(), round(lat, 6), round(lon, 6), round(speed, 1)))
+            timeline.append((t, km, True))
+            t += step
+
+        # Stop: idling or parked, with GPS jitter
+        stop_steps = max(1, int(rnd.choice([rnd.uniform(2, 15), rnd.uniform(20, 90)]) * 60 / interval))
+        for _ in range(stop_steps):
+            gps_rows.append((vehicle_id, t.isoformat(), round(lat + rnd.gauss(0, 2e-6), 6),
+                             round(lon + rnd.gauss(0, 2e-6), 6), 0.0))
+            timeline.append((t, 0.0, False))
+            t += step
+
+    return gps_rows, timeline
+
+def _fuel_rows(rnd, vehicle_id, timeline, level, interval, every=300):
+    """Fuel level readings following consumption, with refuels and rare drains"""
+    rows = []
+    next_reading = None
+    drain_at = rnd.randrange(len(timeline)) if timeline and rnd.random() < 0.05 else None
+
+    for index, (t, km, moving) in enumerate(timeline):
+        level -= km * FUEL_PER_KM
+        if not moving:
+            level -= FUEL_IDLE_PER_HOUR * interval / 3600
+
+        event, filled, drained = 'level', 0.0, 0.0
+        if not moving and level < FUEL_CAPACITY * 0.2:
+            filled = FUEL_CAPACITY * 0.95 - level
+            level += filled
+            event = 'fill'
+        elif index == drain_at:
+            drained = min(level, 15.0)
+            level -= drained
+            event = 'drain'
+
+        if event != 'level' or next_reading is None or t >= next_reading:
+            rows.append((vehicle_id, t.isoformat(), round(level + rnd.gauss(0, 0.15), 2),
+                         round(filled, 2), round(drained, 2), event))
+            next_reading = t + datetime.timedelta(seconds=every)
+
+    return rows, level
+
+def _temperature_rows(rnd, vehicle_id, day_start, every=60):
+    """Two reefer sensors around 4 °C with occasional door-open excursions"""
+    rows = []
+    for sensor in ('temp_001', 'temp_002'):
+        temp = 4.0
+        door_open = 0
+        for i in range(0, 86400, every):
+            if door_open:
+                temp += rnd.uniform(0.3, 0.8)
+                door_open -= 1
+            else:
+                temp += (4.0 - temp) * 0.2 + rnd.gauss(0, 0.15)
+                if rnd.random() < 0.004:
+                    door_open = rnd.randint(3, 12)
+            rows.append((vehicle_id, (day_start + datetime.timedelta(seconds=i)).isoformat(),
+                         round(temp, 2), sensor))
+    return rows
+
+def _alarm_rows(rnd, vehicle_id, gps_rows):
+    rows = []
+    alarm_types = sorted(ALARM_TYPES)
+    for _ in range(rnd.randint(0, 6)):
+        alarm_type = rnd.choice(alarm_types)
+        timestamp = rnd.choice(gps_rows)[1]
+        rows.append((vehicle_id, alarm_type, f'Synthetic {alarm_type} alarm', timestamp,
+                     ALARM_TYPES[alarm_type]['severity'], ALARM_TYPES[alarm_type]['category'],
+                     1 if rnd.random() < 0.3 else 0))
+    return rows
+
+def generate_fleet(path, vehicles=10, days=7, start_date=DEFAULT_START, interval=DEFAULT_INTERVAL, seed=42):
+    """Fill a fresh database at `path` with a synthetic fleet history
+
+    The output depends only on the arguments, so the same call always
+    produces the same rows. Returns per-table row counts.
+    """
+    rnd = random.Random(seed)
+    conn = create_schema(path)
+    first_day = datetime.datetime.fromisoformat(start_date)
+    vehicle_ids = _insert_vehicles(conn, rnd, vehicles, first_day.isoformat())
+
+    for index, vehicle_id in enumerate(vehicle_ids):
+        depot = DEPOTS[index % len(DEPOTS)]
+        level = FUEL_CAPACITY * rnd.uniform(0.5, 0.9)
+        reefer = index % 3 == 0
+
+        for day in range(days):
+            day_start = first_day + datetime.timedelta(days=day)
+            gps_rows, timeline = _vehicle_day(rnd, vehicle_id, day_start, depot, interval)
+            fuel_rows, level = _fuel_rows(rnd, vehicle_id, timeline, level, interval)
+
+            conn.executemany('''
+                INSERT INTO gps_data (vehicle_id, timestamp, latitude, longitude, speed)
+                VALUES (?, ?, ?, ?, ?)
+            ''', gps_rows)
+            conn.executemany('''
+                INSERT INTO fuel_data (vehicle_id, timestamp, fuel_level, fuel_filled, fuel_drained, event_type)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', fuel_rows)
+            if reefer:
+                conn.executemany('''
+                    INSERT INTO temperature_data (vehicle_id, timestamp, temperature_celsius, sensor_id)
+                    VALUES (?, ?, ?, ?)
+                ''', _temperature_rows(rnd, vehicle_id, day_start))
+            conn.executemany('''
+                INSERT INTO alarm_logs (vehicle_id, alarm_type, message, timestamp, severity, category, acknowledged)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', _alarm_rows(rnd, vehicle_id, gps_rows))
+
+        conn.commit()
+
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('vehicles', 'gps_data', 'fuel_data', 'temperature_data', 'alarm_logs')}
+    conn.close()
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic fleet history database')
+    parser.add_argument('path', help='Database file to create (overwritten)')
+    parser.add_argument('--vehicles', type=int, default=10)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--start-date', default=DEFAULT_START)
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL, help='Seconds between GPS fixes')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    counts = generate_fleet(args.path, args.vehicles, args.days, args.start_date, args.interval, args.seed)
+    print(', '.join(f'{table}: {count}' for table, count in counts.items()))
@@ -0,0 +1,181 @@
+# Report and alarm query benchmarks at several fleet sizes
+#
+#   python benchmarks/run_benchmarks.py --output results.json
+#   python benchmarks/run_benchmarks.py --compare results.json
+#
+# Each size gets its own scratch directory with a generated gps.db. The
+# app uses the relative path 'gps.db', so the runner changes into that
+# directory before timing.
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import argparse
+import datetime
+import tempfile
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fleet_generator import generate_fleet, DEFAULT_START
+
+# name -> (vehicles, days)
+SIZES = {
+    'small': (5, 3),
+    'medium': (20, 7),
+    'large': (50, 14)
+}
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _time_call(fn, repeat):
+    fn()  # Warm-up: page cache, imports, prepared statements
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'mean_ms': round(statistics.mean(timings), 3)
+    }
+
+def _benchmarks(days):
+    """Benchmark callables for the database in the current directory"""
+    import app
+    import enhanced_alarm
+
+    # Re-run the schema setup so every scratch database gets the app's indexes
+    app.init_db()
+    enhanced_alarm.init_alarm_db()
+
+    conn = sqlite3.connect('gps.db')
+    imei = conn.execute("SELECT imei FROM vehicles WHERE vehicle_type = 'reefer' ORDER BY id LIMIT 1").fetchone()[0]
+    conn.close()
+
+    start_date = DEFAULT_START
+    end_date = (datetime.date.fromisoformat(DEFAULT_START) + datetime.timedelta(days=days - 1)).isoformat() + 'T23:59:59'
+    since_days = (datetime.date.today() - datetime.date.fromisoformat(DEFAULT_START)).days + 1
+    client = app.app.test_client()
+    query = f'imei={imei}&start_date={start_date}&end_date={end_date}'
+
+    def get_report(path):
+        response = client.get(f'{path}?{query}')
+        assert response.status_code == 200, response.status_code
+        return response.get_data()
+
+    return {
+        'get_latest': lambda: app.get_latest(100),
+        'detect_parking_events': lambda: app.detect_parking_events(imei, start_date, end_date),
+        'get_daily_mileage': lambda: app.get_daily_mileage(imei, start_date, end_date),
+        'get_trip_summary': lambda: app.get_trip_summary(imei, start_date, end_date),
+        'fuel_report': lambda: get_report('/api/reports/fuel'),
+        'temperature_report': lambda: get_report('/api/reports/temperature'),
+        'get_all_alarms': lambda: enhanced_alarm.get_all_alarms(limit=100),
+        'get_alarm_statistics': lambda: enhanced_alarm.get_alarm_statistics(days=since_days)
+    }
+
+def run(sizes, repeat, only=None, work_dir=None):
+    """Generate each fleet size and time every benchmark against it"""
+    results = []
+    base_dir = work_dir or tempfile.mkdtemp(prefix='gps-bench-')
+    original_dir = os.getcwd()
+
+    try:
+        for size in sizes:
+            vehicles, days = SIZES[size]
+            size_dir = os.path.join(base_dir, size)
+            os.makedirs(size_dir, exist_ok=True)
+
+            started = time.perf_counter()
+            counts = generate_fleet(os.path.join(size_dir, 'gps.db'), vehicles, days)
+            print(f"{size}: generated {counts['gps_data']} GPS rows in {time.perf_counter() - started:.1f}s")
+
+            os.chdir(size_dir)
+            for name, fn in _benchmarks(days).items():
+                if only and name not in only:
+                    continue
+                timing = _time_call(fn, repeat)
+                results.append({'size': size, 'vehicles': vehicles, 'days': days,
+                                'rows': counts, 'benchmark': name, **timing})
+                print(f"  {name:<24} median {timing['median_ms']:>10.2f} ms")
+            os.chdir(original_dir)
+    finally:
+        os.chdir(original_dir)
+        if not work_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'repeat': repeat
+        },
+        'results': results
+    }
+
+def compare(current, baseline, threshold, min_delta_ms=1.0):
+    """Return (benchmark, size, baseline_ms, current_ms) for medians that got slower than threshold
+
+    Slowdowns smaller than min_delta_ms are ignored so sub-millisecond
+    timer noise doesn't fail the comparison.
+    """
+    previous = {(r['size'], r['benchmark']): r['median_ms'] for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous.get((result['size'], result['benchmark']))
+        if before and result['median_ms'] > before * (1 + threshold) and result['median_ms'] - before >= min_delta_ms:
+            regressions.append((result['benchmark'], result['size'], before, result['median_ms']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark report and alarm queries on synthetic fleets')
+    parser.add_argument('--sizes', default='small,medium', help=f"Comma-separated sizes from: {', '.join(SIZES)}")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='Comma-separated benchmark names to run')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Baseline results JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed median slowdown against the baseline (0.2 = 20%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help='Ignore slowdowns smaller than this many milliseconds')
+    parser.add_argument('--work-dir', help='Keep the generated databases in this directory')
+    args = parser.parse_args()
+
+    sizes = [s.strip() for s in args.sizes.split(',') if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        parser.error(f"unknown size(s): {', '.join(unknown)}")
+
+    only = set(args.only.split(',')) if args.only else None
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else None
+    results = run(sizes, args.repeat, only, work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.min_delta_ms)
+        for name, size, before, after in regressions:
+            print(f"REGRESSION {name} [{size}]: {before:.2f} ms -> {after:.2f} ms")
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
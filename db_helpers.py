@@ -0,0 +1,31 @@
+# Shared query and date-range helpers for the analytics modules
+import sqlite3
+import datetime
+
+def load_rows(db, query, params=()):
+    """Run a query on its own connection and return all rows
+
+    For small result sets; large reports should stream with
+    report_stream.iter_query instead.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        c = conn.cursor()
+        c.execute(query, params)
+        return c.fetchall()
+    finally:
+        conn.close()
+
+def day_range(start_date, end_date):
+    """ISO days from start_date to end_date inclusive
+
+    Only the date part of each bound is used. end_date defaults to today
+    (UTC) and start_date to six days before the end, i.e. the last week.
+    """
+    end = datetime.date.fromisoformat(end_date[:10]) if end_date else datetime.datetime.utcnow().date()
+    start = datetime.date.fromisoformat(start_date[:10]) if start_date else end - datetime.timedelta(days=6)
+    days = []
+    while start <= end:
+        days.append(start.isoformat())
+        start += datetime.timedelta(days=1)
+    return days
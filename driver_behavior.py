@@ -0,0 +1,394 @@
+# Driver behaviour: harsh acceleration/braking, rapid cornering and speeding
+#
+# The same kernels run in two places: evaluate_driving() applies them to
+# each incoming packet, and score_day() applies them to a whole day of
+# gps_data as numpy arrays. Closed days are cached in driver_daily_scores.
+import os
+import sqlite3
+import datetime
+import threading
+import numpy as np
+from flask import request, jsonify
+from report_format import report_json
+from db_helpers import load_rows, day_range
+from enhanced_alarm import enhanced_log_alarm
+from fuel_analytics import haversine_km
+from speed_rules import SPEED_TOLERANCE_KMH
+
+DB = 'gps.db'
+
+# Event thresholds (overridable through the environment)
+HARSH_ACCEL_MS2 = float(os.getenv('HARSH_ACCEL_MS2', 3.0))       # about 0.3 g
+HARSH_BRAKE_MS2 = float(os.getenv('HARSH_BRAKE_MS2', 3.5))
+CORNERING_DEG_S = float(os.getenv('CORNERING_DEG_S', 30))        # heading change rate
+CORNERING_MIN_SPEED_KMH = float(os.getenv('CORNERING_MIN_SPEED_KMH', 20))
+# Deltas over longer gaps say nothing about how the vehicle was driven
+MAX_SAMPLE_GAP_SECONDS = float(os.getenv('DRIVER_MAX_SAMPLE_GAP', 15))
+# Used for speeding when the vehicle has no active speed limit
+DEFAULT_SPEED_LIMIT_KMH = float(os.getenv('DEFAULT_SPEED_LIMIT_KMH', 90))
+
+# Scoring: points lost per event per 100 km and per percent of driving time speeding
+EVENT_PENALTY = float(os.getenv('DRIVER_EVENT_PENALTY', 2.0))
+SPEEDING_PENALTY = float(os.getenv('DRIVER_SPEEDING_PENALTY', 1.0))
+MIN_SCORE_KM = 5.0  # below this a day has no score
+
+# Same movement rule as the trip report
+MOVING_SPEED_KMH = 1.0
+# Shorter steps give no usable bearing
+MIN_BEARING_STEP_M = 5.0
+
+EVENT_TYPES = ('harsh_acceleration', 'harsh_braking', 'rapid_cornering')
+
+# vehicle_id -> (epoch seconds, speed, heading) of the previous packet
+_previous = {}
+_lock = threading.Lock()
+
+def init_driver_behavior_db():
+    """Create the per-day driver score cache"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS driver_daily_scores (
+            vehicle_id INTEGER,
+            day TEXT,
+            driver_name TEXT,
+            distance_km REAL,
+            driving_seconds REAL,
+            speeding_seconds REAL,
+            harsh_acceleration INTEGER,
+            harsh_braking INTEGER,
+            rapid_cornering INTEGER,
+            score REAL,
+            computed_at TEXT,
+            PRIMARY KEY (vehicle_id, day)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_driver_daily_scores_day ON driver_daily_scores (day, driver_name)')
+
+    conn.commit()
+    conn.close()
+
+# --- Kernels: plain arithmetic, so they take floats or numpy arrays alike ---
+
+def acceleration_ms2(speed_before, speed_after, seconds):
+    """Longitudinal acceleration from two speeds in km/h"""
+    return (speed_after - speed_before) / 3.6 / seconds
+
+def heading_change_deg(heading_before, heading_after):
+    """Signed smallest turn between two headings, in [-180, 180)"""
+    return (heading_after - heading_before + 180) % 360 - 180
+
+def bearing_deg(lat1, lon1, lat2, lon2):
+    """Initial great-circle bearing from point 1 to point 2, 0-360"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    y = np.sin(lon2 - lon1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+def classify_events(accel, turn_rate, speed):
+    """{event_type: flag} for acceleration (m/s²), turn rate (deg/s) and speed (km/h)"""
+    return {
+        'harsh_acceleration': accel >= HARSH_ACCEL_MS2,
+        'harsh_braking': accel <= -HARSH_BRAKE_MS2,
+        'rapid_cornering': (abs(turn_rate) >= CORNERING_DEG_S) & (speed >= CORNERING_MIN_SPEED_KMH)
+    }
+
+def driving_score(events, distance_km, driving_seconds, speeding_seconds):
+    """0-100 score from event counts, distance and time spent speeding"""
+    if distance_km < MIN_SCORE_KM:
+        return None
+    per_100km = sum(events.values()) / distance_km * 100
+    speeding_pct = speeding_seconds / driving_seconds * 100 if driving_seconds else 0.0
+    return round(max(0.0, 100 - per_100km * EVENT_PENALTY - speeding_pct * SPEEDING_PENALTY), 1)
+
+# --- Streaming detector ---
+
+def _epoch(value):
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None).timestamp()
+    except (AttributeError, ValueError):
+        return datetime.datetime.utcnow().timestamp()
+
+def evaluate_driving(packet):
+    """Packet handler: raise harsh driving alarms from consecutive packets
+
+    Acceleration comes from the speed delta and cornering from the
+    change of the packet's heading field, both against the vehicle's
+    previous packet. Pairs further apart than MAX_SAMPLE_GAP_SECONDS are
+    skipped. Speeding is left to speed_rules.
+    """
+    vehicle_id = packet.get('vehicle_id')
+    speed = packet.get('speed')
+    if vehicle_id is None or speed is None:
+        return []
+
+    now = _epoch(packet.get('timestamp'))
+    heading = packet.get('heading')
+
+    with _lock:
+        previous = _previous.get(vehicle_id)
+        _previous[vehicle_id] = (now, speed, heading)
+
+    if previous is None:
+        return []
+    seconds = now - previous[0]
+    if not 0 < seconds <= MAX_SAMPLE_GAP_SECONDS:
+        return []
+
+    accel = acceleration_ms2(previous[1], speed, seconds)
+    turn_rate = 0.0
+    if heading is not None and previous[2] is not None:
+        turn_rate = heading_change_deg(previous[2], heading) / seconds
+
+    detected = [event for event, flag in classify_events(accel, turn_rate, speed).items() if flag]
+    for event in detected:
+        if event == 'rapid_cornering':
+            message = f"Rapid cornering at {speed:.0f} km/h ({abs(turn_rate):.0f}°/s)"
+        else:
+            message = f"{event.replace('_', ' ').capitalize()} of {abs(accel):.1f} m/s² at {speed:.0f} km/h"
+        enhanced_log_alarm(vehicle_id, event, message, metadata={
+            'acceleration_ms2': round(accel, 2),
+            'turn_rate_deg_s': round(turn_rate, 1),
+            'speed': speed,
+            'latitude': packet.get('lat'),
+            'longitude': packet.get('lon'),
+            'timestamp': packet.get('timestamp')
+        })
+
+    return detected
+
+# --- Batch scorer ---
+
+def _epoch_seconds(timestamps):
+    """ISO timestamps to float seconds; numpy parses the common formats in one call"""
+    try:
+        return np.array(timestamps, dtype='datetime64[ms]').astype(np.int64) / 1000.0
+    except ValueError:
+        return np.array([_epoch(ts) for ts in timestamps], dtype=float)
+
+def _speed_limit(vehicle_id):
+    rows = load_rows(DB, '''
+        SELECT speed_limit_kmh FROM speed_limits
+        WHERE vehicle_id = ? AND is_active = 1
+        ORDER BY set_at DESC, id DESC LIMIT 1
+    ''', (vehicle_id,))
+    return float(rows[0][0]) if rows else DEFAULT_SPEED_LIMIT_KMH
+
+def score_day(vehicle_id, day, speed_limit=None):
+    """Fix count, event counts, distance, speeding time and score for one vehicle and day
+
+    gps_data has no heading column, so headings are the bearings between
+    consecutive fixes; a turn is measured at each fix between two steps
+    long enough to have a bearing.
+    """
+    day_start = datetime.date.fromisoformat(day)
+    rows = load_rows(DB, '''
+        SELECT timestamp, latitude, longitude, speed FROM gps_data
+        WHERE vehicle_id = ? AND timestamp >= ? AND timestamp < ?
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY timestamp
+    ''', (vehicle_id, day_start.isoformat(), (day_start + datetime.timedelta(days=1)).isoformat()))
+
+    if speed_limit is None:
+        speed_limit = _speed_limit(vehicle_id)
+
+    result = {
+        'date': day,
+        'points': len(rows),
+        'distance_km': 0.0,
+        'driving_seconds': 0.0,
+        'speeding_seconds': 0.0,
+        **{event: 0 for event in EVENT_TYPES}
+    }
+
+    if len(rows) > 1:
+        times = _epoch_seconds([r[0] for r in rows])
+        lat = np.array([r[1] for r in rows], dtype=float)
+        lon = np.array([r[2] for r in rows], dtype=float)
+        speed = np.array([r[3] or 0 for r in rows], dtype=float)
+
+        # Step i runs from fix i to fix i + 1
+        dt = np.diff(times)
+        valid = (dt > 0) & (dt <= MAX_SAMPLE_GAP_SECONDS)
+        safe_dt = np.where(valid, dt, 1.0)
+        steps_km = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        moving = speed[1:] > MOVING_SPEED_KMH
+
+        accel = np.where(valid, acceleration_ms2(speed[:-1], speed[1:], safe_dt), 0.0)
+
+        # Turn at fix i between steps i - 1 and i, over the time between their midpoints
+        has_bearing = valid & (steps_km * 1000 >= MIN_BEARING_STEP_M)
+        bearings = bearing_deg(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        turn = heading_change_deg(bearings[:-1], bearings[1:])
+        turn_seconds = (safe_dt[:-1] + safe_dt[1:]) / 2
+        turn_rate = np.where(has_bearing[:-1] & has_bearing[1:], turn / turn_seconds, 0.0)
+
+        flags = classify_events(accel, np.concatenate((turn_rate, [0.0])), speed[1:])
+        for event, flag in flags.items():
+            result[event] = int(np.count_nonzero(flag & valid))
+
+        driving = valid & moving
+        result['distance_km'] = round(float(steps_km[moving].sum()), 2)
+        result['driving_seconds'] = float(dt[driving].sum())
+        result['speeding_seconds'] = float(dt[driving & (speed[1:] > speed_limit + SPEED_TOLERANCE_KMH)].sum())
+
+    result['score'] = driving_score({event: result[event] for event in EVENT_TYPES}, result['distance_km'],
+                                    result['driving_seconds'], result['speeding_seconds'])
+    return result
+
+SCORE_COLUMNS = ('distance_km', 'driving_seconds', 'speeding_seconds') + EVENT_TYPES
+
+def get_daily_scores(days, vehicle_ids=None):
+    """Per vehicle-day score rows for the given days, scoring any that aren't cached
+
+    Closed days are computed once and stored; today is always recomputed,
+    and so are closed days without any fixes, which late uploads can still
+    fill. Returns dicts with vehicle_id, driver_name and the score_day
+    fields.
+    """
+    vehicles = load_rows(DB, 'SELECT id, driver_name FROM vehicles ORDER BY id', ())
+    if vehicle_ids is not None:
+        vehicles = [v for v in vehicles if v[0] in vehicle_ids]
+    if not vehicles or not days:
+        return []
+
+    today = datetime.datetime.utcnow().date().isoformat()
+    query = f'''
+        SELECT vehicle_id, day, driver_name, {', '.join(SCORE_COLUMNS)}, score
+        FROM driver_daily_scores WHERE day >= ? AND day <= ?
+    '''
+    if vehicle_ids is None:
+        cached_rows = load_rows(DB, query, (days[0], days[-1]))
+    else:
+        # Only the requested vehicles, staying under SQLite's bound-parameter limit
+        ids = [vehicle[0] for vehicle in vehicles]
+        cached_rows = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cached_rows += load_rows(DB, query + f" AND vehicle_id IN ({','.join('?' * len(chunk))})",
+                                     (days[0], days[-1], *chunk))
+    cached = {}
+    for row in cached_rows:
+        cached[(row[0], row[1])] = {'vehicle_id': row[0], 'date': row[1], 'driver_name': row[2],
+                                    **dict(zip(SCORE_COLUMNS, row[3:-1])), 'score': row[-1]}
+
+    results = []
+    fresh = []
+    limits = {}
+    for vehicle_id, driver_name in vehicles:
+        for day in days:
+            row = cached.get((vehicle_id, day))
+            if row is None or day >= today:
+                if vehicle_id not in limits:
+                    limits[vehicle_id] = _speed_limit(vehicle_id)
+                row = {'vehicle_id': vehicle_id, 'driver_name': driver_name,
+                       **score_day(vehicle_id, day, limits[vehicle_id])}
+                if row.pop('points') and day < today:
+                    fresh.append(row)
+            results.append(row)
+
+    if fresh:
+        computed_at = datetime.datetime.utcnow().isoformat()
+        conn = sqlite3.connect(DB)
+        c = conn.cursor()
+        c.executemany(f'''
+            INSERT OR REPLACE INTO driver_daily_scores
+                (vehicle_id, day, driver_name, {', '.join(SCORE_COLUMNS)}, score, computed_at)
+            VALUES ({', '.join('?' * (len(SCORE_COLUMNS) + 5))})
+        ''', [(row['vehicle_id'], row['date'], row['driver_name'], *[row[col] for col in SCORE_COLUMNS],
+               row['score'], computed_at) for row in fresh])
+        conn.commit()
+        conn.close()
+
+    return results
+
+def summarize_scores(rows):
+    """Totals and score over any set of vehicle-day rows"""
+    totals = {col: sum(row[col] for row in rows) for col in SCORE_COLUMNS}
+    totals['distance_km'] = round(totals['distance_km'], 2)
+    totals['score'] = driving_score({event: totals[event] for event in EVENT_TYPES}, totals['distance_km'],
+                                    totals['driving_seconds'], totals['speeding_seconds'])
+    totals['speeding_pct'] = (round(totals['speeding_seconds'] / totals['driving_seconds'] * 100, 1)
+                              if totals['driving_seconds'] else 0.0)
+    return totals
+
+def get_driver_leaderboard(start_date=None, end_date=None, limit=None):
+    """Drivers ranked best first; drivers without a score (too little driving) go last"""
+    by_driver = {}
+    for row in get_daily_scores(day_range(start_date, end_date)):
+        by_driver.setdefault(row['driver_name'] or 'Unassigned', []).append(row)
+
+    leaderboard = [{'driver_name': driver, 'vehicle_ids': sorted({row['vehicle_id'] for row in rows}),
+                    **summarize_scores(rows)} for driver, rows in by_driver.items()]
+    leaderboard.sort(key=lambda d: (d['score'] is None, -(d['score'] or 0), d['driver_name']))
+    for rank, entry in enumerate(leaderboard, 1):
+        entry['rank'] = rank
+    return leaderboard[:limit] if limit else leaderboard
+
+def add_driver_behavior_routes(app, get_vehicle_id_from_imei):
+    """Add driver behaviour routes to Flask app"""
+
+    @app.route('/api/reports/driver_behavior')
+    def driver_behavior_api():
+        imei = request.args.get('imei')
+        driver = request.args.get('driver')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+
+        if not imei and not driver:
+            return jsonify({'error': 'imei or driver parameter is required'}), 400
+
+        try:
+            days = day_range(start_date, end_date)
+        except ValueError:
+            return jsonify({'error': 'Invalid date parameter'}), 400
+
+        if imei:
+            vehicle_id = get_vehicle_id_from_imei(imei)
+            if not vehicle_id:
+                return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+            rows = get_daily_scores(days, {vehicle_id})
+        else:
+            # The driver's current vehicles plus any scored under their name in the range;
+            # rows count only when the driver drove, as on the leaderboard
+            vehicle_ids = {row[0] for row in load_rows(DB, 'SELECT id FROM vehicles WHERE driver_name = ?', (driver,))}
+            if days:
+                vehicle_ids |= {row[0] for row in load_rows(DB, '''
+                    SELECT DISTINCT vehicle_id FROM driver_daily_scores WHERE day >= ? AND day <= ? AND driver_name = ?
+                ''', (days[0], days[-1], driver))}
+            if not vehicle_ids:
+                return jsonify({'error': 'Driver not found'}), 404
+            rows = [row for row in get_daily_scores(days, vehicle_ids) if row['driver_name'] == driver]
+
+        # One entry per day, vehicles of the same driver combined
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row['date'], []).append(row)
+        daily = [{'date': day, **summarize_scores(day_rows)} for day, day_rows in sorted(by_day.items())]
+
+        return report_json({
+            'imei': imei,
+            'driver': driver,
+            'start_date': start_date,
+            'end_date': end_date,
+            'daily': daily,
+            **summarize_scores(rows)
+        })
+
+    @app.route('/api/reports/driver_behavior/leaderboard')
+    def driver_leaderboard_api():
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        limit = request.args.get('limit', type=int)
+
+        try:
+            drivers = get_driver_leaderboard(start_date, end_date, limit)
+        except ValueError:
+            return jsonify({'error': 'Invalid date parameter'}), 400
+
+        return report_json({
+            'start_date': start_date,
+            'end_date': end_date,
+            'drivers': drivers
+        })
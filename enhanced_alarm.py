@@ -1,8 +1,14 @@
 # Enhanced alarm system with severity levels
+import os
+import time
+import atexit
 import sqlite3
 import datetime
 import json
+import threading
 from flask import request, jsonify
+from pagination import parse_page_args, paginate
+from notifications import notify_alarm, cancel_escalation
 
 # Alarm severity levels
 ALARM_SEVERITY = {
@@ -14,20 +20,247 @@ ALARM_SEVERITY = {
 # Alarm type classifications
 ALARM_TYPES = {
     'speed_violation': {'severity': 'warning', 'category': 'safety'},
+    'harsh_acceleration': {'severity': 'warning', 'category': 'safety'},
+    'harsh_braking': {'severity': 'warning', 'category': 'safety'},
+    'rapid_cornering': {'severity': 'warning', 'category': 'safety'},
     'excessive_idling': {'severity': 'info', 'category': 'efficiency'},
     'unauthorized_movement': {'severity': 'critical', 'category': 'security'},
     'geofence_violation': {'severity': 'warning', 'category': 'compliance'},
+    'route_deviation': {'severity': 'warning', 'category': 'compliance'},
+    'unscheduled_stop': {'severity': 'warning', 'category': 'compliance'},
     'maintenance_due': {'severity': 'info', 'category': 'maintenance'},
     'emergency': {'severity': 'critical', 'category': 'emergency'},
     'fuel_waste_prevention': {'severity': 'warning', 'category': 'efficiency'},
     'productivity_tracking': {'severity': 'info', 'category': 'efficiency'},
     'device_offline': {'severity': 'warning', 'category': 'connectivity'},
+    'device_online': {'severity': 'info', 'category': 'connectivity'},
     'low_battery': {'severity': 'warning', 'category': 'maintenance'},
     'tamper_detection': {'severity': 'critical', 'category': 'security'}
 }
 
+# Repeats of the same (vehicle, alarm_type) within this window are counted, not stored
+ALARM_SUPPRESS_SECONDS = float(os.getenv('ALARM_SUPPRESS_SECONDS', 300))
+# Quiet hours as HH:MM-HH:MM local time (e.g. 22:00-06:00); empty disables them
+ALARM_QUIET_HOURS = os.getenv('ALARM_QUIET_HOURS', '')
+# Buffered (non-critical) alarms are written when this many are pending...
+ALARM_BATCH_SIZE = int(os.getenv('ALARM_BATCH_SIZE', 100))
+# ...or at least this often
+ALARM_FLUSH_SECONDS = float(os.getenv('ALARM_FLUSH_SECONDS', 2))
+
+# (vehicle_id, alarm_type) -> {'until', 'record'}: open suppression windows
+_suppression = {}
+# Alarm records waiting for the batch writer
+_alarm_buffer = []
+# Stored alarms whose suppressed count changed since they were written
+_alarm_updates = {}
+_alarm_lock = threading.Lock()
+_alarm_wakeup = threading.Event()
+_alarm_writer = []
+
+def init_alarm_db():
+    """Bring alarm_logs up to date: metadata column and keyset indexes"""
+    conn = sqlite3.connect('gps.db')
+    c = conn.cursor()
+    
+    columns = [row[1] for row in c.execute('PRAGMA table_info(alarm_logs)')]
+    if 'metadata' not in columns:
+        c.execute('ALTER TABLE alarm_logs ADD COLUMN metadata TEXT')
+    
+    c.execute('CREATE INDEX IF NOT EXISTS idx_alarm_logs_timestamp_id ON alarm_logs (timestamp, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_alarm_logs_vehicle_timestamp_id ON alarm_logs (vehicle_id, timestamp, id)')
+    
+    # Per-day counters behind the statistics endpoint; vehicle_id 0 holds fleet totals
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS alarm_counters (
+            day TEXT,
+            vehicle_id INTEGER,
+            severity TEXT,
+            category TEXT,
+            count INTEGER DEFAULT 0,
+            unacknowledged INTEGER DEFAULT 0,
+            PRIMARY KEY (vehicle_id, day, severity, category)
+        )
+    ''')
+    
+    c.execute('SELECT EXISTS (SELECT 1 FROM alarm_counters)')
+    has_counters = c.fetchone()[0]
+    conn.commit()
+    conn.close()
+    
+    if not has_counters:
+        rebuild_alarm_counters()
+
+def rebuild_alarm_counters():
+    """Recompute alarm_counters from the full alarm log (backfill or repair)"""
+    flush_alarms()
+    
+    conn = sqlite3.connect('gps.db', timeout=30)
+    c = conn.cursor()
+    c.execute('DELETE FROM alarm_counters')
+    c.execute('''
+        INSERT INTO alarm_counters (day, vehicle_id, severity, category, count, unacknowledged)
+        SELECT substr(timestamp, 1, 10), vehicle_id, severity, category,
+               COUNT(*), SUM(CASE WHEN acknowledged THEN 0 ELSE 1 END)
+        FROM alarm_logs
+        WHERE timestamp IS NOT NULL AND vehicle_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+    ''')
+    c.execute('''
+        INSERT INTO alarm_counters (day, vehicle_id, severity, category, count, unacknowledged)
+        SELECT day, 0, severity, category, SUM(count), SUM(unacknowledged)
+        FROM alarm_counters
+        GROUP BY day, severity, category
+    ''')
+    conn.commit()
+    conn.close()
+
+def _bump_counters(c, deltas):
+    """Apply {(day, vehicle_id, severity, category): (count, unacknowledged)} deltas
+
+    Each delta is applied to the vehicle's row and to the fleet row
+    (vehicle_id 0), inside the caller's transaction.
+    """
+    totals = {}
+    for (day, vehicle_id, severity, category), (count, unacknowledged) in deltas.items():
+        for key in ((day, vehicle_id, severity, category), (day, 0, severity, category)):
+            current = totals.get(key, (0, 0))
+            totals[key] = (current[0] + count, current[1] + unacknowledged)
+    
+    c.executemany('''
+        INSERT INTO alarm_counters (day, vehicle_id, severity, category, count, unacknowledged)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (vehicle_id, day, severity, category) DO UPDATE SET
+            count = count + excluded.count,
+            unacknowledged = unacknowledged + excluded.unacknowledged
+    ''', [key + value for key, value in totals.items()])
+
+def _parse_quiet_hours(value):
+    """Parse 'HH:MM-HH:MM' into (start, end) time strings, or None"""
+    if not value:
+        return None
+    try:
+        start, end = value.split('-')
+        return (datetime.time.fromisoformat(start.strip()).isoformat(),
+                datetime.time.fromisoformat(end.strip()).isoformat())
+    except ValueError:
+        print(f"Ignoring invalid ALARM_QUIET_HOURS: {value}")
+        return None
+
+QUIET_HOURS = _parse_quiet_hours(ALARM_QUIET_HOURS)
+
+def in_quiet_hours(when=None):
+    """Whether a time falls in the configured quiet hours (wrapping midnight)"""
+    if not QUIET_HOURS:
+        return False
+    now = (when or datetime.datetime.now()).time().isoformat()
+    start, end = QUIET_HOURS
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+def _record_metadata(record):
+    metadata = dict(record['metadata'] or {})
+    if record['suppressed']:
+        metadata['suppressed_count'] = record['suppressed']
+        metadata['last_occurrence'] = record['last_occurrence']
+    if record['quiet_hours']:
+        metadata['quiet_hours'] = True
+    return json.dumps(metadata) if metadata else None
+
+def _write_alarms(records, updates):
+    """Insert new alarm records and refresh suppressed counts in one transaction"""
+    conn = sqlite3.connect('gps.db', timeout=30)
+    try:
+        c = conn.cursor()
+    
+        ids = []
+        for record in records:
+            c.execute('''
+                INSERT INTO alarm_logs (vehicle_id, alarm_type, message, timestamp, severity, category, metadata)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (record['vehicle_id'], record['alarm_type'], record['message'], record['timestamp'],
+                  record['severity'], record['category'], _record_metadata(record)))
+            ids.append(c.lastrowid)
+    
+        if updates:
+            c.executemany('UPDATE alarm_logs SET metadata = ? WHERE id = ?',
+                          [(_record_metadata(record), record['id']) for record in updates])
+    
+        deltas = {}
+        for record in records:
+            key = (record['timestamp'][:10], record['vehicle_id'], record['severity'], record['category'])
+            count, unacknowledged = deltas.get(key, (0, 0))
+            deltas[key] = (count + 1, unacknowledged + 1)
+        if deltas:
+            _bump_counters(c, deltas)
+    
+        conn.commit()
+    finally:
+        conn.close()
+    
+    # Only mark records as stored once the transaction has committed
+    for record, alarm_id in zip(records, ids):
+        record['id'] = alarm_id
+
+def flush_alarms():
+    """Write buffered alarms and pending suppression counts; returns rows inserted"""
+    with _alarm_lock:
+        records = list(_alarm_buffer)
+        _alarm_buffer.clear()
+        updates = [record for record in _alarm_updates.values() if 'id' in record]
+        # A critical alarm still being written has no id yet; keep its count for the next flush.
+        # Records in this batch are inserted with their current count, so they need no update.
+        batch = {id(record) for record in records}
+        pending = {key: record for key, record in _alarm_updates.items()
+                   if 'id' not in record and key not in batch}
+        _alarm_updates.clear()
+        _alarm_updates.update(pending)
+        
+        # Forget windows that have closed so the map doesn't grow without bound
+        now = time.monotonic()
+        for key in [key for key, window in _suppression.items() if window['until'] <= now]:
+            del _suppression[key]
+    
+    if not records and not updates:
+        return 0
+    
+    try:
+        _write_alarms(records, updates)
+    except sqlite3.Error as e:
+        print(f"Error writing alarms: {e}")
+        with _alarm_lock:
+            _alarm_buffer[:0] = records
+            for record in updates:
+                _alarm_updates[id(record)] = record
+        return 0
+    
+    return len(records)
+
+def _alarm_writer_loop():
+    while True:
+        _alarm_wakeup.wait(ALARM_FLUSH_SECONDS)
+        _alarm_wakeup.clear()
+        flush_alarms()
+
+def _ensure_alarm_writer():
+    with _alarm_lock:
+        if not _alarm_writer:
+            writer = threading.Thread(target=_alarm_writer_loop, daemon=True)
+            writer.start()
+            _alarm_writer.append(writer)
+            atexit.register(flush_alarms)
+
 def log_alarm_with_severity(vehicle_id, alarm_type, message, severity=None, metadata=None):
-    """Enhanced alarm logging with severity levels and classification"""
+    """Enhanced alarm logging with severity levels and classification
+
+    Repeats of the same alarm type for a vehicle within
+    ALARM_SUPPRESS_SECONDS are not stored again; they are counted in the
+    first alarm's metadata (suppressed_count, last_occurrence).
+    Critical alarms are written and notified immediately and their id is
+    returned (None when the write failed and the alarm was queued for the
+    batch writer). Other alarms are buffered for the batch writer (returns
+    None), and during quiet hours they are flagged in metadata.
+    """
     # Determine severity if not provided
     if not severity and alarm_type in ALARM_TYPES:
         severity = ALARM_TYPES[alarm_type]['severity']
@@ -35,36 +268,81 @@ def log_alarm_with_severity(vehicle_id, alarm_type, message, severity=None, meta
         severity = 'info'  # default severity
     
     category = ALARM_TYPES.get(alarm_type, {}).get('category', 'general')
-    
+    now = datetime.datetime.now()
+    key = (vehicle_id, alarm_type)
+    
+    # Both lanes need it: suppressed repeats of critical alarms are written by the batch writer too
+    if not _alarm_writer:
+        _ensure_alarm_writer()
+    
+    with _alarm_lock:
+        window = _suppression.get(key)
+        if window and window['until'] > time.monotonic():
+            record = window['record']
+            record['suppressed'] += 1
+            record['last_occurrence'] = now.isoformat()
+            _alarm_updates[id(record)] = record
+            return None
+        
+        record = {
+            'vehicle_id': vehicle_id,
+            'alarm_type': alarm_type,
+            'message': message,
+            'timestamp': now.isoformat(),
+            'severity': severity,
+            'category': category,
+            'metadata': metadata,
+            'suppressed': 0,
+            'last_occurrence': None,
+            'quiet_hours': severity != 'critical' and in_quiet_hours(now)
+        }
+        _suppression[key] = {'until': time.monotonic() + ALARM_SUPPRESS_SECONDS, 'record': record}
+        
+        if severity != 'critical':
+            _alarm_buffer.append(record)
+            if len(_alarm_buffer) >= ALARM_BATCH_SIZE:
+                _alarm_wakeup.set()
+    
+    if severity != 'critical':
+        if not record['quiet_hours']:
+            notify_alarm(_notification(record))
+        return None
+    
+    # Priority lane: critical alarms skip the buffer. The write happens
+    # outside the lock so ingest isn't blocked on SQLite; if it fails the
+    # record goes to the batch writer instead of being lost.
     print(f"[{severity.upper()} ALARM] Vehicle {vehicle_id}: {message}")
-    
+    try:
+        _write_alarms([record], [])
+    except sqlite3.Error as e:
+        print(f"Error writing critical alarm, queued for retry: {e}")
+        with _alarm_lock:
+            _alarm_buffer.append(record)
+        _alarm_wakeup.set()
+    trigger_critical_notification(vehicle_id, alarm_type, message, metadata, record.get('id'))
+    return record.get('id')
+
+def _notification(record):
+    return {key: record.get(key) for key in
+            ('id', 'vehicle_id', 'alarm_type', 'message', 'timestamp', 'severity', 'category', 'metadata')}
+
+def _alarm_acknowledged(alarm_id):
     conn = sqlite3.connect('gps.db')
     c = conn.cursor()
-    
-    # Store metadata as JSON if provided
-    metadata_json = json.dumps(metadata) if metadata else None
-    
-    c.execute('''
-        INSERT INTO alarm_logs (vehicle_id, alarm_type, message, timestamp, severity, category, metadata)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (vehicle_id, alarm_type, message, datetime.datetime.now().isoformat(), severity, category, metadata_json))
-    
-    conn.commit()
+    c.execute('SELECT acknowledged FROM alarm_logs WHERE id = ?', (alarm_id,))
+    row = c.fetchone()
     conn.close()
-    
-    # Trigger immediate notifications for critical alarms
-    if severity == 'critical':
-        trigger_critical_notification(vehicle_id, alarm_type, message, metadata)
+    return bool(row and row[0])
 
-def trigger_critical_notification(vehicle_id, alarm_type, message, metadata=None):
-    """Trigger immediate notifications for critical alarms"""
-    # Here you can integrate with:
-    # - SMS notifications
-    # - Email alerts
-    # - Push notifications
-    # - Webhook calls
-    
+def trigger_critical_notification(vehicle_id, alarm_type, message, metadata=None, alarm_id=None):
+    """Trigger immediate notifications for critical alarms
+
+    Delivery (webhook, SMS gateway, email) happens on the notification
+    workers, so this never blocks on network I/O. Alarms with an id are
+    escalated if nobody acknowledges them in time.
+    """
     notification_data = {
+        'id': alarm_id,
         'vehicle_id': vehicle_id,
         'alarm_type': alarm_type,
         'message': message,
@@ -74,14 +352,13 @@ def trigger_critical_notification(vehicle_id, alarm_type, message, metadata=None
     }
     
     print(f"[CRITICAL NOTIFICATION] {json.dumps(notification_data, indent=2)}")
-    
-    # TODO: Add actual notification integrations:
-    # - send_sms_notification(vehicle_id, message)
-    # - send_email_alert(notification_data)
-    # - call_webhook(notification_data)
+    notify_alarm(notification_data, _alarm_acknowledged)
+
+def get_vehicle_alarms(vehicle_id, severity=None, category=None, limit=100, before=None):
+    """Get alarms for a specific vehicle with filtering options
 
-def get_vehicle_alarms(vehicle_id, severity=None, category=None, limit=100):
-    """Get alarms for a specific vehicle with filtering options"""
+    `before` is a (timestamp, id) keyset position from a previous page.
+    """
     conn = sqlite3.connect('gps.db')
     c = conn.cursor()
     
@@ -101,7 +378,11 @@ def get_vehicle_alarms(vehicle_id, severity=None, category=None, limit=100):
         query += ' AND category = ?'
         params.append(category)
     
-    query += ' ORDER BY timestamp DESC LIMIT ?'
+    if before:
+        query += ' AND (timestamp, id) < (?, ?)'
+        params.extend(before)
+    
+    query += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
     params.append(limit)
     
     c.execute(query, params)
@@ -127,8 +408,11 @@ def get_vehicle_alarms(vehicle_id, severity=None, category=None, limit=100):
     
     return alarms
 
-def get_all_alarms(severity=None, category=None, acknowledged=None, limit=100):
-    """Get all alarms with filtering options"""
+def get_all_alarms(severity=None, category=None, acknowledged=None, limit=100, before=None):
+    """Get all alarms with filtering options
+
+    `before` is a (timestamp, id) keyset position from a previous page.
+    """
     conn = sqlite3.connect('gps.db')
     c = conn.cursor()
     
@@ -154,7 +438,11 @@ def get_all_alarms(severity=None, category=None, acknowledged=None, limit=100):
         query += ' AND a.acknowledged = ?'
         params.append(1 if acknowledged else 0)
     
-    query += ' ORDER BY a.timestamp DESC LIMIT ?'
+    if before:
+        query += ' AND (a.timestamp, a.id) < (?, ?)'
+        params.extend(before)
+    
+    query += ' ORDER BY a.timestamp DESC, a.id DESC LIMIT ?'
     params.append(limit)
     
     c.execute(query, params)
@@ -184,9 +472,15 @@ def get_all_alarms(severity=None, category=None, acknowledged=None, limit=100):
 
 def acknowledge_alarm(alarm_id, acknowledged_by):
     """Acknowledge an alarm"""
-    conn = sqlite3.connect('gps.db')
+    conn = sqlite3.connect('gps.db', timeout=30)
     c = conn.cursor()
     
+    c.execute('''
+        SELECT substr(timestamp, 1, 10), vehicle_id, severity, category, acknowledged
+        FROM alarm_logs WHERE id = ?
+    ''', (alarm_id,))
+    row = c.fetchone()
+    
     c.execute('''
         UPDATE alarm_logs 
         SET acknowledged = 1, acknowledged_by = ?, acknowledged_at = ?
@@ -194,90 +488,59 @@ def acknowledge_alarm(alarm_id, acknowledged_by):
     ''', (acknowledged_by, datetime.datetime.now().isoformat(), alarm_id))
     
     success = c.rowcount > 0
+    
+    # Only the first acknowledgement moves the unacknowledged gauge
+    if success and not row[4] and row[0] and row[1] is not None:
+        _bump_counters(c, {row[:4]: (0, -1)})
+    
     conn.commit()
     conn.close()
     
+    if success:
+        cancel_escalation(alarm_id)
+    
     return success
 
 def get_alarm_statistics(vehicle_id=None, days=7):
-    """Get alarm statistics for dashboard"""
+    """Get alarm statistics for dashboard
+
+    Sums the per-day alarm_counters rows for the last `days` calendar days
+    (today included) instead of scanning alarm_logs.
+    """
     conn = sqlite3.connect('gps.db')
     c = conn.cursor()
     
-    since_date = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat()
-    
-    if vehicle_id:
-        query = '''
-            SELECT severity, category, COUNT(*) as count
-            FROM alarm_logs 
-            WHERE vehicle_id = ? AND timestamp >= ?
-            GROUP BY severity, category
-        '''
-        c.execute(query, (vehicle_id, since_date))
-    else:
-        query = '''
-            SELECT severity, category, COUNT(*) as count
-            FROM alarm_logs 
-            WHERE timestamp >= ?
-            GROUP BY severity, category
-        '''
-        c.execute(query, (since_date,))
+    since_day = (datetime.date.today() - datetime.timedelta(days=max(days, 1) - 1)).isoformat()
+    
+    c.execute('''
+        SELECT severity, category, SUM(count), SUM(unacknowledged)
+        FROM alarm_counters
+        WHERE vehicle_id = ? AND day >= ?
+        GROUP BY severity, category
+    ''', (vehicle_id or 0, since_day))
     
     rows = c.fetchall()
     conn.close()
     
     stats = {
         'total_alarms': 0,
+        'unacknowledged': 0,
         'by_severity': {'critical': 0, 'warning': 0, 'info': 0},
         'by_category': {},
         'period_days': days
     }
     
-    for severity, category, count in rows:
+    for severity, category, count, unacknowledged in rows:
         stats['total_alarms'] += count
+        stats['unacknowledged'] += unacknowledged
         stats['by_severity'][severity] = stats['by_severity'].get(severity, 0) + count
         stats['by_category'][category] = stats['by_category'].get(category, 0) + count
     
     return stats
 
-def check_device_offline_alarms():
-    """Check for devices that haven't reported data recently"""
-    conn = sqlite3.connect('gps.db')
-    c = conn.cursor()
-    
-    # Check devices with no data in last 30 minutes
-    cutoff_time = (datetime.datetime.now() - datetime.timedelta(minutes=30)).isoformat()
-    
-    c.execute('''
-        SELECT DISTINCT v.id, v.license_plate, v.imei
-        FROM vehicles v
-        LEFT JOIN gps_data g ON v.id = g.vehicle_id AND g.timestamp >= ?
-        WHERE g.vehicle_id IS NULL
-    ''', (cutoff_time,))
-    
-    offline_vehicles = c.fetchall()
-    conn.close()
-    
-    for vehicle_id, license_plate, imei in offline_vehicles:
-        # Check if we already logged this alarm recently (avoid spam)
-        recent_offline_alarm = get_vehicle_alarms(
-            vehicle_id, 
-            alarm_type='device_offline', 
-            limit=1
-        )
-        
-        if not recent_offline_alarm:
-            log_alarm_with_severity(
-                vehicle_id, 
-                'device_offline', 
-                f'Vehicle {license_plate} ({imei}) has not reported data for over 30 minutes',
-                severity='warning',
-                metadata={'last_seen': cutoff_time}
-            )
-
 def enhanced_log_alarm(vehicle_id, alarm_type, message, severity=None, metadata=None):
     """Wrapper function to maintain compatibility with existing code"""
-    log_alarm_with_severity(vehicle_id, alarm_type, message, severity, metadata)
+    return log_alarm_with_severity(vehicle_id, alarm_type, message, severity, metadata)
 
 # Flask API endpoints for alarm management
 def add_alarm_routes(app):
@@ -291,13 +554,19 @@ def add_alarm_routes(app):
         category = request.args.get('category')
         acknowledged = request.args.get('acknowledged')
         
+        try:
+            limit, before = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         if vehicle_id:
-            alarms = get_vehicle_alarms(vehicle_id, severity, category)
+            alarms = get_vehicle_alarms(vehicle_id, severity, category, limit + 1, before)
         else:
             acknowledged_bool = None if acknowledged is None else acknowledged.lower() == 'true'
-            alarms = get_all_alarms(severity, category, acknowledged_bool)
+            alarms = get_all_alarms(severity, category, acknowledged_bool, limit + 1, before)
         
-        return jsonify({'alarms': alarms, 'total': len(alarms)})
+        alarms, next_cursor = paginate(alarms, limit)
+        return jsonify({'alarms': alarms, 'total': len(alarms), 'next_cursor': next_cursor})
     
     @app.route('/api/alarms/<int:alarm_id>/acknowledge', methods=['POST'])
     def acknowledge_alarm_api(alarm_id):
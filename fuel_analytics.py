@@ -0,0 +1,306 @@
+# Fuel analytics: fill/drain detection from the level series and L/100km
+import os
+import json
+import sqlite3
+import datetime
+import numpy as np
+from flask import request, jsonify
+from report_format import report_json
+from db_helpers import load_rows, day_range
+
+DB = 'gps.db'
+
+# Detection settings (overridable through the environment)
+SMOOTH_WINDOW = int(os.getenv('FUEL_SMOOTH_WINDOW', 5))           # samples in the rolling median
+NOISE_LITERS = float(os.getenv('FUEL_NOISE_LITERS', 0.2))         # level changes below this are noise
+FILL_THRESHOLD_LITERS = float(os.getenv('FUEL_FILL_THRESHOLD', 5.0))
+DRAIN_THRESHOLD_LITERS = float(os.getenv('FUEL_DRAIN_THRESHOLD', 5.0))
+MAX_BURN_RATE_LPH = float(os.getenv('FUEL_MAX_BURN_RATE', 40.0))  # faster drops are drains, not driving
+
+# Same movement rules as the trip report
+MOVING_SPEED_KMH = 1.0
+MIN_TRIP_MINUTES = 5
+MIN_DISTANCE_KM = 0.5  # below this L/100km is meaningless
+
+def init_fuel_analytics_db():
+    """Create the per-day analytics cache"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS fuel_daily_cache (
+            vehicle_id INTEGER,
+            day TEXT,
+            result TEXT,
+            computed_at TEXT,
+            PRIMARY KEY (vehicle_id, day)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fuel_data_vehicle_timestamp ON fuel_data (vehicle_id, timestamp)')
+
+    conn.commit()
+    conn.close()
+
+def _epoch_seconds(timestamps):
+    """Convert ISO timestamp strings to float seconds (naive, as stored)"""
+    return np.array([
+        datetime.datetime.fromisoformat(ts.replace('Z', '+00:00')).replace(tzinfo=None).timestamp()
+        for ts in timestamps
+    ], dtype=float)
+
+def _iso(seconds):
+    return datetime.datetime.fromtimestamp(float(seconds)).isoformat()
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Vectorized great-circle distance in kilometers"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * np.arcsin(np.sqrt(a))
+
+def smooth_levels(levels, window=SMOOTH_WINDOW):
+    """Rolling median that removes sloshing spikes but keeps real steps"""
+    if window < 2 or len(levels) < window:
+        return levels.copy()
+    half = window // 2
+    padded = np.pad(levels, (half, window - 1 - half), mode='edge')
+    return np.median(np.lib.stride_tricks.sliding_window_view(padded, window), axis=1)
+
+def _runs(mask):
+    """Start/end (inclusive) indexes of consecutive True runs in a boolean array"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+def detect_fuel_events(times, levels):
+    """Derive fill and drain events from a raw fuel level series
+
+    Levels are median-smoothed, then consecutive rising or falling steps
+    are grouped into runs. A rising run adding at least the fill threshold
+    is a fill. A falling run losing at least the drain threshold faster
+    than any plausible burn rate is a drain (siphoning, leaks).
+    """
+    if len(levels) < 2:
+        return [], []
+
+    smoothed = smooth_levels(levels)
+    delta = np.diff(smoothed)
+    # Prefix sums give every run's total change and duration in one pass
+    change = np.concatenate(([0.0], np.cumsum(delta)))
+    elapsed = np.concatenate(([0.0], np.cumsum(np.maximum(np.diff(times), 1.0))))
+
+    def event(s, e, amount):
+        return {
+            'start_time': _iso(times[s]),
+            'end_time': _iso(times[e + 1]),
+            'liters': round(float(amount), 2),
+            'level_before': round(float(smoothed[s]), 2),
+            'level_after': round(float(smoothed[e + 1]), 2)
+        }
+
+    starts, ends = _runs(delta > NOISE_LITERS)
+    amounts = change[ends + 1] - change[starts]
+    fills = [event(s, e, amount) for s, e, amount in zip(starts, ends, amounts)
+             if amount >= FILL_THRESHOLD_LITERS]
+
+    starts, ends = _runs(delta < -NOISE_LITERS)
+    amounts = change[starts] - change[ends + 1]
+    rates = amounts / ((elapsed[ends + 1] - elapsed[starts]) / 3600)
+    drains = [event(s, e, amount) for s, e, amount, rate in zip(starts, ends, amounts, rates)
+              if amount >= DRAIN_THRESHOLD_LITERS and rate > MAX_BURN_RATE_LPH]
+
+    return fills, drains
+
+def _events_between(events, start, end):
+    total = 0.0
+    for event in events:
+        if start <= event['start_time'] < end:
+            total += event['liters']
+    return total
+
+def _consumption(times, smoothed, fills, drains, start, end):
+    """Fuel burned between two instants: level drop plus fills minus drains"""
+    if len(times) == 0 or end <= times[0] or start >= times[-1]:
+        return None
+    level_start, level_end = np.interp([start, end], times, smoothed)
+    start_iso, end_iso = _iso(start), _iso(end)
+    return float(level_start - level_end + _events_between(fills, start_iso, end_iso)
+                 - _events_between(drains, start_iso, end_iso))
+
+def _per_100km(liters, km):
+    if liters is None or km < MIN_DISTANCE_KM:
+        return None
+    return round(liters / km * 100, 2)
+
+def analyze_day(vehicle_id, day):
+    """Fuel events, distance and consumption for one vehicle and day"""
+    day_start = datetime.date.fromisoformat(day)
+    window = (vehicle_id, day_start.isoformat(), (day_start + datetime.timedelta(days=1)).isoformat())
+
+    fuel_rows = load_rows(DB, '''
+        SELECT timestamp, fuel_level FROM fuel_data
+        WHERE vehicle_id = ? AND timestamp >= ? AND timestamp < ? AND fuel_level IS NOT NULL
+        ORDER BY timestamp
+    ''', window)
+    gps_rows = load_rows(DB, '''
+        SELECT timestamp, latitude, longitude, speed FROM gps_data
+        WHERE vehicle_id = ? AND timestamp >= ? AND timestamp < ?
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY timestamp
+    ''', window)
+
+    times = _epoch_seconds([r[0] for r in fuel_rows])
+    levels = np.array([r[1] for r in fuel_rows], dtype=float)
+    smoothed = smooth_levels(levels)
+    fills, drains = detect_fuel_events(times, levels)
+
+    # Distance only accumulates between consecutive moving points
+    trips = []
+    distance_km = 0.0
+    if len(gps_rows) > 1:
+        gps_times = _epoch_seconds([r[0] for r in gps_rows])
+        lat = np.array([r[1] for r in gps_rows], dtype=float)
+        lon = np.array([r[2] for r in gps_rows], dtype=float)
+        speed = np.array([r[3] or 0 for r in gps_rows], dtype=float)
+        moving = speed > MOVING_SPEED_KMH
+        steps = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        distance_km = float(steps[moving[1:]].sum())
+
+        # A trip runs from the first moving point to the first stopped one
+        starts, ends = _runs(moving)
+        for s, e in zip(starts, ends):
+            stop = min(e + 1, len(gps_rows) - 1)
+            if (gps_times[stop] - gps_times[s]) / 60 < MIN_TRIP_MINUTES:
+                continue
+            # The same steps the day total counts: those ending on a moving point,
+            # including the one into the trip's first moving point
+            trip_km = float(steps[max(s - 1, 0):e].sum())
+            liters = _consumption(times, smoothed, fills, drains, gps_times[s], gps_times[stop])
+            trips.append({
+                'start_time': gps_rows[s][0],
+                'end_time': gps_rows[stop][0],
+                'distance_km': round(trip_km, 2),
+                'fuel_used_liters': round(liters, 2) if liters is not None else None,
+                'liters_per_100km': _per_100km(liters, trip_km)
+            })
+
+    consumption = None
+    if len(times) > 1:
+        consumption = _consumption(times, smoothed, fills, drains, times[0], times[-1])
+
+    return {
+        'date': day,
+        'readings': len(fuel_rows),
+        'gps_points': len(gps_rows),
+        'fill_events': fills,
+        'drain_events': drains,
+        'total_filled': round(sum(e['liters'] for e in fills), 2),
+        'total_drained': round(sum(e['liters'] for e in drains), 2),
+        'fuel_used_liters': round(consumption, 2) if consumption is not None else None,
+        'distance_km': round(distance_km, 2),
+        'liters_per_100km': _per_100km(consumption, distance_km),
+        'trips': trips
+    }
+
+def get_day_analysis(vehicle_id, day):
+    """Per-day analysis, cached once the day is closed
+
+    Closed days without fuel readings or GPS points aren't cached, so late
+    uploads are picked up.
+    """
+    closed = datetime.date.fromisoformat(day) < datetime.datetime.utcnow().date()
+
+    if closed:
+        rows = load_rows(DB, 'SELECT result FROM fuel_daily_cache WHERE vehicle_id = ? AND day = ?',
+                          (vehicle_id, day))
+        if rows:
+            return json.loads(rows[0][0])
+
+    result = analyze_day(vehicle_id, day)
+
+    if closed and (result['readings'] or result['gps_points']):
+        conn = sqlite3.connect(DB)
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR REPLACE INTO fuel_daily_cache (vehicle_id, day, result, computed_at)
+            VALUES (?, ?, ?, ?)
+        ''', (vehicle_id, day, json.dumps(result), datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+        conn.close()
+
+    return result
+
+def summarize_days(days):
+    """Totals over a list of per-day analyses"""
+    measured = [d for d in days if d['fuel_used_liters'] is not None]
+    fuel_used = sum(d['fuel_used_liters'] for d in measured) if measured else None
+    distance = sum(d['distance_km'] for d in days)
+    # Only days with fuel readings count toward consumption per distance
+    measured_distance = sum(d['distance_km'] for d in measured)
+    return {
+        'total_filled': round(sum(d['total_filled'] for d in days), 2),
+        'total_drained': round(sum(d['total_drained'] for d in days), 2),
+        'fill_count': sum(len(d['fill_events']) for d in days),
+        'drain_count': sum(len(d['drain_events']) for d in days),
+        'fuel_used_liters': round(fuel_used, 2) if fuel_used is not None else None,
+        'distance_km': round(distance, 2),
+        'liters_per_100km': _per_100km(fuel_used, measured_distance)
+    }
+
+def get_fuel_analytics(vehicle_id, start_date=None, end_date=None):
+    days = [get_day_analysis(vehicle_id, day) for day in day_range(start_date, end_date)]
+    return days, summarize_days(days)
+
+def get_fleet_fuel_summary(start_date=None, end_date=None):
+    """Per-vehicle fuel totals for the whole fleet"""
+    vehicles = load_rows(DB, 'SELECT id, imei, license_plate FROM vehicles ORDER BY id', ())
+    day_list = day_range(start_date, end_date)
+    summary = []
+    for vehicle_id, imei, license_plate in vehicles:
+        days = [get_day_analysis(vehicle_id, day) for day in day_list]
+        summary.append({'vehicle_id': vehicle_id, 'imei': imei, 'license_plate': license_plate,
+                        **summarize_days(days)})
+    return summary
+
+def add_fuel_analytics_routes(app, get_vehicle_id_from_imei):
+    """Add fuel analytics routes to Flask app"""
+
+    @app.route('/api/reports/fuel/analytics')
+    def fuel_analytics_api():
+        imei = request.args.get('imei')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+
+        if not imei:
+            return jsonify({'error': 'IMEI parameter is required'}), 400
+
+        vehicle_id = get_vehicle_id_from_imei(imei)
+        if not vehicle_id:
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        try:
+            days, totals = get_fuel_analytics(vehicle_id, start_date, end_date)
+        except ValueError:
+            return jsonify({'error': 'Invalid date parameter'}), 400
+
+        return report_json({
+            'imei': imei,
+            'start_date': start_date,
+            'end_date': end_date,
+            'daily': days,
+            **totals
+        })
+
+    @app.route('/api/reports/fuel/fleet')
+    def fleet_fuel_api():
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+
+        try:
+            vehicles = get_fleet_fuel_summary(start_date, end_date)
+        except ValueError:
+            return jsonify({'error': 'Invalid date parameter'}), 400
+
+        return report_json({
+            'start_date': start_date,
+            'end_date': end_date,
+            'vehicles': vehicles
+        })
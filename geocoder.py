@@ -0,0 +1,161 @@
+# Offline reverse geocoding from a local gazetteer file
+#
+# Names are loaded once from GAZETTEER_PATH into numpy arrays sorted by
+# grid cell, so the names of a run of cells in one grid row form a
+# single slice. A lookup searches growing squares of cells around the
+# point until the nearest name found is closer than anything outside the
+# square. Results are cached per coordinate rounded to about 10 m.
+import os
+import csv
+import math
+import functools
+import numpy as np
+
+# GeoNames dump (tab-separated, e.g. ET.txt or cities500.txt) or a CSV with
+# name, lat and lon columns (e.g. an OSM extract of streets and places)
+GAZETTEER_PATH = os.getenv('GAZETTEER_PATH')
+# GeoNames feature classes kept: populated places, spots/buildings, roads, areas
+GEONAMES_FEATURE_CLASSES = set(os.getenv('GEONAMES_FEATURE_CLASSES', 'P,S,R,L').split(','))
+# Farther than this from every name, a point gets no name
+GEOCODER_MAX_DISTANCE_M = float(os.getenv('GEOCODER_MAX_DISTANCE_M', 2000))
+GEOCODER_CACHE_SIZE = int(os.getenv('GEOCODER_CACHE_SIZE', 100000))
+GEOCODER_CELL_DEG = 0.01
+CACHE_DECIMALS = 4
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEG = math.radians(1) * EARTH_RADIUS_M
+
+# cell row -> (sorted cell columns, slice starts, slice ends), plus the name arrays
+_index = None
+
+def _coordinates(lat, lon):
+    """(lat, lon) as floats, or None when they aren't a valid position"""
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None  # Also rejects nan
+    return lat, lon
+
+# Malformed rows are skipped and counted in skipped[0], so one bad line
+# in a large dump doesn't keep the app from starting
+def _read_geonames(path, skipped):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for fields in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(fields) > 6 and fields[6] in GEONAMES_FEATURE_CLASSES:
+                position = _coordinates(fields[4], fields[5])
+                if position is None:
+                    skipped[0] += 1
+                    continue
+                yield (fields[1],) + position
+
+def _read_csv(path, skipped):
+    with open(path, encoding='utf-8', errors='replace', newline='') as f:
+        for row in csv.DictReader(f):
+            lat = row.get('lat') or row.get('latitude')
+            lon = row.get('lon') or row.get('lng') or row.get('longitude')
+            if not (row.get('name') and lat and lon):
+                continue
+            position = _coordinates(lat, lon)
+            if position is None:
+                skipped[0] += 1
+                continue
+            yield (row['name'],) + position
+
+def build_index(entries):
+    """Grid index over (name, lat, lon) entries"""
+    names, lats, lons = [], [], []
+    for name, lat, lon in entries:
+        names.append(name)
+        lats.append(lat)
+        lons.append(lon)
+    lat = np.array(lats, dtype=float)
+    lon = np.array(lons, dtype=float)
+    cell_y = np.floor(lat / GEOCODER_CELL_DEG).astype(np.int64)
+    cell_x = np.floor(lon / GEOCODER_CELL_DEG).astype(np.int64)
+
+    order = np.lexsort((cell_x, cell_y))
+    lat, lon, cell_y, cell_x = lat[order], lon[order], cell_y[order], cell_x[order]
+    names = np.array(names, dtype=object)[order]
+
+    # Slice boundaries of each non-empty cell, grouped by row
+    rows = {}
+    if len(order):
+        starts = np.flatnonzero(np.concatenate(([True], (cell_y[1:] != cell_y[:-1]) | (cell_x[1:] != cell_x[:-1]))))
+        ends = np.append(starts[1:], len(order))
+        for y in np.unique(cell_y[starts]):
+            in_row = cell_y[starts] == y
+            rows[int(y)] = (cell_x[starts][in_row], starts[in_row], ends[in_row])
+
+    return {'rows': rows, 'lat': lat, 'lon': lon, 'names': names}
+
+def load_gazetteer(path=GAZETTEER_PATH):
+    """Load the gazetteer into memory; returns the number of names (0 when not configured)"""
+    global _index
+    if not path:
+        return 0
+    if not os.path.exists(path):
+        print(f"Warning: gazetteer file {path} not found, reports won't be geocoded")
+        return 0
+
+    reader = _read_csv if path.lower().endswith('.csv') else _read_geonames
+    skipped = [0]
+    try:
+        index = build_index(reader(path, skipped))
+    except (OSError, csv.Error) as e:
+        print(f"Warning: could not read gazetteer {path} ({e}), reports won't be geocoded")
+        return 0
+    _index = index
+    _lookup.cache_clear()
+    print(f"Loaded {len(_index['names'])} gazetteer names from {path}"
+          + (f" ({skipped[0]} malformed rows skipped)" if skipped[0] else ''))
+    return len(_index['names'])
+
+def _nearest(index, lat, lon):
+    """(distance in m, name) of the nearest entry within GEOCODER_MAX_DISTANCE_M"""
+    cy = math.floor(lat / GEOCODER_CELL_DEG)
+    cx = math.floor(lon / GEOCODER_CELL_DEG)
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    # Anything outside the square of radius r cells is at least this far per ring
+    ring_m = GEOCODER_CELL_DEG * METERS_PER_DEG * cos_lat
+    max_ring = int(math.ceil(GEOCODER_MAX_DISTANCE_M / ring_m)) + 1
+
+    best = None
+    for ring in range(max_ring + 1):
+        for y in range(cy - ring, cy + ring + 1):
+            row = index['rows'].get(y)
+            if row is None:
+                continue
+            # Only the cells not already searched in smaller squares
+            edge = y in (cy - ring, cy + ring)
+            spans = [(cx - ring, cx + ring)] if edge else [(cx - ring, cx - ring), (cx + ring, cx + ring)]
+            for first, last in spans:
+                i = np.searchsorted(row[0], first)
+                j = np.searchsorted(row[0], last, side='right')
+                if i == j:
+                    continue
+                start, end = row[1][i], row[2][j - 1]
+                dy = index['lat'][start:end] - lat
+                dx = (index['lon'][start:end] - lon) * cos_lat
+                dist = np.hypot(dx, dy) * METERS_PER_DEG
+                k = int(np.argmin(dist))
+                if best is None or dist[k] < best[0]:
+                    best = (float(dist[k]), index['names'][start + k])
+        if best is not None and best[0] <= ring * ring_m:
+            break
+
+    if best is None or best[0] > GEOCODER_MAX_DISTANCE_M:
+        return None
+    return best
+
+@functools.lru_cache(maxsize=GEOCODER_CACHE_SIZE)
+def _lookup(lat, lon):
+    found = _nearest(_index, lat, lon)
+    return found[1] if found else None
+
+def reverse_geocode(lat, lon):
+    """Name of the nearest gazetteer entry, or None (no gazetteer, no fix or nothing near)"""
+    if _index is None or lat is None or lon is None:
+        return None
+    return _lookup(round(lat, CACHE_DECIMALS), round(lon, CACHE_DECIMALS))
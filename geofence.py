@@ -0,0 +1,432 @@
+# Geofence zones and entry/exit detection at ingest
+import os
+import json
+import math
+import sqlite3
+import datetime
+import threading
+from flask import request, jsonify
+from enhanced_alarm import enhanced_log_alarm
+
+DB = 'gps.db'
+
+ZONE_TYPES = ('circle', 'rectangle', 'polygon')
+ALARM_ON = ('entry', 'exit', 'both')
+
+# Grid cell size in degrees (0.01° is about 1.1 km)
+GEOFENCE_CELL_DEG = float(os.getenv('GEOFENCE_CELL_DEG', 0.01))
+# Zones covering more grid cells than this are kept in a list checked for every point
+GEOFENCE_MAX_CELLS = int(os.getenv('GEOFENCE_MAX_CELLS', 400))
+# Offset applied to packet timestamps (UTC) when evaluating zone schedules
+GEOFENCE_UTC_OFFSET_HOURS = float(os.getenv('GEOFENCE_UTC_OFFSET_HOURS', 0))
+
+# Spatial index; replaced with a new dict (never mutated) whenever zones change
+_index = {'zones': {}, 'grid': {}, 'large': []}
+
+# vehicle_id -> set of zone ids the vehicle is currently inside
+_vehicle_zones = {}
+
+_lock = threading.Lock()
+
+def init_geofence_db():
+    """Create the geofences table"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS geofences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            zone_type TEXT CHECK(zone_type IN ('circle', 'rectangle', 'polygon')),
+            geometry TEXT NOT NULL,
+            vehicle_id INTEGER,
+            alarm_on TEXT DEFAULT 'both' CHECK(alarm_on IN ('entry', 'exit', 'both')),
+            schedule TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (vehicle_id) REFERENCES vehicles (id)
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+def _bbox(zone_type, geometry):
+    """Bounding box (min_lat, min_lon, max_lat, max_lon) of a zone"""
+    if zone_type == 'circle':
+        dlat = geometry['radius_m'] / 110540.0
+        dlon = geometry['radius_m'] / (111320.0 * max(math.cos(math.radians(geometry['lat'])), 1e-6))
+        return (geometry['lat'] - dlat, geometry['lon'] - dlon, geometry['lat'] + dlat, geometry['lon'] + dlon)
+    if zone_type == 'rectangle':
+        return (geometry['min_lat'], geometry['min_lon'], geometry['max_lat'], geometry['max_lon'])
+    lats = [p[0] for p in geometry['points']]
+    lons = [p[1] for p in geometry['points']]
+    return (min(lats), min(lons), max(lats), max(lons))
+
+def validate_geometry(zone_type, geometry):
+    """Normalize a zone geometry; raises ValueError when it is malformed"""
+    if zone_type not in ZONE_TYPES:
+        raise ValueError(f"zone_type must be one of {', '.join(ZONE_TYPES)}")
+    if not isinstance(geometry, dict):
+        raise ValueError('geometry must be an object')
+
+    try:
+        if zone_type == 'circle':
+            geometry = {'lat': float(geometry['lat']), 'lon': float(geometry['lon']),
+                        'radius_m': float(geometry['radius_m'])}
+            if geometry['radius_m'] <= 0:
+                raise ValueError('radius_m must be positive')
+        elif zone_type == 'rectangle':
+            geometry = {key: float(geometry[key]) for key in ('min_lat', 'min_lon', 'max_lat', 'max_lon')}
+            if geometry['min_lat'] >= geometry['max_lat'] or geometry['min_lon'] >= geometry['max_lon']:
+                raise ValueError('rectangle min values must be below max values')
+        else:
+            geometry = {'points': [[float(lat), float(lon)] for lat, lon in geometry['points']]}
+            if len(geometry['points']) < 3:
+                raise ValueError('polygon needs at least 3 points')
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Invalid {zone_type} geometry: {e}')
+
+    return geometry
+
+def validate_schedule(schedule):
+    """Normalize {days, start, end}; None means the zone is always active"""
+    if not schedule:
+        return None
+    try:
+        days = [int(day) for day in schedule.get('days', range(7))]
+        start = datetime.time.fromisoformat(schedule.get('start', '00:00'))
+        end = datetime.time.fromisoformat(schedule.get('end', '23:59:59'))
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid schedule: {e}')
+    if any(day < 0 or day > 6 for day in days):
+        raise ValueError('schedule days must be 0 (Monday) to 6 (Sunday)')
+    return {'days': days, 'start': start.isoformat(), 'end': end.isoformat()}
+
+def _schedule_active(schedule, when):
+    """Whether a schedule covers a time; windows with end < start wrap midnight"""
+    if schedule is None:
+        return True
+    local = when + datetime.timedelta(hours=GEOFENCE_UTC_OFFSET_HOURS)
+    now = local.time().isoformat()
+    if schedule['start'] <= schedule['end']:
+        return local.weekday() in schedule['days'] and schedule['start'] <= now <= schedule['end']
+    if now >= schedule['start']:
+        return local.weekday() in schedule['days']
+    # After midnight, the window belongs to the previous day's schedule
+    return now <= schedule['end'] and (local.weekday() - 1) % 7 in schedule['days']
+
+def _contains(zone, lat, lon):
+    """Exact containment test, after the bounding box check passed"""
+    zone_type = zone['zone_type']
+    geometry = zone['geometry']
+
+    if zone_type == 'rectangle':
+        return True
+    if zone_type == 'circle':
+        dy = (lat - geometry['lat']) * 110540.0
+        dx = (lon - geometry['lon']) * zone['meters_per_lon']
+        return dx * dx + dy * dy <= zone['radius_sq']
+
+    # Ray casting on the polygon edges
+    inside = False
+    points = geometry['points']
+    j = len(points) - 1
+    for i in range(len(points)):
+        lat_i, lon_i = points[i]
+        lat_j, lon_j = points[j]
+        if (lat_i > lat) != (lat_j > lat) and \
+                lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+            inside = not inside
+        j = i
+    return inside
+
+def _cell(lat, lon):
+    return (int(math.floor(lat / GEOFENCE_CELL_DEG)), int(math.floor(lon / GEOFENCE_CELL_DEG)))
+
+def build_index(zones):
+    """Build the grid index for a list of zone dicts and swap it in
+
+    Each zone is registered in every grid cell its bounding box touches;
+    very large zones go to a short list that is checked for every point.
+    Vehicle inside/outside state is kept for zones that still exist.
+    """
+    global _index
+    index = {'zones': {}, 'grid': {}, 'large': []}
+
+    for zone in zones:
+        zone = dict(zone)
+        zone['bbox'] = _bbox(zone['zone_type'], zone['geometry'])
+        if zone['zone_type'] == 'circle':
+            zone['meters_per_lon'] = 111320.0 * math.cos(math.radians(zone['geometry']['lat']))
+            zone['radius_sq'] = zone['geometry']['radius_m'] ** 2
+        index['zones'][zone['id']] = zone
+
+        min_lat, min_lon, max_lat, max_lon = zone['bbox']
+        low = _cell(min_lat, min_lon)
+        high = _cell(max_lat, max_lon)
+        if (high[0] - low[0] + 1) * (high[1] - low[1] + 1) > GEOFENCE_MAX_CELLS:
+            index['large'].append(zone['id'])
+            continue
+        for i in range(low[0], high[0] + 1):
+            for j in range(low[1], high[1] + 1):
+                index['grid'].setdefault((i, j), []).append(zone['id'])
+
+    with _lock:
+        _index = index
+        for vehicle_id, inside in _vehicle_zones.items():
+            _vehicle_zones[vehicle_id] = {zone_id for zone_id in inside if zone_id in index['zones']}
+
+    return len(index['zones'])
+
+def zones_at(lat, lon, vehicle_id=None, index=None):
+    """Ids of the zones containing a point that apply to a vehicle"""
+    index = index or _index
+    zones = index['zones']
+    candidates = index['grid'].get(_cell(lat, lon), [])
+    if index['large']:
+        candidates = candidates + index['large']
+
+    found = set()
+    for zone_id in candidates:
+        zone = zones[zone_id]
+        if zone['vehicle_id'] is not None and zone['vehicle_id'] != vehicle_id:
+            continue
+        min_lat, min_lon, max_lat, max_lon = zone['bbox']
+        if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon and _contains(zone, lat, lon):
+            found.add(zone_id)
+    return found
+
+def update_vehicle_zones(vehicle_id, lat, lon):
+    """Update a vehicle's zone membership; returns [(zone, 'entry' | 'exit')]
+
+    The first position seen for a vehicle only records its state, so a
+    restart does not report every vehicle as entering its current zones.
+    """
+    index = _index
+    inside = zones_at(lat, lon, vehicle_id, index)
+    zones = index['zones']
+
+    with _lock:
+        previous = _vehicle_zones.get(vehicle_id)
+        _vehicle_zones[vehicle_id] = inside
+
+    if previous is None or previous == inside:
+        return []
+
+    events = [(zones[zone_id], 'entry') for zone_id in inside - previous]
+    events += [(zones[zone_id], 'exit') for zone_id in previous - inside if zone_id in zones]
+    return events
+
+def _parse_timestamp(value):
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        return datetime.datetime.utcnow()
+
+def evaluate_geofences(packet):
+    """Packet handler: raise geofence_violation alarms on zone transitions"""
+    vehicle_id = packet.get('vehicle_id')
+    lat = packet.get('lat')
+    lon = packet.get('lon')
+    if vehicle_id is None or lat is None or lon is None:
+        return []
+
+    events = update_vehicle_zones(vehicle_id, lat, lon)
+    if not events:
+        return []
+
+    when = _parse_timestamp(packet.get('timestamp'))
+    raised = []
+    for zone, event in events:
+        if zone['alarm_on'] not in (event, 'both') or not _schedule_active(zone['schedule'], when):
+            continue
+        action = 'entered' if event == 'entry' else 'exited'
+        enhanced_log_alarm(
+            vehicle_id,
+            'geofence_violation',
+            f"Vehicle {action} geofence '{zone['name']}'",
+            metadata={
+                'geofence_id': zone['id'],
+                'geofence_name': zone['name'],
+                'event': event,
+                'latitude': lat,
+                'longitude': lon,
+                'timestamp': packet.get('timestamp')
+            }
+        )
+        raised.append((zone['id'], event))
+    return raised
+
+def _row_to_geofence(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'zone_type': row[2],
+        'geometry': json.loads(row[3]),
+        'vehicle_id': row[4],
+        'alarm_on': row[5],
+        'schedule': json.loads(row[6]) if row[6] else None,
+        'is_active': bool(row[7]),
+        'created_at': row[8],
+        'updated_at': row[9]
+    }
+
+def get_geofences(active_only=False):
+    """List geofences"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    query = '''
+        SELECT id, name, zone_type, geometry, vehicle_id, alarm_on, schedule, is_active, created_at, updated_at
+        FROM geofences
+    '''
+    if active_only:
+        query += ' WHERE is_active = 1'
+    c.execute(query + ' ORDER BY id')
+    rows = c.fetchall()
+    conn.close()
+    return [_row_to_geofence(row) for row in rows]
+
+def get_geofence(geofence_id):
+    """Get one geofence by id"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, name, zone_type, geometry, vehicle_id, alarm_on, schedule, is_active, created_at, updated_at
+        FROM geofences WHERE id = ?
+    ''', (geofence_id,))
+    row = c.fetchone()
+    conn.close()
+    return _row_to_geofence(row) if row else None
+
+def load_geofences():
+    """Rebuild the in-memory index from the active geofences"""
+    return build_index(get_geofences(active_only=True))
+
+def _validated_fields(data, current=None):
+    """Merge request fields over an existing geofence and validate them"""
+    fields = dict(current or {'alarm_on': 'both', 'schedule': None, 'vehicle_id': None, 'is_active': True})
+    fields.update({key: data[key] for key in
+                   ('name', 'zone_type', 'geometry', 'vehicle_id', 'alarm_on', 'schedule', 'is_active')
+                   if key in data})
+
+    if not fields.get('name'):
+        raise ValueError('name is required')
+    if fields['alarm_on'] not in ALARM_ON:
+        raise ValueError(f"alarm_on must be one of {', '.join(ALARM_ON)}")
+    if type(fields['is_active']) not in (bool, int) or fields['is_active'] not in (0, 1):
+        raise ValueError('is_active must be true, false, 0 or 1')
+    fields['geometry'] = validate_geometry(fields.get('zone_type'), fields.get('geometry'))
+    fields['schedule'] = validate_schedule(fields['schedule'])
+    return fields
+
+def create_geofence(data):
+    """Create a geofence and refresh the index; raises ValueError on bad input"""
+    fields = _validated_fields(data)
+    now = datetime.datetime.utcnow().isoformat()
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO geofences (name, zone_type, geometry, vehicle_id, alarm_on, schedule, is_active, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (fields['name'], fields['zone_type'], json.dumps(fields['geometry']), fields['vehicle_id'],
+          fields['alarm_on'], json.dumps(fields['schedule']) if fields['schedule'] else None,
+          1 if fields['is_active'] else 0, now, now))
+    geofence_id = c.lastrowid
+    conn.commit()
+    conn.close()
+
+    load_geofences()
+    return geofence_id
+
+def update_geofence(geofence_id, data):
+    """Update a geofence and refresh the index; returns False if it doesn't exist"""
+    current = get_geofence(geofence_id)
+    if not current:
+        return False
+    fields = _validated_fields(data, current)
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        UPDATE geofences SET name = ?, zone_type = ?, geometry = ?, vehicle_id = ?, alarm_on = ?,
+                             schedule = ?, is_active = ?, updated_at = ?
+        WHERE id = ?
+    ''', (fields['name'], fields['zone_type'], json.dumps(fields['geometry']), fields['vehicle_id'],
+          fields['alarm_on'], json.dumps(fields['schedule']) if fields['schedule'] else None,
+          1 if fields['is_active'] else 0, datetime.datetime.utcnow().isoformat(), geofence_id))
+    conn.commit()
+    conn.close()
+
+    load_geofences()
+    return True
+
+def delete_geofence(geofence_id):
+    """Delete a geofence and refresh the index"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('DELETE FROM geofences WHERE id = ?', (geofence_id,))
+    success = c.rowcount > 0
+    conn.commit()
+    conn.close()
+
+    if success:
+        load_geofences()
+    return success
+
+def add_geofence_routes(app, get_vehicle_id_from_imei):
+    """Add geofence routes to Flask app"""
+
+    @app.route('/api/geofences', methods=['GET', 'POST'])
+    def geofences_api():
+        if request.method == 'GET':
+            return jsonify({'geofences': get_geofences()})
+
+        try:
+            geofence_id = create_geofence(request.get_json() or {})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'success': True, 'geofence': get_geofence(geofence_id)}), 201
+
+    @app.route('/api/geofences/<int:geofence_id>', methods=['GET', 'PUT', 'DELETE'])
+    def geofence_api(geofence_id):
+        if request.method == 'GET':
+            geofence = get_geofence(geofence_id)
+            if not geofence:
+                return jsonify({'error': 'Geofence not found'}), 404
+            return jsonify(geofence)
+
+        if request.method == 'DELETE':
+            if not delete_geofence(geofence_id):
+                return jsonify({'error': 'Geofence not found'}), 404
+            return jsonify({'success': True, 'message': 'Geofence deleted'})
+
+        try:
+            if not update_geofence(geofence_id, request.get_json() or {}):
+                return jsonify({'error': 'Geofence not found'}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'success': True, 'geofence': get_geofence(geofence_id)})
+
+    @app.route('/api/geofences/vehicle')
+    def vehicle_geofences_api():
+        """Zones a vehicle is currently inside, from the live state"""
+        imei = request.args.get('imei')
+        if not imei:
+            return jsonify({'error': 'IMEI parameter is required'}), 400
+
+        vehicle_id = get_vehicle_id_from_imei(imei)
+        if not vehicle_id:
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        with _lock:
+            inside = _vehicle_zones.get(vehicle_id)
+            zones = _index['zones']
+        return jsonify({
+            'imei': imei,
+            'known': inside is not None,
+            'geofences': [{'id': zone_id, 'name': zones[zone_id]['name']}
+                          for zone_id in sorted(inside or []) if zone_id in zones]
+        })
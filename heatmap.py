@@ -0,0 +1,294 @@
+# Fleet density heatmap: gps_data binned into web-mercator tile grids
+#
+# Every tile is split into TILE_CELLS x TILE_CELLS cells. Cells are
+# addressed by one integer key per zoom, ordered so that the cells of a
+# tile are contiguous: ((tile_x << zoom | tile_y) << 2 * CELL_BITS) | cell.
+# A day's counts are kept as two sorted arrays (keys, counts) per zoom.
+# Closed days are stored in heatmap_daily_cache; today is binned
+# incrementally from the gps_data rows added since the last refresh.
+import os
+import sys
+import zlib
+import sqlite3
+import datetime
+import threading
+import collections
+import numpy as np
+from flask import request, jsonify
+
+DB = 'gps.db'
+
+HEATMAP_MIN_ZOOM = int(os.getenv('HEATMAP_MIN_ZOOM', 3))
+HEATMAP_MAX_ZOOM = int(os.getenv('HEATMAP_MAX_ZOOM', 15))
+# Longest date range a heatmap may cover
+HEATMAP_MAX_DAYS = int(os.getenv('HEATMAP_MAX_DAYS', 31))
+# How often today's counts pick up new rows
+HEATMAP_TODAY_TTL = float(os.getenv('HEATMAP_TODAY_TTL', 60))
+DEFAULT_DAYS = 7
+
+CELL_BITS = 5                    # 32 x 32 cells, 8 px each on a 256 px tile
+TILE_CELLS = 1 << CELL_BITS
+CELL_MASK = TILE_CELLS - 1
+MERCATOR_MAX_LAT = 85.0511287798
+
+# Merged date ranges kept in memory: (first_day, last_day, zoom) -> (keys, counts, max, today_version)
+RANGE_CACHE_SIZE = 32
+_ranges = collections.OrderedDict()
+# Today's counts: day, last gps_data id binned, zoom -> (keys, counts), refresh time, version
+_today = {'day': None, 'last_id': 0, 'zooms': {}, 'refreshed': 0.0, 'version': 0}
+_lock = threading.Lock()
+
+def init_heatmap_db():
+    """Create the per-day density cache"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS heatmap_daily_cache (
+            day TEXT,
+            zoom INTEGER,
+            cell_keys BLOB,
+            cell_counts BLOB,
+            points INTEGER,
+            computed_at TEXT,
+            PRIMARY KEY (day, zoom)
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+# --- Binning ---
+
+def _encode(cx, cy, zoom):
+    """Cell keys from global cell coordinates at a tile zoom"""
+    tile = ((cx >> CELL_BITS) << zoom) | (cy >> CELL_BITS)
+    return (tile << (2 * CELL_BITS)) | ((cy & CELL_MASK) << CELL_BITS) | (cx & CELL_MASK)
+
+def _decode(keys, zoom):
+    """Global cell coordinates (cx, cy) of cell keys"""
+    tile = keys >> (2 * CELL_BITS)
+    cell = keys & ((1 << (2 * CELL_BITS)) - 1)
+    cx = ((tile >> zoom) << CELL_BITS) | (cell & CELL_MASK)
+    cy = ((tile & ((1 << zoom) - 1)) << CELL_BITS) | (cell >> CELL_BITS)
+    return cx, cy
+
+def _sum_by_key(keys, counts):
+    """Sorted unique keys with the counts of equal keys added up"""
+    if not len(keys):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts[order], starts)
+
+def bin_points(lat, lon):
+    """{zoom: (keys, counts)} for HEATMAP_MIN_ZOOM..HEATMAP_MAX_ZOOM from coordinate arrays
+
+    Points are binned once at the finest zoom; each coarser zoom is
+    derived from the cells of the one above, which are far fewer than
+    the points.
+    """
+    level = HEATMAP_MAX_ZOOM + CELL_BITS
+    scale = float(1 << level)
+    lat = np.radians(np.clip(lat, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+    x = (lon + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0
+    cx = np.clip((x * scale).astype(np.int64), 0, (1 << level) - 1)
+    cy = np.clip((y * scale).astype(np.int64), 0, (1 << level) - 1)
+
+    grids = {}
+    keys, counts = _sum_by_key(_encode(cx, cy, HEATMAP_MAX_ZOOM), np.ones(len(cx), dtype=np.int64))
+    grids[HEATMAP_MAX_ZOOM] = (keys, counts)
+    for zoom in range(HEATMAP_MAX_ZOOM - 1, HEATMAP_MIN_ZOOM - 1, -1):
+        cx, cy = _decode(keys, zoom + 1)
+        keys, counts = _sum_by_key(_encode(cx >> 1, cy >> 1, zoom), counts)
+        grids[zoom] = (keys, counts)
+    return grids
+
+def _merge(grids):
+    """Add up several (keys, counts) grids of the same zoom"""
+    grids = [g for g in grids if len(g[0])]
+    if len(grids) <= 1:
+        return grids[0] if grids else (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    return _sum_by_key(np.concatenate([g[0] for g in grids]), np.concatenate([g[1] for g in grids]))
+
+# --- Closed days ---
+
+def _pack(keys, counts):
+    # Keys are sorted, so their deltas are small and compress well
+    deltas = np.diff(keys, prepend=0) if len(keys) else keys
+    return (zlib.compress(deltas.astype(np.int64).tobytes()),
+            zlib.compress(counts.astype(np.uint32).tobytes()))
+
+def _unpack(key_blob, count_blob):
+    keys = np.cumsum(np.frombuffer(zlib.decompress(key_blob), dtype=np.int64))
+    counts = np.frombuffer(zlib.decompress(count_blob), dtype=np.uint32).astype(np.int64)
+    return keys, counts
+
+def _load_points(c, where, params):
+    c.execute(f'''
+        SELECT latitude, longitude FROM gps_data
+        WHERE {where} AND latitude IS NOT NULL AND longitude IS NOT NULL
+    ''', params)
+    points = np.array(c.fetchall(), dtype=float).reshape(-1, 2)
+    return points[:, 0], points[:, 1]
+
+def compute_day(day):
+    """Bin one closed day and store every zoom in the cache; returns {zoom: (keys, counts)}
+
+    A day without points is not stored, so rows backfilled into it later
+    are picked up the next time it is requested.
+    """
+    day_start = datetime.date.fromisoformat(day)
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    lat, lon = _load_points(c, 'timestamp >= ? AND timestamp < ?',
+                            (day_start.isoformat(), (day_start + datetime.timedelta(days=1)).isoformat()))
+    grids = bin_points(lat, lon)
+    if len(lat):
+        computed_at = datetime.datetime.utcnow().isoformat()
+        c.executemany('''
+            INSERT OR REPLACE INTO heatmap_daily_cache (day, zoom, cell_keys, cell_counts, points, computed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(day, zoom, *_pack(keys, counts), len(lat), computed_at) for zoom, (keys, counts) in grids.items()])
+        conn.commit()
+    conn.close()
+    return grids
+
+def _closed_days(days, zoom):
+    """Cached grids of closed days at one zoom, binning the days that are missing"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT day, cell_keys, cell_counts FROM heatmap_daily_cache
+        WHERE day >= ? AND day <= ? AND zoom = ?
+    ''', (days[0], days[-1], zoom))
+    grids = {row[0]: _unpack(row[1], row[2]) for row in c.fetchall()}
+    conn.close()
+
+    for day in days:
+        if day not in grids:
+            grids[day] = compute_day(day)[zoom]
+    return [grids[day] for day in days]
+
+# --- Today ---
+
+def _refresh_today(today):
+    """Bin the gps_data rows added since the last refresh into today's grids"""
+    now = datetime.datetime.utcnow().timestamp()
+    if _today['day'] == today and now - _today['refreshed'] < HEATMAP_TODAY_TTL:
+        return
+    if _today['day'] != today:
+        _today.update(day=today, last_id=0, zooms={})
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM gps_data')
+    last_id = c.fetchone()[0]
+    if last_id > _today['last_id']:
+        tomorrow = (datetime.date.fromisoformat(today) + datetime.timedelta(days=1)).isoformat()
+        if _today['last_id']:
+            lat, lon = _load_points(c, 'id > ? AND id <= ? AND timestamp >= ? AND timestamp < ?',
+                                    (_today['last_id'], last_id, today, tomorrow))
+        else:
+            lat, lon = _load_points(c, 'id <= ? AND timestamp >= ? AND timestamp < ?', (last_id, today, tomorrow))
+        if len(lat):
+            for zoom, grid in bin_points(lat, lon).items():
+                previous = _today['zooms'].get(zoom)
+                _today['zooms'][zoom] = _merge([previous, grid]) if previous is not None else grid
+            _today['version'] += 1
+        _today['last_id'] = last_id
+    conn.close()
+    _today['refreshed'] = now
+
+# --- Queries ---
+
+def heatmap_days(start_date=None, end_date=None):
+    """Days covered by a request; the last DEFAULT_DAYS days when no range is given"""
+    end = datetime.date.fromisoformat(end_date[:10]) if end_date else datetime.datetime.utcnow().date()
+    start = datetime.date.fromisoformat(start_date[:10]) if start_date else end - datetime.timedelta(days=DEFAULT_DAYS - 1)
+    if start > end:
+        raise ValueError('start_date is after end_date')
+    if (end - start).days >= HEATMAP_MAX_DAYS:
+        raise ValueError(f'Date range is limited to {HEATMAP_MAX_DAYS} days')
+    return [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+def get_density(days, zoom):
+    """(keys, counts, max count) over the days at a zoom
+
+    The closed days of a range are merged once and kept in memory; a
+    range that includes today is merged again only when today's counts
+    have changed.
+    """
+    today = datetime.datetime.utcnow().date().isoformat()
+    closed = [day for day in days if day < today]
+    with _lock:
+        if today in days:
+            _refresh_today(today)
+        version = _today['version'] if today in days else None
+        cache_key = (days[0], days[-1], zoom)
+        cached = _ranges.get(cache_key)
+        if cached is not None and cached[3] == version:
+            _ranges.move_to_end(cache_key)
+            return cached[:3]
+
+    grids = _closed_days(closed, zoom) if closed else []
+    with _lock:
+        if today in days and zoom in _today['zooms']:
+            grids.append(_today['zooms'][zoom])
+        keys, counts = _merge(grids)
+        result = (keys, counts, int(counts.max()) if len(counts) else 0, version)
+        _ranges[cache_key] = result
+        while len(_ranges) > RANGE_CACHE_SIZE:
+            _ranges.popitem(last=False)
+    return result[:3]
+
+def get_tile(days, zoom, x, y):
+    """Non-empty cells of one tile: cell indexes (row * TILE_CELLS + column), counts and the range max"""
+    keys, counts, peak = get_density(days, zoom)
+    tile = ((x << zoom) | y) << (2 * CELL_BITS)
+    lo, hi = np.searchsorted(keys, [tile, tile + (1 << (2 * CELL_BITS))])
+    return {
+        'cells': (keys[lo:hi] - tile).tolist(),
+        'counts': counts[lo:hi].tolist(),
+        'max': peak
+    }
+
+def add_heatmap_routes(app):
+    """Add heatmap tile routes to Flask app"""
+
+    @app.route('/api/heatmap/<int:zoom>/<int:x>/<int:y>')
+    def heatmap_tile_api(zoom, x, y):
+        if not HEATMAP_MIN_ZOOM <= zoom <= HEATMAP_MAX_ZOOM:
+            return jsonify({'error': f'zoom must be between {HEATMAP_MIN_ZOOM} and {HEATMAP_MAX_ZOOM}'}), 400
+        if not (0 <= x < 1 << zoom and 0 <= y < 1 << zoom):
+            return jsonify({'error': 'Tile out of range'}), 400
+
+        try:
+            days = heatmap_days(request.args.get('start_date'), request.args.get('end_date'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        response = jsonify({
+            'zoom': zoom,
+            'x': x,
+            'y': y,
+            'start_date': days[0],
+            'end_date': days[-1],
+            'size': TILE_CELLS,
+            **get_tile(days, zoom, x, y)
+        })
+        # Closed ranges never change; ranges including today change with every refresh
+        today = datetime.datetime.utcnow().date().isoformat()
+        response.headers['Cache-Control'] = f'max-age={int(HEATMAP_TODAY_TTL) if days[-1] >= today else 86400}'
+        return response
+
+if __name__ == '__main__':
+    # Precompute a closed day, e.g. from a nightly cron job:
+    #   python heatmap.py 2025-01-31
+    target_day = sys.argv[1] if len(sys.argv) > 1 else \
+        (datetime.datetime.utcnow().date() - datetime.timedelta(days=1)).isoformat()
+    init_heatmap_db()
+    count = int(compute_day(target_day)[HEATMAP_MAX_ZOOM][1].sum())
+    print(f"Binned {count} GPS points for {target_day}")
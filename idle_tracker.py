@@ -0,0 +1,207 @@
+# Incremental idle detection on incoming packets
+import os
+import time
+import atexit
+import sqlite3
+import datetime
+import threading
+from flask import request, jsonify
+from enhanced_alarm import enhanced_log_alarm
+
+DB = 'gps.db'
+
+# Below this speed the vehicle counts as stopped (same threshold as the reports)
+IDLE_SPEED_KMH = float(os.getenv('IDLE_SPEED_KMH', 1))
+# Idle time before an excessive_idling alarm
+IDLE_ALARM_MINUTES = float(os.getenv('IDLE_ALARM_MINUTES', 10))
+# Idle time before a fuel_waste_prevention alarm
+IDLE_FUEL_WASTE_MINUTES = float(os.getenv('IDLE_FUEL_WASTE_MINUTES', 30))
+# How often changed state is written to vehicle_idle_status
+IDLE_FLUSH_SECONDS = float(os.getenv('IDLE_FLUSH_SECONDS', 30))
+
+# Status values stored in vehicle_idle_status.idle_status:
+#   moving  - speed at or above IDLE_SPEED_KMH
+#   idling  - stopped with the ignition on
+#   parked  - stopped with the ignition off
+#   stopped - stopped, ignition state not reported (never alarms)
+
+# vehicle_id -> {'status', 'idle_start', 'last_update', 'alarmed'}
+_states = {}
+_dirty = set()
+_lock = threading.Lock()
+_flusher = []
+
+def load_idle_status():
+    """Restore tracker state from vehicle_idle_status after a restart
+
+    Alarms whose threshold had already passed are treated as raised, so
+    a restart in the middle of a long idle does not repeat them.
+    """
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('SELECT vehicle_id, idle_status, idle_start_time, last_update FROM vehicle_idle_status')
+    rows = c.fetchall()
+    conn.close()
+
+    with _lock:
+        _states.clear()
+        for vehicle_id, status, idle_start, last_update in rows:
+            alarmed = set()
+            if status == 'idling' and idle_start and last_update:
+                minutes = (_parse_timestamp(last_update) - _parse_timestamp(idle_start)).total_seconds() / 60
+                if minutes >= IDLE_ALARM_MINUTES:
+                    alarmed.add('excessive_idling')
+                if minutes >= IDLE_FUEL_WASTE_MINUTES:
+                    alarmed.add('fuel_waste_prevention')
+            _states[vehicle_id] = {
+                'status': status,
+                'idle_start': idle_start,
+                'last_update': last_update,
+                'alarmed': alarmed
+            }
+
+    return len(rows)
+
+def flush_idle_status():
+    """Write every changed vehicle state in one transaction"""
+    with _lock:
+        rows = [(vehicle_id, _states[vehicle_id]['status'], _states[vehicle_id]['idle_start'],
+                 _states[vehicle_id]['last_update']) for vehicle_id in _dirty]
+        _dirty.clear()
+
+    if not rows:
+        return 0
+
+    try:
+        conn = sqlite3.connect(DB, timeout=30)
+        c = conn.cursor()
+        c.executemany('''
+            INSERT OR REPLACE INTO vehicle_idle_status (vehicle_id, idle_status, idle_start_time, last_update)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        print(f"Error saving idle status: {e}")
+        with _lock:
+            _dirty.update(row[0] for row in rows)
+        return 0
+
+    return len(rows)
+
+def _flush_loop():
+    while True:
+        time.sleep(IDLE_FLUSH_SECONDS)
+        flush_idle_status()
+
+def _ensure_flusher():
+    with _lock:
+        if not _flusher:
+            flusher = threading.Thread(target=_flush_loop, daemon=True)
+            flusher.start()
+            _flusher.append(flusher)
+            atexit.register(flush_idle_status)
+
+def _parse_timestamp(value):
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        return datetime.datetime.utcnow()
+
+def _classify(speed, ignition):
+    if speed is not None and speed >= IDLE_SPEED_KMH:
+        return 'moving'
+    if ignition is None:
+        return 'stopped'
+    return 'idling' if ignition else 'parked'
+
+def evaluate_idle(packet):
+    """Packet handler: advance the vehicle's idle state and raise idle alarms
+
+    Uses the packet's speed and ignition flag. The idle clock starts when
+    the vehicle stops with the ignition on and resets when it moves or
+    the ignition is switched off. Each alarm fires at most once per idle
+    period. State changes are persisted by the background flusher, not
+    per packet.
+    """
+    vehicle_id = packet.get('vehicle_id')
+    if vehicle_id is None:
+        return []
+
+    timestamp = packet.get('timestamp') or datetime.datetime.utcnow().isoformat()
+    status = _classify(packet.get('speed'), packet.get('ignition'))
+    alarms = []
+
+    with _lock:
+        state = _states.get(vehicle_id)
+        if state is None or state['status'] != status:
+            state = _states[vehicle_id] = {
+                'status': status,
+                'idle_start': timestamp if status != 'moving' else None,
+                'last_update': timestamp,
+                'alarmed': set()
+            }
+        else:
+            state['last_update'] = timestamp
+
+        if status == 'idling':
+            minutes = (_parse_timestamp(timestamp) - _parse_timestamp(state['idle_start'])).total_seconds() / 60
+            for alarm_type, threshold in (('excessive_idling', IDLE_ALARM_MINUTES),
+                                          ('fuel_waste_prevention', IDLE_FUEL_WASTE_MINUTES)):
+                if minutes >= threshold and alarm_type not in state['alarmed']:
+                    state['alarmed'].add(alarm_type)
+                    alarms.append((alarm_type, minutes, state['idle_start']))
+
+        _dirty.add(vehicle_id)
+
+    if not _flusher:
+        _ensure_flusher()
+
+    for alarm_type, minutes, idle_start in alarms:
+        if alarm_type == 'excessive_idling':
+            message = f"Vehicle idling for {minutes:.0f} minutes"
+        else:
+            message = f"Engine running while stopped for {minutes:.0f} minutes, wasting fuel"
+        enhanced_log_alarm(vehicle_id, alarm_type, message, metadata={
+            'idle_minutes': round(minutes, 1),
+            'idle_start_time': idle_start,
+            'latitude': packet.get('lat'),
+            'longitude': packet.get('lon')
+        })
+
+    return [alarm[0] for alarm in alarms]
+
+def get_idle_status(vehicle_id=None):
+    """Current idle state from memory, for one vehicle or all of them"""
+    with _lock:
+        if vehicle_id is None:
+            states = dict(_states)
+        else:
+            states = {vehicle_id: _states[vehicle_id]} if vehicle_id in _states else {}
+        return [{
+            'vehicle_id': vid,
+            'idle_status': state['status'],
+            'idle_start_time': state['idle_start'],
+            'last_update': state['last_update']
+        } for vid, state in sorted(states.items())]
+
+def add_idle_routes(app, get_vehicle_id_from_imei):
+    """Add idle status routes to Flask app"""
+
+    @app.route('/api/idle_status')
+    def idle_status_api():
+        imei = request.args.get('imei')
+        if not imei:
+            return jsonify({'vehicles': get_idle_status()})
+
+        vehicle_id = get_vehicle_id_from_imei(imei)
+        if not vehicle_id:
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        status = get_idle_status(vehicle_id)
+        return jsonify(status[0] if status else {
+            'vehicle_id': vehicle_id,
+            'idle_status': None,
+            'idle_start_time': None,
+            'last_update': None
+        })
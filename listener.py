@@ -23,7 +23,41 @@ def handle_packet(imei, lat, lon, speed, heading):
 
     push_packet(packet)
 
-def save_gps(imei, lat, lon, speed):
+# Callbacks run for every decoded packet after it is stored: handler(packet)
+PACKET_HANDLERS = []
+
+# imei -> vehicle_id, filled on first packet from each device
+_vehicle_ids = {}
+
+def add_packet_handler(handler):
+    """Register a callback for decoded packets (rule engines, live views)"""
+    PACKET_HANDLERS.append(handler)
+
+def get_vehicle_id(imei):
+    """Resolve a device IMEI to its vehicle id, cached after the first lookup"""
+    if imei in _vehicle_ids:
+        return _vehicle_ids[imei]
+
+    conn = sqlite3.connect(DB, timeout=30)
+    c = conn.cursor()
+    c.execute("SELECT id FROM vehicles WHERE imei = ?", (imei,))
+    row = c.fetchone()
+    conn.close()
+
+    if row:
+        _vehicle_ids[imei] = row[0]
+        return row[0]
+    return None
+
+def dispatch_packet(packet):
+    """Pass a packet to every registered handler; one failing handler doesn't stop the rest"""
+    for handler in PACKET_HANDLERS:
+        try:
+            handler(packet)
+        except Exception as e:
+            print(f"Packet handler {handler.__name__} failed: {e}")
+
+def save_gps(imei, lat, lon, speed, timestamp=None):
     conn = sqlite3.connect(DB, timeout=30)
     c = conn.cursor()
     c.execute("""
@@ -31,7 +65,7 @@ def save_gps(imei, lat, lon, speed):
         SELECT id, ?, ?, ?, ?
         FROM vehicles WHERE imei = ?
     """, (
-        datetime.datetime.utcnow().isoformat(),
+        timestamp or datetime.datetime.utcnow().isoformat(),
         lat, lon, speed, imei
     ))
     conn.commit()
@@ -47,8 +81,21 @@ def handle_client(conn, addr):
         lat = 9.03
         lon = 38.74
         speed = 40
+        heading = None
+
+        timestamp = datetime.datetime.utcnow().isoformat()
+        save_gps(imei, lat, lon, speed, timestamp)
 
-        save_gps(imei, lat, lon, speed)
+        dispatch_packet({
+            "imei": imei,
+            "vehicle_id": get_vehicle_id(imei),
+            "lat": lat,
+            "lon": lon,
+            "speed": speed,
+            "heading": heading,
+            "ignition": None,  # Not decoded yet
+            "timestamp": timestamp
+        })
     except Exception as e:
         print("ERR:", e)
     finally:
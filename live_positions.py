@@ -0,0 +1,420 @@
+# Last known position per vehicle, pushed to map viewers over Server-Sent Events
+import os
+import json
+import math
+import time
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from flask import Response, request, jsonify
+
+DB = 'gps.db'
+
+# Changed positions are sent at most this often (one update per vehicle per interval)
+LIVE_PUSH_SECONDS = float(os.getenv('LIVE_PUSH_SECONDS', 1))
+# Comment line sent on idle streams so proxies keep them open
+LIVE_KEEPALIVE_SECONDS = 15
+# Batches a slow viewer may fall behind before it is resynced with a snapshot
+LIVE_SUBSCRIBER_BACKLOG = 10
+# Grid cell size of the position index, in degrees (0.01 is about 1.1 km)
+LIVE_CELL_DEG = float(os.getenv('LIVE_CELL_DEG', 0.01))
+# Largest radius accepted by /api/vehicles/nearby
+MAX_NEARBY_RADIUS_M = 100000
+# Recent positions kept per vehicle, to tell which one a polling client last saw
+LIVE_TRAIL_LENGTH = 8
+
+# vehicle_id -> {'vehicle_id', 'imei', 'license_plate', 'lat', 'lon', 'speed', 'heading', 'timestamp'}
+_positions = {}
+# vehicle_id -> (imei, license_plate)
+_vehicles = {}
+# Grid index over _positions: (cell_x, cell_y) -> set of vehicle_ids, and each vehicle's cell
+_cells = {}
+_cell_of = {}
+# Vehicles whose position changed since the last push
+_pending = set()
+# vehicle_id -> version of its last change, oldest change first, for delta polling
+_versions = OrderedDict()
+_version = 0
+# vehicle_id -> deque of (version, lat, lon), oldest first
+_trails = {}
+# Distinguishes version numbers from an earlier process, which restart at 0
+_BOOT_ID = str(int(time.time()))
+# Open streams: {'queue': Queue of batches, 'resync': bool, 'bbox', 'visible': ids the viewer has inside its bbox}
+_subscribers = []
+
+_lock = threading.Lock()
+_broadcaster = []
+
+def _vehicle_info(vehicle_id):
+    """(imei, license_plate) for a vehicle, looked up once"""
+    info = _vehicles.get(vehicle_id)
+    if info is None:
+        conn = sqlite3.connect(DB)
+        c = conn.cursor()
+        c.execute('SELECT imei, license_plate FROM vehicles WHERE id = ?', (vehicle_id,))
+        row = c.fetchone()
+        conn.close()
+        info = _vehicles[vehicle_id] = (row[0], row[1]) if row else (None, None)
+    return info
+
+def _cell(lat, lon):
+    return int(math.floor(lon / LIVE_CELL_DEG)), int(math.floor(lat / LIVE_CELL_DEG))
+
+def _place(vehicle_id, position):
+    """Store a position and move the vehicle between grid cells if needed (caller holds _lock)"""
+    _positions[vehicle_id] = position
+    cell = _cell(position['lat'], position['lon'])
+    previous = _cell_of.get(vehicle_id)
+    if previous == cell:
+        return
+    if previous is not None:
+        members = _cells[previous]
+        members.discard(vehicle_id)
+        if not members:
+            del _cells[previous]
+    _cells.setdefault(cell, set()).add(vehicle_id)
+    _cell_of[vehicle_id] = cell
+
+def _touch(vehicle_id):
+    """Give a vehicle the next version number (caller holds _lock)"""
+    global _version
+    _version += 1
+    _versions[vehicle_id] = _version
+    _versions.move_to_end(vehicle_id)
+    position = _positions[vehicle_id]
+    trail = _trails.get(vehicle_id)
+    if trail is None:
+        trail = _trails[vehicle_id] = deque(maxlen=LIVE_TRAIL_LENGTH)
+    trail.append((_version, position['lat'], position['lon']))
+
+def _seen_in_bbox(vehicle_id, version, bbox):
+    """Whether a client at `version` had the vehicle inside bbox (caller holds _lock)
+
+    Uses the newest trail entry at or before the version. When the trail
+    no longer reaches back that far the answer is unknown, so it is
+    assumed inside and the client gets a (possibly redundant) removal.
+    """
+    trail = _trails.get(vehicle_id, ())
+    for entry_version, lat, lon in reversed(trail):
+        if entry_version <= version:
+            return _in_bbox({'lat': lat, 'lon': lon}, bbox)
+    return len(trail) == LIVE_TRAIL_LENGTH
+
+def load_live_positions():
+    """Seed the store with each vehicle's latest stored point (one index seek per vehicle)"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('SELECT id, imei, license_plate FROM vehicles')
+    vehicles = c.fetchall()
+
+    positions = {}
+    for vehicle_id, imei, license_plate in vehicles:
+        c.execute('''
+            SELECT timestamp, latitude, longitude, speed FROM gps_data
+            WHERE vehicle_id = ? AND latitude IS NOT NULL AND longitude IS NOT NULL
+            ORDER BY timestamp DESC LIMIT 1
+        ''', (vehicle_id,))
+        row = c.fetchone()
+        if row:
+            positions[vehicle_id] = {'vehicle_id': vehicle_id, 'imei': imei, 'license_plate': license_plate, 'lat': row[1],
+                                     'lon': row[2], 'speed': row[3], 'heading': None, 'timestamp': row[0]}
+    conn.close()
+
+    with _lock:
+        _vehicles.update({vehicle_id: (imei, plate) for vehicle_id, imei, plate in vehicles})
+        for vehicle_id, position in positions.items():
+            current = _positions.get(vehicle_id)
+            if current is None or (current['timestamp'] or '') < (position['timestamp'] or ''):
+                _place(vehicle_id, position)
+                _touch(vehicle_id)
+
+    return len(positions)
+
+def update_position(packet):
+    """Packet handler: record the vehicle's position and queue it for viewers"""
+    vehicle_id = packet.get('vehicle_id')
+    lat, lon = packet.get('lat'), packet.get('lon')
+    if vehicle_id is None or lat is None or lon is None:
+        return
+
+    if vehicle_id not in _vehicles:
+        _vehicle_info(vehicle_id)
+
+    with _lock:
+        imei, license_plate = _vehicles[vehicle_id]
+        _place(vehicle_id, {
+            'vehicle_id': vehicle_id,
+            'imei': imei,
+            'license_plate': license_plate,
+            'lat': lat,
+            'lon': lon,
+            'speed': packet.get('speed'),
+            'heading': packet.get('heading'),
+            'timestamp': packet.get('timestamp')
+        })
+        _pending.add(vehicle_id)
+        _touch(vehicle_id)
+
+def parse_bbox(value):
+    """'min_lon,min_lat,max_lon,max_lat' (Leaflet's toBBoxString order) to a tuple, or None"""
+    if not value:
+        return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    if min_lat > max_lat or min_lon > max_lon:
+        raise ValueError('bbox minimum is greater than its maximum')
+    return min_lon, min_lat, max_lon, max_lat
+
+def _in_bbox(position, bbox):
+    return bbox[1] <= position['lat'] <= bbox[3] and bbox[0] <= position['lon'] <= bbox[2]
+
+def _ids_in_bbox(bbox):
+    """Vehicle ids inside bbox from the grid (caller holds _lock)
+
+    Visits the cells the box covers, or every occupied cell when that is
+    fewer (whole-country boxes), so the cost follows what is near the box.
+    """
+    min_x, min_y = _cell(bbox[1], bbox[0])
+    max_x, max_y = _cell(bbox[3], bbox[2])
+    if (max_x - min_x + 1) * (max_y - min_y + 1) <= len(_cells):
+        cells = ((x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
+    else:
+        cells = (cell for cell in _cells if min_x <= cell[0] <= max_x and min_y <= cell[1] <= max_y)
+    ids = []
+    for cell in cells:
+        for vehicle_id in _cells.get(cell, ()):
+            if _in_bbox(_positions[vehicle_id], bbox):
+                ids.append(vehicle_id)
+    return ids
+
+def get_positions(bbox=None):
+    """Snapshot of every known position, optionally only those inside bbox"""
+    with _lock:
+        if bbox is None:
+            return [dict(position) for position in _positions.values()]
+        return [dict(_positions[vehicle_id]) for vehicle_id in _ids_in_bbox(bbox)]
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+def get_nearby(lat, lon, radius_m, limit=None):
+    """Vehicles within radius_m of a point, nearest first, each with distance_m"""
+    # Degrees spanned by the radius on the same sphere as _distance_m, padded for rounding
+    dlat = radius_m / 111194.9 * 1.001
+    dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-6)
+    bbox = (lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+
+    nearby = []
+    with _lock:
+        for vehicle_id in _ids_in_bbox(bbox):
+            position = _positions[vehicle_id]
+            distance = _distance_m(lat, lon, position['lat'], position['lon'])
+            if distance <= radius_m:
+                nearby.append((distance, position))
+
+    nearby.sort(key=lambda hit: hit[0])
+    if limit:
+        nearby = nearby[:limit]
+    return [{**position, 'distance_m': round(distance, 1)} for distance, position in nearby]
+
+def version_token():
+    return f"{_BOOT_ID}-{_version}"
+
+def get_changes(since=None, bbox=None):
+    """(version token, changed positions, IMEIs that left bbox, whether it is a full list)
+
+    Walks the version map from the newest change backwards and stops at
+    the first vehicle the client already has, so the cost is the number
+    of changes, not the fleet size. A missing, malformed or previous-process
+    token returns every position. With a bbox, changed vehicles that were
+    inside it at the client's version and are now outside are listed as
+    removed so the client can drop them.
+    """
+    since_version = None
+    if since:
+        boot, _, number = since.partition('-')
+        if boot == _BOOT_ID and number.isdigit():
+            since_version = int(number)
+
+    with _lock:
+        token = version_token()
+        if since_version is None:
+            ids = _positions if bbox is None else _ids_in_bbox(bbox)
+            return token, [dict(_positions[vehicle_id]) for vehicle_id in ids], [], True
+
+        changed = []
+        removed = []
+        for vehicle_id in reversed(_versions):
+            if _versions[vehicle_id] <= since_version:
+                break
+            position = _positions[vehicle_id]
+            if bbox is None or _in_bbox(position, bbox):
+                changed.append(dict(position))
+            elif _seen_in_bbox(vehicle_id, since_version, bbox):
+                removed.append(position['imei'])
+        return token, changed, removed, False
+
+def changes_response(since, if_none_match=None, bbox=None):
+    """JSON delta for /api/latest?since=..., or 304 when the client's ETag is current"""
+    token = version_token()
+    etag = f'"{token}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        response = Response(status=304)
+    else:
+        token, positions, removed, full = get_changes(since, bbox)
+        etag = f'"{token}"'
+        response = jsonify({'version': token, 'full': full, 'vehicles': positions, 'removed': removed})
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _events(positions, removed=()):
+    """SSE text for a batch: a `positions` event, plus `removed` when vehicles left the viewer's bbox"""
+    text = f"event: positions\ndata: {json.dumps(positions)}\n\n" if positions else ''
+    if removed:
+        text += f"event: removed\ndata: {json.dumps(list(removed))}\n\n"
+    return text
+
+def _broadcast_loop():
+    while True:
+        time.sleep(LIVE_PUSH_SECONDS)
+        with _lock:
+            if not _pending:
+                continue
+            batch = [dict(_positions[vehicle_id]) for vehicle_id in _pending]
+            _pending.clear()
+            # Split per bbox viewer here, where its visible set can't change under us.
+            # Only vehicles the viewer has on screen can be removed, so the
+            # payload follows what is visible, not the fleet size.
+            deliveries = []
+            for subscriber in _subscribers:
+                bbox = subscriber['bbox']
+                if bbox is None:
+                    deliveries.append((subscriber, None, None))
+                    continue
+                visible = subscriber['visible']
+                inside, removed = [], []
+                for position in batch:
+                    if _in_bbox(position, bbox):
+                        inside.append(position)
+                        visible.add(position['vehicle_id'])
+                    elif position['vehicle_id'] in visible:
+                        removed.append(position['imei'])
+                        visible.discard(position['vehicle_id'])
+                if inside or removed:
+                    deliveries.append((subscriber, inside, removed))
+
+        # Serialized once for every viewer without a bbox
+        message = None
+        for subscriber, inside, removed in deliveries:
+            if inside is None:
+                message = message or _events(batch)
+                text = message
+            else:
+                text = _events(inside, removed)
+            try:
+                subscriber['queue'].put_nowait(text)
+            except queue.Full:
+                subscriber['resync'] = True
+
+def _ensure_broadcaster():
+    with _lock:
+        if not _broadcaster:
+            broadcaster = threading.Thread(target=_broadcast_loop, daemon=True)
+            broadcaster.start()
+            _broadcaster.append(broadcaster)
+
+def subscribe(bbox=None):
+    subscriber = {'queue': queue.Queue(maxsize=LIVE_SUBSCRIBER_BACKLOG), 'resync': False, 'bbox': bbox,
+                  'visible': set()}
+    with _lock:
+        _subscribers.append(subscriber)
+    if not _broadcaster:
+        _ensure_broadcaster()
+    return subscriber
+
+def unsubscribe(subscriber):
+    with _lock:
+        if subscriber in _subscribers:
+            _subscribers.remove(subscriber)
+
+def _snapshot(subscriber):
+    """Current positions for a viewer, resetting the set of vehicles it has on screen"""
+    with _lock:
+        if subscriber['bbox'] is None:
+            positions = [dict(position) for position in _positions.values()]
+        else:
+            positions = [dict(_positions[vehicle_id]) for vehicle_id in _ids_in_bbox(subscriber['bbox'])]
+            subscriber['visible'] = {position['vehicle_id'] for position in positions}
+    return f"event: snapshot\ndata: {json.dumps(positions)}\n\n"
+
+def stream_positions(bbox=None):
+    """SSE response: a `snapshot` event, then `positions` events with changed vehicles only"""
+    subscriber = subscribe(bbox)
+
+    def generate():
+        try:
+            yield _snapshot(subscriber)
+            while True:
+                try:
+                    message = subscriber['queue'].get(timeout=LIVE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if subscriber['resync']:
+                    # Fell behind: drop the backlog and start over from the current state
+                    subscriber['resync'] = False
+                    while not subscriber['queue'].empty():
+                        subscriber['queue'].get_nowait()
+                    yield _snapshot(subscriber)
+                    continue
+                yield message
+        finally:
+            unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def add_live_position_routes(app):
+    """Add live position routes to Flask app"""
+
+    @app.route('/api/live/stream')
+    def live_stream_api():
+        try:
+            bbox = parse_bbox(request.args.get('bbox'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return stream_positions(bbox)
+
+    @app.route('/api/vehicles/within')
+    def vehicles_within_api():
+        try:
+            bbox = parse_bbox(request.args.get('bbox'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if bbox is None:
+            return jsonify({'error': 'bbox parameter is required'}), 400
+        vehicles = get_positions(bbox)
+        return jsonify({'bbox': list(bbox), 'count': len(vehicles), 'vehicles': vehicles})
+
+    @app.route('/api/vehicles/nearby')
+    def vehicles_nearby_api():
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
+        radius_m = request.args.get('radius_m', 2000, type=float)
+        limit = request.args.get('limit', type=int)
+
+        if lat is None or lon is None:
+            return jsonify({'error': 'lat and lon parameters are required'}), 400
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({'error': 'lat/lon out of range'}), 400
+        if not 0 < radius_m <= MAX_NEARBY_RADIUS_M:
+            return jsonify({'error': f'radius_m must be between 0 and {MAX_NEARBY_RADIUS_M}'}), 400
+
+        vehicles = get_nearby(lat, lon, radius_m, limit)
+        return jsonify({'lat': lat, 'lon': lon, 'radius_m': radius_m, 'count': len(vehicles), 'vehicles': vehicles})
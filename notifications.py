@@ -0,0 +1,310 @@
+# Asynchronous alarm notifications: webhook, SMS gateway and email
+import os
+import json
+import time
+import heapq
+import queue
+import random
+import smtplib
+import threading
+import http.client
+import datetime
+from email.message import EmailMessage
+from urllib.parse import urlsplit
+
+# Channel settings; a channel is enabled when its destination is configured
+NOTIFY_WEBHOOK_URL = os.getenv('NOTIFY_WEBHOOK_URL', '')
+NOTIFY_SMS_URL = os.getenv('NOTIFY_SMS_URL', '')  # HTTP SMS gateway, receives {"to": [...], "message": "..."}
+NOTIFY_SMS_TO = [n.strip() for n in os.getenv('NOTIFY_SMS_TO', '').split(',') if n.strip()]
+NOTIFY_SMTP_HOST = os.getenv('NOTIFY_SMTP_HOST', '')
+NOTIFY_SMTP_PORT = int(os.getenv('NOTIFY_SMTP_PORT', 25))
+NOTIFY_SMTP_USER = os.getenv('NOTIFY_SMTP_USER', '')
+NOTIFY_SMTP_PASSWORD = os.getenv('NOTIFY_SMTP_PASSWORD', '')
+NOTIFY_SMTP_STARTTLS = os.getenv('NOTIFY_SMTP_STARTTLS', '').lower() in ('1', 'true', 'yes')
+NOTIFY_EMAIL_FROM = os.getenv('NOTIFY_EMAIL_FROM', 'gps-alarms@localhost')
+NOTIFY_EMAIL_TO = [a.strip() for a in os.getenv('NOTIFY_EMAIL_TO', '').split(',') if a.strip()]
+NOTIFY_ESCALATION_TO = [a.strip() for a in os.getenv('NOTIFY_ESCALATION_TO', '').split(',') if a.strip()]
+
+# Dispatcher settings
+NOTIFY_QUEUE_SIZE = int(os.getenv('NOTIFY_QUEUE_SIZE', 1000))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', 4))
+NOTIFY_CHANNEL_CONCURRENCY = int(os.getenv('NOTIFY_CHANNEL_CONCURRENCY', 2))
+NOTIFY_TIMEOUT_SECONDS = float(os.getenv('NOTIFY_TIMEOUT_SECONDS', 10))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', 5))
+NOTIFY_RETRY_BASE_SECONDS = float(os.getenv('NOTIFY_RETRY_BASE_SECONDS', 2))
+# Non-critical alarms are collected and sent as one digest per interval
+NOTIFY_DIGEST_SECONDS = float(os.getenv('NOTIFY_DIGEST_SECONDS', 300))
+# Alarms listed in one digest; the rest are only counted
+NOTIFY_DIGEST_MAX = int(os.getenv('NOTIFY_DIGEST_MAX', 500))
+# Unacknowledged critical alarms are escalated after this long (0 disables)
+NOTIFY_ESCALATE_MINUTES = float(os.getenv('NOTIFY_ESCALATE_MINUTES', 15))
+
+CHANNELS = ('webhook', 'sms', 'email')
+
+# Channels used for each kind of notification, when configured
+ROUTES = {
+    'critical': ('webhook', 'sms', 'email'),
+    'digest': ('webhook', 'email'),
+    'escalation': ('webhook', 'sms', 'email')
+}
+
+_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+_channel_slots = {channel: threading.BoundedSemaphore(NOTIFY_CHANNEL_CONCURRENCY) for channel in CHANNELS}
+# channel -> idle connections available for reuse
+_connections = {channel: queue.LifoQueue() for channel in CHANNELS}
+
+# Timer heap shared by retries, digests and escalations: (due, seq, fn, args)
+_timers = []
+_timer_seq = [0]
+_timer_condition = threading.Condition()
+
+_digest = []
+_digest_omitted = [0]  # alarms past NOTIFY_DIGEST_MAX in the pending digest
+_escalations = {}  # alarm_id -> alarm awaiting acknowledgement
+_lock = threading.Lock()
+_threads = []
+
+stats = {'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0}
+
+def _count(key):
+    with _lock:
+        stats[key] += 1
+
+def channel_enabled(channel):
+    if channel == 'webhook':
+        return bool(NOTIFY_WEBHOOK_URL)
+    if channel == 'sms':
+        return bool(NOTIFY_SMS_URL and NOTIFY_SMS_TO)
+    if channel == 'email':
+        return bool(NOTIFY_SMTP_HOST and NOTIFY_EMAIL_TO)
+    return False
+
+class PermanentError(Exception):
+    """A delivery failure that retrying will not fix (e.g. HTTP 4xx)"""
+
+def _schedule(delay, fn, *args):
+    with _timer_condition:
+        _timer_seq[0] += 1
+        heapq.heappush(_timers, (time.monotonic() + delay, _timer_seq[0], fn, args))
+        _timer_condition.notify()
+
+def _timer_loop():
+    while True:
+        with _timer_condition:
+            while not _timers or _timers[0][0] > time.monotonic():
+                _timer_condition.wait(timeout=_timers[0][0] - time.monotonic() if _timers else None)
+            _, _, fn, args = heapq.heappop(_timers)
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Notification timer failed: {e}")
+
+def _ensure_threads():
+    with _lock:
+        if _threads:
+            return
+        for target in [_timer_loop] + [_worker_loop] * NOTIFY_WORKERS:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            _threads.append(thread)
+
+def _enqueue(channel, kind, payload, attempt=0):
+    """Queue one delivery; never blocks the caller"""
+    try:
+        _queue.put_nowait({'channel': channel, 'kind': kind, 'payload': payload, 'attempt': attempt})
+        return True
+    except queue.Full:
+        _count('dropped')
+        print(f"Notification queue full, dropping {kind} via {channel}")
+        return False
+
+def _fan_out(kind, payload):
+    for channel in ROUTES[kind]:
+        if channel_enabled(channel):
+            _enqueue(channel, kind, payload)
+
+def _http_connection(url):
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=NOTIFY_TIMEOUT_SECONDS)
+
+def _post_json(channel, url, body):
+    """POST JSON on a reused keep-alive connection"""
+    parts = urlsplit(url)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    data = json.dumps(body).encode('utf-8')
+
+    try:
+        conn = _connections[channel].get_nowait()
+    except queue.Empty:
+        conn = _http_connection(url)
+
+    try:
+        conn.request('POST', path, body=data, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+    except (OSError, http.client.HTTPException):
+        conn.close()
+        raise
+
+    if response.will_close:
+        conn.close()
+    else:
+        _connections[channel].put(conn)
+
+    if response.status >= 500 or response.status == 429:
+        raise OSError(f'HTTP {response.status}')
+    if response.status >= 400:
+        raise PermanentError(f'HTTP {response.status}')
+
+def _smtp_connection():
+    conn = smtplib.SMTP(NOTIFY_SMTP_HOST, NOTIFY_SMTP_PORT, timeout=NOTIFY_TIMEOUT_SECONDS)
+    if NOTIFY_SMTP_STARTTLS:
+        conn.starttls()
+    if NOTIFY_SMTP_USER:
+        conn.login(NOTIFY_SMTP_USER, NOTIFY_SMTP_PASSWORD)
+    return conn
+
+def _send_email(subject, text, recipients):
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = NOTIFY_EMAIL_FROM
+    message['To'] = ', '.join(recipients)
+    message.set_content(text)
+
+    try:
+        conn = _connections['email'].get_nowait()
+    except queue.Empty:
+        conn = _smtp_connection()
+
+    try:
+        try:
+            conn.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Idle connection timed out on the server side; reconnect once
+            conn.close()
+            conn = _smtp_connection()
+            conn.send_message(message)
+    except smtplib.SMTPRecipientsRefused as e:
+        _connections['email'].put(conn)
+        raise PermanentError(str(e))
+    except (OSError, smtplib.SMTPException):
+        conn.close()
+        raise
+    _connections['email'].put(conn)
+
+def _alarm_line(alarm):
+    return f"[{alarm['severity'].upper()}] {alarm.get('timestamp', '')} vehicle {alarm['vehicle_id']}: {alarm['message']}"
+
+def _render(kind, payload):
+    """(subject, text) for a notification"""
+    if kind == 'digest':
+        alarms = payload['alarms']
+        lines = [_alarm_line(alarm) for alarm in alarms]
+        if payload.get('omitted'):
+            lines.append(f"... and {payload['omitted']} more")
+        return (f"GPS alarm digest: {len(alarms) + payload.get('omitted', 0)} alarms", '\n'.join(lines))
+    alarm = payload['alarm']
+    prefix = 'ESCALATION - unacknowledged' if kind == 'escalation' else 'Critical alarm'
+    return (f"{prefix}: {alarm['alarm_type']} on vehicle {alarm['vehicle_id']}", _alarm_line(alarm))
+
+def _deliver(channel, kind, payload):
+    subject, text = _render(kind, payload)
+    if channel == 'webhook':
+        _post_json(channel, NOTIFY_WEBHOOK_URL, {'type': kind, **payload})
+    elif channel == 'sms':
+        recipients = NOTIFY_SMS_TO
+        if kind == 'escalation' and NOTIFY_ESCALATION_TO:
+            recipients = [r for r in NOTIFY_ESCALATION_TO if '@' not in r] or NOTIFY_SMS_TO
+        _post_json(channel, NOTIFY_SMS_URL, {'to': recipients, 'message': f'{subject}\n{text}'[:480]})
+    elif channel == 'email':
+        recipients = NOTIFY_EMAIL_TO
+        if kind == 'escalation' and NOTIFY_ESCALATION_TO:
+            recipients = [r for r in NOTIFY_ESCALATION_TO if '@' in r] or NOTIFY_EMAIL_TO
+        _send_email(subject, text, recipients)
+
+def _worker_loop():
+    while True:
+        job = _queue.get()
+        try:
+            with _channel_slots[job['channel']]:
+                _deliver(job['channel'], job['kind'], job['payload'])
+            _count('sent')
+        except PermanentError as e:
+            _count('failed')
+            print(f"Notification via {job['channel']} rejected: {e}")
+        except Exception as e:
+            if job['attempt'] >= NOTIFY_MAX_RETRIES:
+                _count('failed')
+                print(f"Notification via {job['channel']} failed after {job['attempt'] + 1} attempts: {e}")
+            else:
+                # Exponential backoff with jitter, without holding a worker
+                delay = NOTIFY_RETRY_BASE_SECONDS * (2 ** job['attempt']) * random.uniform(0.5, 1.5)
+                _count('retried')
+                _schedule(delay, _enqueue, job['channel'], job['kind'], job['payload'], job['attempt'] + 1)
+        finally:
+            _queue.task_done()
+
+def _send_digest():
+    with _lock:
+        alarms = list(_digest)
+        omitted = _digest_omitted[0]
+        _digest.clear()
+        _digest_omitted[0] = 0
+    if alarms or omitted:
+        _fan_out('digest', {'alarms': alarms, 'omitted': omitted, 'sent_at': datetime.datetime.now().isoformat()})
+
+def _escalate(alarm_id, is_acknowledged):
+    with _lock:
+        alarm = _escalations.pop(alarm_id, None)
+    if alarm is None:
+        return  # Acknowledged through cancel_escalation
+    if is_acknowledged and is_acknowledged(alarm_id):
+        return
+    _fan_out('escalation', {'alarm': alarm})
+
+def notify_alarm(alarm, is_acknowledged=None):
+    """Hand an alarm to the dispatcher; returns immediately
+
+    Critical alarms go out on every configured channel at once and, when
+    they have an id, are escalated after NOTIFY_ESCALATE_MINUTES unless
+    acknowledged first. `is_acknowledged(alarm_id)` is checked before
+    escalating. Other alarms are collected into a digest of at most
+    NOTIFY_DIGEST_MAX alarms; any beyond that are only counted.
+    """
+    if not any(channel_enabled(channel) for channel in CHANNELS):
+        return False
+    _ensure_threads()
+
+    if alarm['severity'] == 'critical':
+        _fan_out('critical', {'alarm': alarm})
+        if alarm.get('id') and NOTIFY_ESCALATE_MINUTES > 0:
+            with _lock:
+                _escalations[alarm['id']] = alarm
+            _schedule(NOTIFY_ESCALATE_MINUTES * 60, _escalate, alarm['id'], is_acknowledged)
+        return True
+
+    with _lock:
+        first = not _digest and not _digest_omitted[0]
+        if len(_digest) < NOTIFY_DIGEST_MAX:
+            _digest.append(alarm)
+        else:
+            _digest_omitted[0] += 1
+    if first:
+        _schedule(NOTIFY_DIGEST_SECONDS, _send_digest)
+    return True
+
+def cancel_escalation(alarm_id):
+    """Stop a pending escalation once its alarm has been acknowledged"""
+    with _lock:
+        return _escalations.pop(alarm_id, None) is not None
+
+def flush_notifications(timeout=None):
+    """Send the pending digest now and wait for the queue to drain (shutdown, tests)"""
+    _send_digest()
+    deadline = time.monotonic() + timeout if timeout else None
+    while _queue.unfinished_tasks:
+        if deadline and time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
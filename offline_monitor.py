@@ -0,0 +1,168 @@
+# Heartbeat-driven device offline/online detection
+import os
+import time
+import heapq
+import sqlite3
+import datetime
+import threading
+from enhanced_alarm import enhanced_log_alarm
+
+DB = 'gps.db'
+
+# Silence after which a device is reported offline
+OFFLINE_AFTER_MINUTES = float(os.getenv('OFFLINE_AFTER_MINUTES', 30))
+
+# vehicle_id -> time.time() of the last packet
+_last_seen = {}
+# Vehicles currently reported offline
+_offline = set()
+# Heap of (deadline, vehicle_id); each vehicle has at most one entry
+_deadlines = []
+_scheduled = set()
+
+_condition = threading.Condition()
+_monitor = []
+
+def _iso(seen):
+    return datetime.datetime.fromtimestamp(seen, datetime.timezone.utc).replace(tzinfo=None).isoformat()
+
+def _schedule(vehicle_id, deadline):
+    """Push a deadline; wakes the monitor if it became the earliest one"""
+    heapq.heappush(_deadlines, (deadline, vehicle_id))
+    _scheduled.add(vehicle_id)
+    if _deadlines[0][1] == vehicle_id:
+        _condition.notify()
+
+def load_last_seen():
+    """Seed last-seen times from gps_data, one indexed lookup per vehicle
+
+    Vehicles that were already silent and whose latest connectivity alarm
+    is device_offline are marked offline without a new alarm, so restarts
+    don't repeat alarms. Vehicles that never reported are not tracked
+    until their first packet.
+    """
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('SELECT id FROM vehicles')
+    vehicle_ids = [row[0] for row in c.fetchall()]
+
+    seen = {}
+    already_offline = set()
+    for vehicle_id in vehicle_ids:
+        c.execute('SELECT MAX(timestamp) FROM gps_data WHERE vehicle_id = ?', (vehicle_id,))
+        last = c.fetchone()[0]
+        if not last:
+            continue
+        try:
+            last_time = datetime.datetime.fromisoformat(last.replace('Z', '+00:00'))
+        except ValueError:
+            continue
+        if last_time.tzinfo is None:
+            last_time = last_time.replace(tzinfo=datetime.timezone.utc)
+        seen[vehicle_id] = last_time.timestamp()
+
+        c.execute('''
+            SELECT alarm_type FROM alarm_logs
+            WHERE vehicle_id = ? AND alarm_type IN ('device_offline', 'device_online')
+            ORDER BY timestamp DESC, id DESC LIMIT 1
+        ''', (vehicle_id,))
+        row = c.fetchone()
+        if row and row[0] == 'device_offline':
+            already_offline.add(vehicle_id)
+    conn.close()
+
+    timeout = OFFLINE_AFTER_MINUTES * 60
+    now = time.time()
+    with _condition:
+        for vehicle_id, last in seen.items():
+            if vehicle_id in _last_seen:
+                continue  # A live packet arrived meanwhile
+            _last_seen[vehicle_id] = last
+            if last + timeout <= now and vehicle_id in already_offline:
+                _offline.add(vehicle_id)
+            elif vehicle_id not in _scheduled:
+                _schedule(vehicle_id, last + timeout)
+
+    return len(seen)
+
+def record_heartbeat(packet):
+    """Packet handler: refresh last-seen and report devices coming back online
+
+    O(1) per packet; a heap entry is only added when the vehicle has none
+    pending, so heap work scales with offline timeouts, not packets.
+    """
+    vehicle_id = packet.get('vehicle_id')
+    if vehicle_id is None:
+        return None
+
+    now = time.time()
+    with _condition:
+        previous = _last_seen.get(vehicle_id)
+        _last_seen[vehicle_id] = now
+        came_back = vehicle_id in _offline
+        _offline.discard(vehicle_id)
+        if vehicle_id not in _scheduled:
+            _schedule(vehicle_id, now + OFFLINE_AFTER_MINUTES * 60)
+
+    if came_back:
+        minutes = (now - previous) / 60 if previous else None
+        enhanced_log_alarm(
+            vehicle_id,
+            'device_online',
+            f"Device back online after {minutes:.0f} minutes" if minutes is not None else 'Device back online',
+            metadata={
+                'last_seen': _iso(previous) if previous else None,
+                'offline_minutes': round(minutes, 1) if minutes is not None else None
+            }
+        )
+        return 'online'
+    return None
+
+def _due_vehicles():
+    """Pop expired deadlines; returns [(vehicle_id, last_seen)] that just went offline"""
+    timeout = OFFLINE_AFTER_MINUTES * 60
+    now = time.time()
+    due = []
+    while _deadlines and _deadlines[0][0] <= now:
+        _, vehicle_id = heapq.heappop(_deadlines)
+        _scheduled.discard(vehicle_id)
+        last = _last_seen.get(vehicle_id)
+        if last is None:
+            continue
+        if last + timeout > now:
+            _schedule(vehicle_id, last + timeout)  # Heard from since; push the real deadline
+        elif vehicle_id not in _offline:
+            _offline.add(vehicle_id)
+            due.append((vehicle_id, last))
+    return due
+
+def _monitor_loop():
+    while True:
+        with _condition:
+            due = _due_vehicles()
+            if not due:
+                wait = _deadlines[0][0] - time.time() if _deadlines else None
+                _condition.wait(timeout=max(wait, 0) if wait is not None else None)
+                continue
+
+        for vehicle_id, last in due:
+            try:
+                enhanced_log_alarm(
+                    vehicle_id,
+                    'device_offline',
+                    f"Device has not reported data for over {OFFLINE_AFTER_MINUTES:.0f} minutes",
+                    metadata={'last_seen': _iso(last)}
+                )
+            except Exception as e:
+                print(f"Error logging offline alarm for vehicle {vehicle_id}: {e}")
+
+def start_offline_monitor():
+    """Seed last-seen times and start the deadline thread (once)"""
+    with _condition:
+        if _monitor:
+            return
+        monitor = threading.Thread(target=_monitor_loop, daemon=True)
+        _monitor.append(monitor)
+
+    load_last_seen()
+    monitor.start()
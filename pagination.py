@@ -0,0 +1,53 @@
+# Opaque keyset cursors for paginated API responses
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(timestamp, row_id):
+    """Encode a (timestamp, id) keyset position as an opaque cursor string"""
+    raw = json.dumps([timestamp, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor back into a (timestamp, id) tuple
+
+    Raises ValueError when the cursor was not produced by encode_cursor.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(timestamp, str) or not isinstance(row_id, int):
+        raise ValueError('Invalid cursor')
+    return timestamp, row_id
+
+def parse_page_args(args, default_limit=DEFAULT_PAGE_SIZE):
+    """Read `limit` and `cursor` query parameters
+
+    Returns (limit, before) where before is the decoded keyset position or
+    None for the first page. Raises ValueError on malformed input.
+    """
+    try:
+        limit = int(args.get('limit', default_limit))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid limit parameter')
+    if limit < 1:
+        raise ValueError('Invalid limit parameter')
+    limit = min(limit, MAX_PAGE_SIZE)
+    cursor = args.get('cursor')
+    before = decode_cursor(cursor) if cursor else None
+    return limit, before
+
+def paginate(items, limit, timestamp_key='timestamp', id_key='id'):
+    """Trim a page fetched with limit + 1 rows and build its next cursor
+
+    Returns (page, next_cursor); next_cursor is None on the last page.
+    """
+    if len(items) <= limit:
+        return items, None
+    page = items[:limit]
+    last = page[-1]
+    return page, encode_cursor(last[timestamp_key], last[id_key])
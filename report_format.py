@@ -0,0 +1,133 @@
+# Compact report responses: columnar layout, fast JSON encoding, compression
+#
+# ?format=columnar turns every list of row objects, including lists nested
+# inside rows, into one array per field, so key names are sent once
+# instead of once per row.
+# Bodies are encoded with orjson when it is installed, and /api/reports/*
+# responses are compressed with brotli or gzip when the client accepts it.
+import os
+import gzip
+import json
+import zlib
+from flask import Response, request, current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies gain too little from compression to be worth the CPU
+COMPRESS_MIN_BYTES = int(os.getenv('REPORT_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # higher qualities compress a little better at several times the cost
+
+REPORT_PATH_PREFIX = '/api/reports/'
+
+def wants_columnar():
+    """Check whether the client asked for columnar report rows (?format=columnar)"""
+    return request.args.get('format', '').lower() == 'columnar'
+
+def to_columns(rows):
+    """{field: [values]} from a list of row dicts; fields missing from a row are None"""
+    fields = {}
+    for row in rows:
+        for field in row:
+            fields.setdefault(field, None)
+    return {field: [row.get(field) for row in rows] for field in fields}
+
+def columnar(payload):
+    """Copy of a report with each list of dicts in columnar form, nested ones too
+
+    Rows are converted before their list is, so e.g. every temperature
+    sensor's `buckets` become columns inside the sensors' columns.
+    """
+    if isinstance(payload, dict):
+        return {key: columnar(value) for key, value in payload.items()}
+    if isinstance(payload, list) and any(isinstance(item, (dict, list)) for item in payload):
+        items = [columnar(item) for item in payload]
+        return to_columns(items) if all(isinstance(item, dict) for item in items) else items
+    return payload
+
+def dumps(payload):
+    """Compact JSON bytes with sorted keys, like jsonify; orjson when available"""
+    default = current_app.json.default
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, default=default,
+                                option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits; the standard encoder handles them
+    return json.dumps(payload, default=default, sort_keys=True, separators=(',', ':')).encode()
+
+def report_json(payload, status=200):
+    """JSON response for a report payload, columnar when requested"""
+    if wants_columnar():
+        payload = columnar(payload)
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+def _encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def _gzip_chunks(chunks):
+    # Flush after every chunk so streamed reports still arrive progressively
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _brotli_chunks(chunks):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    for chunk in chunks:
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+def compress_response(response):
+    """after_request hook: brotli/gzip for JSON report responses
+
+    Buffered bodies under COMPRESS_MIN_BYTES are left alone. Streamed
+    reports are compressed chunk by chunk with the negotiated encoding;
+    files (job results) are sent as they are.
+    """
+    if (not request.path.startswith(REPORT_PATH_PREFIX) or response.mimetype != 'application/json'
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or not 200 <= response.status_code < 300):
+        return response
+
+    encoding = _encoding()
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        chunks = response.iter_encoded()
+        response.response = _brotli_chunks(chunks) if encoding == 'br' else _gzip_chunks(chunks)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(body, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_report_format(app):
+    """Compress report responses of a Flask app"""
+    app.after_request(compress_response)
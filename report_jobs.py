@@ -0,0 +1,330 @@
+# Background report jobs for long date ranges
+import os
+import json
+import uuid
+import time
+import queue
+import threading
+import datetime
+from flask import request, jsonify, send_file, Response
+from report_stream import iter_json_report
+
+# Job execution settings (overridable through the environment)
+JOBS_DIR = os.getenv('REPORT_JOBS_DIR', 'report_jobs')
+JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('REPORT_JOB_QUEUE_SIZE', 50))
+JOB_TTL_HOURS = float(os.getenv('REPORT_JOB_TTL_HOURS', 24))
+
+FINISHED_STATES = ('completed', 'failed', 'cancelled')
+
+# Report builders registered by the app: name -> parts(imei, start_date, end_date)
+_reports = {}
+
+_jobs = {}
+_cancel_events = {}
+_jobs_lock = threading.Lock()
+_job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_workers = []
+
+class JobCancelled(Exception):
+    pass
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
+
+def _parse_time(value):
+    """Parse an ISO date/datetime string into a naive datetime, or None"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed.replace(tzinfo=None)
+
+def _result_path(job_id):
+    return os.path.join(JOBS_DIR, f'{job_id}.json')
+
+def _meta_path(job_id):
+    return os.path.join(JOBS_DIR, f'{job_id}.meta.json')
+
+def _save_meta(job):
+    """Persist job metadata so finished jobs survive a restart"""
+    tmp_path = _meta_path(job['id']) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, _meta_path(job['id']))
+
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job.update(fields)
+        snapshot = dict(job)
+    if snapshot['status'] in FINISHED_STATES:
+        _save_meta(snapshot)
+    return snapshot
+
+def get_job(job_id):
+    """Get a job's status, falling back to metadata persisted on disk"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job:
+            return dict(job)
+    try:
+        with open(_meta_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_jobs():
+    """List jobs known to this process, newest first"""
+    with _jobs_lock:
+        jobs = [dict(job) for job in _jobs.values()]
+    return sorted(jobs, key=lambda job: job['created_at'], reverse=True)
+
+def cleanup_expired_jobs():
+    """Delete finished jobs and result files older than the TTL
+
+    Files of queued and running jobs are kept whatever their age: a long
+    job can write its .tmp result for longer than the TTL.
+    """
+    if not os.path.isdir(JOBS_DIR):
+        return
+    cutoff = time.time() - JOB_TTL_HOURS * 3600
+    cutoff_time = datetime.datetime.utcnow() - datetime.timedelta(hours=JOB_TTL_HOURS)
+
+    with _jobs_lock:
+        expired = [job_id for job_id, job in _jobs.items()
+                   if job['status'] in FINISHED_STATES and job.get('finished_at')
+                   and _parse_time(job['finished_at']) < cutoff_time]
+        for job_id in expired:
+            del _jobs[job_id]
+            _cancel_events.pop(job_id, None)
+        active = {job_id for job_id, job in _jobs.items() if job['status'] not in FINISHED_STATES}
+
+    for name in os.listdir(JOBS_DIR):
+        # <job id>.json, <job id>.meta.json and their .tmp files
+        if name.split('.', 1)[0] in active:
+            continue
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def _track_progress(job_id, items, start, end, cancel_event):
+    """Pass items through while updating progress and honouring cancellation"""
+    span = (end - start).total_seconds() if start and end and end > start else None
+    count = 0
+    last_update = 0.0
+
+    for item in items:
+        if cancel_event.is_set():
+            raise JobCancelled()
+        count += 1
+        yield item
+
+        now = time.monotonic()
+        if now - last_update < 0.5:
+            continue
+        last_update = now
+
+        progress = None
+        if span:
+            stamp = _parse_time(item.get('start_time') or item.get('timestamp') or item.get('date'))
+            if stamp:
+                progress = round(min(max((stamp - start).total_seconds() / span, 0.0), 0.99), 2)
+        _update_job(job_id, items=count, progress=progress)
+
+    _update_job(job_id, items=count)
+
+def _run_job(job_id):
+    job = get_job(job_id)
+    cancel_event = _cancel_events.get(job_id)
+    if job is None or cancel_event is None or cancel_event.is_set():
+        return
+
+    _update_job(job_id, status='running', started_at=_now(), progress=0.0)
+
+    start = _parse_time(job['start_date'])
+    end = _parse_time(job['end_date']) or datetime.datetime.utcnow()
+    header = {'imei': job['imei'], 'start_date': job['start_date'], 'end_date': job['end_date']}
+    tmp_path = _result_path(job_id) + '.tmp'
+
+    try:
+        key, items, trailer = _reports[job['report']](job['imei'], job['start_date'], job['end_date'])
+        items = _track_progress(job_id, items, start, end, cancel_event)
+        with open(tmp_path, 'w') as f:
+            for chunk in iter_json_report(header, key, items, trailer):
+                f.write(chunk)
+        os.replace(tmp_path, _result_path(job_id))
+        _update_job(job_id, status='completed', progress=1.0, finished_at=_now())
+    except JobCancelled:
+        _update_job(job_id, status='cancelled', finished_at=_now())
+    except Exception as e:
+        print(f"Report job {job_id} failed: {e}")
+        _update_job(job_id, status='failed', error=str(e), finished_at=_now())
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _worker_loop():
+    while True:
+        job_id = _job_queue.get()
+        try:
+            _run_job(job_id)
+        finally:
+            _job_queue.task_done()
+
+def _ensure_workers():
+    with _jobs_lock:
+        while len(_workers) < JOB_WORKERS:
+            worker = threading.Thread(target=_worker_loop, daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+def submit_job(report, imei, start_date=None, end_date=None):
+    """Queue a report job and return its status record
+
+    Raises ValueError for an unknown report type and queue.Full when the
+    job queue is at capacity.
+    """
+    if report not in _reports:
+        raise ValueError(f'Unknown report type: {report}')
+
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    cleanup_expired_jobs()
+    _ensure_workers()
+
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'report': report,
+        'imei': imei,
+        'start_date': start_date,
+        'end_date': end_date,
+        'status': 'queued',
+        'progress': 0.0,
+        'items': 0,
+        'error': None,
+        'created_at': _now(),
+        'started_at': None,
+        'finished_at': None
+    }
+
+    with _jobs_lock:
+        _jobs[job_id] = job
+        _cancel_events[job_id] = threading.Event()
+
+    try:
+        _job_queue.put_nowait(job_id)
+    except queue.Full:
+        with _jobs_lock:
+            del _jobs[job_id]
+            del _cancel_events[job_id]
+        raise
+
+    return dict(job)
+
+def cancel_job(job_id):
+    """Cancel a queued or running job; returns False if it cannot be cancelled"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        cancel_event = _cancel_events.get(job_id)
+        if not job or not cancel_event or job['status'] in FINISHED_STATES:
+            return False
+        cancel_event.set()
+        queued = job['status'] == 'queued'
+
+    # Queued jobs never reach the worker body, so finish them here
+    if queued:
+        _update_job(job_id, status='cancelled', finished_at=_now())
+    return True
+
+def add_report_job_routes(app, reports, get_vehicle_id_from_imei):
+    """Add report job routes to Flask app
+
+    `reports` maps report names to builders returning (key, items, trailer),
+    the same builders that serve the synchronous report routes.
+    """
+    _reports.update(reports)
+
+    @app.route('/api/reports/jobs', methods=['GET', 'POST'])
+    def report_jobs_api():
+        if request.method == 'GET':
+            return jsonify({'jobs': list_jobs()})
+
+        data = request.get_json() or {}
+        report = data.get('report')
+        imei = data.get('imei')
+
+        if not report or not imei:
+            return jsonify({'error': 'report and imei are required'}), 400
+        # Checked up front so an unknown vehicle isn't queued to fail in a worker
+        if not get_vehicle_id_from_imei(imei):
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        try:
+            job = submit_job(report, imei, data.get('start_date'), data.get('end_date'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except queue.Full:
+            return jsonify({'error': 'Report job queue is full, try again later'}), 503
+
+        return jsonify({
+            'job': job,
+            'status_url': f"/api/reports/jobs/{job['id']}",
+            'result_url': f"/api/reports/jobs/{job['id']}/result"
+        }), 202
+
+    @app.route('/api/reports/jobs/<job_id>', methods=['GET'])
+    def report_job_status_api(job_id):
+        job = get_job(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify({'job': job})
+
+    @app.route('/api/reports/jobs/<job_id>', methods=['DELETE'])
+    def cancel_report_job_api(job_id):
+        if not get_job(job_id):
+            return jsonify({'error': 'Job not found'}), 404
+        if not cancel_job(job_id):
+            return jsonify({'error': 'Job has already finished'}), 409
+        return jsonify({'success': True, 'message': 'Job cancelled'})
+
+    @app.route('/api/reports/jobs/<job_id>/result')
+    def report_job_result_api(job_id):
+        job = get_job(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        if job['status'] != 'completed':
+            return jsonify({'error': f"Job is {job['status']}", 'job': job}), 409
+
+        path = os.path.abspath(_result_path(job_id))
+        if not os.path.exists(path):
+            return jsonify({'error': 'Job result has expired'}), 410
+        return send_file(path, mimetype='application/json', as_attachment=True,
+                         download_name=f"{job['report']}_{job['imei']}.json")
+
+    @app.route('/api/reports/jobs/<job_id>/events')
+    def report_job_events_api(job_id):
+        """Server-Sent Events stream of job progress until it finishes"""
+        if not get_job(job_id):
+            return jsonify({'error': 'Job not found'}), 404
+
+        def generate():
+            last = None
+            while True:
+                job = get_job(job_id)
+                if job is None:
+                    return
+                if job != last:
+                    yield f"data: {json.dumps(job)}\n\n"
+                    last = job
+                if job['status'] in FINISHED_STATES:
+                    return
+                time.sleep(1)
+
+        return Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,83 @@
+# Streaming helpers for large report payloads
+import sqlite3
+import json
+from flask import Response, request
+
+# Rows pulled from SQLite per fetchmany() call
+FETCH_SIZE = 500
+
+# Serialized items buffered before a chunk is written to the response
+CHUNK_ITEMS = 200
+
+def wants_stream():
+    """Check whether the client asked for a streamed report (?stream=true)"""
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+def iter_query(db, query, params=(), size=FETCH_SIZE):
+    """Execute a query and yield its rows in fetchmany batches
+
+    The connection stays open until the generator is exhausted or closed,
+    so only one batch of rows is held in memory at a time.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        c = conn.cursor()
+        c.execute(query, params)
+        while True:
+            rows = c.fetchmany(size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def new_stats():
+    """Create an empty running min/max/avg accumulator"""
+    return {'count': 0, 'total': 0.0, 'min': None, 'max': None}
+
+def update_stats(stats, value):
+    """Fold a value into a running accumulator, ignoring None"""
+    if value is None:
+        return
+    stats['count'] += 1
+    stats['total'] += value
+    if stats['min'] is None or value < stats['min']:
+        stats['min'] = value
+    if stats['max'] is None or value > stats['max']:
+        stats['max'] = value
+
+def stats_average(stats):
+    """Average of a running accumulator, or None when empty"""
+    return stats['total'] / stats['count'] if stats['count'] else None
+
+def iter_json_report(header, key, items, trailer):
+    """Serialize a report as JSON text chunks without materializing it
+
+    The output has the same shape as the buffered report: the header
+    fields, then `key` holding the array of items, then the fields returned
+    by `trailer()`, which is called after the last item has been written so
+    it can report totals accumulated while iterating.
+    """
+    yield json.dumps(header)[:-1] + ', ' + json.dumps(key) + ': ['
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(json.dumps(item))
+        if len(buffer) >= CHUNK_ITEMS:
+            yield ('' if first else ', ') + ', '.join(buffer)
+            first = False
+            buffer = []
+    if buffer:
+        yield ('' if first else ', ') + ', '.join(buffer)
+    yield '], ' + json.dumps(trailer())[1:]
+
+def stream_json_report(header, key, items, trailer):
+    """Stream a report as one JSON object in a chunked Flask response"""
+    return Response(iter_json_report(header, key, items, trailer), mimetype='application/json')
+
+def build_report(header, key, items, trailer):
+    """Buffered counterpart of stream_json_report: build the report dict"""
+    report = dict(header)
+    report[key] = list(items)
+    report.update(trailer())
+    return report
@@ -0,0 +1,500 @@
+# Planned routes for trip requests: corridor monitoring and adherence
+import os
+import json
+import math
+import heapq
+import sqlite3
+import datetime
+import threading
+from flask import request, jsonify
+from enhanced_alarm import enhanced_log_alarm
+from route_track import encode_polyline, decode_polyline
+from trip_assignment import complete_trip_request
+
+DB = 'gps.db'
+
+# Time outside the corridor before a route_deviation alarm
+ROUTE_DEVIATION_SECONDS = float(os.getenv('ROUTE_DEVIATION_SECONDS', 30))
+# Time stopped away from planned stops before an unscheduled_stop alarm
+ROUTE_STOP_MINUTES = float(os.getenv('ROUTE_STOP_MINUTES', 5))
+# Default corridor half-width when a route is attached without one
+DEFAULT_CORRIDOR_M = float(os.getenv('ROUTE_CORRIDOR_M', 200))
+# Gaps longer than this are not counted toward adherence
+ADHERENCE_MAX_GAP_SECONDS = 120
+
+# Same movement rule as the trip report
+MOVING_SPEED_KMH = 1.0
+# Entries per R-tree node
+RTREE_NODE_SIZE = 8
+
+# vehicle_id -> active route: {'trip_request_id', 'corridor_m', 'stops', 'index', ...}
+_active = {}
+# vehicle_id -> {'off_since', 'deviation_alarmed', 'stop_since', 'stop_alarmed', 'max_deviation_m'}
+_states = {}
+_lock = threading.Lock()
+
+def init_route_plan_db():
+    """Create the planned route table"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trip_routes (
+            trip_request_id INTEGER PRIMARY KEY,
+            vehicle_id INTEGER,
+            polyline TEXT,
+            corridor_m REAL,
+            stops TEXT,
+            status TEXT DEFAULT 'active',
+            started_at TEXT,
+            ended_at TEXT,
+            adherence_pct REAL,
+            max_deviation_m REAL,
+            created_at TEXT,
+            FOREIGN KEY (trip_request_id) REFERENCES trip_requests(id),
+            FOREIGN KEY (vehicle_id) REFERENCES vehicles(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_trip_routes_status_vehicle ON trip_routes (status, vehicle_id)')
+
+    conn.commit()
+    conn.close()
+
+# --- Segment index ---
+
+def _projector(points):
+    """Local equirectangular projection to meters, centred on the route"""
+    lat0 = sum(p[0] for p in points) / len(points)
+    lon0 = sum(p[1] for p in points) / len(points)
+    kx = 111320.0 * math.cos(math.radians(lat0))
+
+    def project(lat, lon):
+        return (lon - lon0) * kx, (lat - lat0) * 110540.0
+    return project
+
+def _segment_distance(px, py, segment):
+    """Distance from a point to a projected segment, and the position along it (0-1)"""
+    ax, ay, bx, by = segment
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    t = 0.0 if length2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy)), t
+
+def _box_distance(px, py, box):
+    dx = max(box[0] - px, 0.0, px - box[2])
+    dy = max(box[1] - py, 0.0, py - box[3])
+    return math.hypot(dx, dy)
+
+def _str_pack(entries):
+    """One level of Sort-Tile-Recursive packing: entries are (box, child)"""
+    slices = math.ceil(math.sqrt(math.ceil(len(entries) / RTREE_NODE_SIZE)))
+    per_slice = slices * RTREE_NODE_SIZE
+    entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+    nodes = []
+    for s in range(0, len(entries), per_slice):
+        column = sorted(entries[s:s + per_slice], key=lambda e: e[0][1] + e[0][3])
+        for n in range(0, len(column), RTREE_NODE_SIZE):
+            group = column[n:n + RTREE_NODE_SIZE]
+            box = (min(e[0][0] for e in group), min(e[0][1] for e in group),
+                   max(e[0][2] for e in group), max(e[0][3] for e in group))
+            nodes.append((box, group))
+    return nodes
+
+def build_segment_index(points):
+    """STR-packed R-tree over the route's segments
+
+    Leaves hold segment numbers; every node is (box, [(box, child), ...]).
+    A single-point route becomes one zero-length segment.
+    """
+    project = _projector(points)
+    xy = [project(lat, lon) for lat, lon in points]
+    if len(xy) == 1:
+        xy = xy * 2
+
+    segments = [(xy[i][0], xy[i][1], xy[i + 1][0], xy[i + 1][1]) for i in range(len(xy) - 1)]
+    # Cumulative length at the start of each segment, for progress along the route
+    offsets = [0.0]
+    for ax, ay, bx, by in segments:
+        offsets.append(offsets[-1] + math.hypot(bx - ax, by - ay))
+
+    level = [((min(s[0], s[2]), min(s[1], s[3]), max(s[0], s[2]), max(s[1], s[3])), i)
+             for i, s in enumerate(segments)]
+    level = _str_pack(level)
+    while len(level) > 1:
+        level = _str_pack(level)
+
+    return {'project': project, 'segments': segments, 'offsets': offsets, 'root': level[0]}
+
+def nearest_segment(index, lat, lon):
+    """(distance_m, segment number, meters along the route) for the closest segment
+
+    Best-first search: nodes come off the heap in order of their box
+    distance, so the first segment popped is the nearest and only the
+    branches near the point are visited (O(log n) for a typical route).
+    """
+    px, py = index['project'](lat, lon)
+    heap = [(0.0, 0, False, index['root'])]
+    counter = 1
+    while heap:
+        distance, _, is_segment, item = heapq.heappop(heap)
+        if is_segment:
+            segment_distance, t = item[1]
+            number = item[0]
+            length = index['offsets'][number + 1] - index['offsets'][number]
+            return segment_distance, number, index['offsets'][number] + t * length
+        for box, child in item[1]:
+            if isinstance(child, int):
+                exact = _segment_distance(px, py, index['segments'][child])
+                heapq.heappush(heap, (exact[0], counter, True, (child, exact)))
+            else:
+                heapq.heappush(heap, (_box_distance(px, py, box), counter, False, (box, child)))
+            counter += 1
+    return None
+
+# --- Routes ---
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+def _parse_timestamp(value):
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        return datetime.datetime.utcnow()
+
+def _prepare(row):
+    """Turn a trip_routes row into a route dict with its segment index"""
+    trip_request_id, vehicle_id, polyline, corridor_m, stops, status, started_at, ended_at, \
+        adherence_pct, max_deviation_m, created_at = row
+    points = decode_polyline(polyline)
+    planned_stops = json.loads(stops) if stops else []
+    # The start and end of the route are always allowed stops
+    allowed = [{'lat': points[0][0], 'lon': points[0][1], 'radius_m': corridor_m},
+               {'lat': points[-1][0], 'lon': points[-1][1], 'radius_m': corridor_m}]
+    allowed += [{'lat': s['lat'], 'lon': s['lon'], 'radius_m': s.get('radius_m', corridor_m)} for s in planned_stops]
+    return {
+        'trip_request_id': trip_request_id,
+        'vehicle_id': vehicle_id,
+        'polyline': polyline,
+        'points': points,
+        'corridor_m': corridor_m,
+        'stops': planned_stops,
+        'allowed_stops': allowed,
+        'status': status,
+        'started_at': started_at,
+        'ended_at': ended_at,
+        'adherence_pct': adherence_pct,
+        'max_deviation_m': max_deviation_m,
+        'created_at': created_at,
+        'index': build_segment_index(points)
+    }
+
+ROUTE_COLUMNS = '''trip_request_id, vehicle_id, polyline, corridor_m, stops, status, started_at, ended_at,
+                   adherence_pct, max_deviation_m, created_at'''
+
+def _load_route(trip_request_id):
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute(f'SELECT {ROUTE_COLUMNS} FROM trip_routes WHERE trip_request_id = ?', (trip_request_id,))
+    row = c.fetchone()
+    conn.close()
+    return _prepare(row) if row else None
+
+def load_route_plans():
+    """Load every active planned route into memory"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute(f"SELECT {ROUTE_COLUMNS} FROM trip_routes WHERE status = 'active' ORDER BY started_at")
+    rows = c.fetchall()
+    conn.close()
+
+    with _lock:
+        _active.clear()
+        _states.clear()
+        for row in rows:
+            route = _prepare(row)
+            _active[route['vehicle_id']] = route
+
+    return len(rows)
+
+def _parse_points(data):
+    """Route points from an encoded `polyline` or a `points` list of [lat, lon]"""
+    if data.get('polyline'):
+        try:
+            points = decode_polyline(data['polyline'])
+        except (IndexError, TypeError):
+            raise ValueError('polyline is not a valid encoded polyline')
+    else:
+        try:
+            points = [(float(lat), float(lon)) for lat, lon in data.get('points') or []]
+        except (TypeError, ValueError):
+            raise ValueError('points must be a list of [lat, lon] pairs')
+    if len(points) < 2:
+        raise ValueError('a route needs at least two points')
+    for lat, lon in points:
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError('route point out of range')
+    return points
+
+def _parse_stops(stops):
+    if stops is None:
+        return []
+    if not isinstance(stops, list):
+        raise ValueError('stops must be a list')
+    parsed = []
+    for stop in stops:
+        try:
+            entry = {'lat': float(stop['lat']), 'lon': float(stop['lon'])}
+            if stop.get('radius_m') is not None:
+                entry['radius_m'] = float(stop['radius_m'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('each stop needs numeric lat and lon (radius_m optional)')
+        parsed.append(entry)
+    return parsed
+
+def attach_route(trip_request_id, data):
+    """Attach a planned route to a trip request and start monitoring it
+
+    Raises LookupError when the trip request doesn't exist and ValueError
+    for invalid input or a vehicle already running another route.
+    """
+    points = _parse_points(data)
+    stops = _parse_stops(data.get('stops'))
+    corridor_m = float(data.get('corridor_m') or DEFAULT_CORRIDOR_M)
+    if corridor_m <= 0:
+        raise ValueError('corridor_m must be positive')
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('SELECT vehicle_id FROM trip_requests WHERE id = ?', (trip_request_id,))
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        raise LookupError('Trip request not found')
+    vehicle_id = data.get('vehicle_id') or row[0]
+    if not vehicle_id:
+        conn.close()
+        raise ValueError('vehicle_id is required when the trip request has no vehicle')
+    try:
+        vehicle_id = int(vehicle_id)
+    except (TypeError, ValueError):
+        conn.close()
+        raise ValueError('vehicle_id must be an integer')
+
+    with _lock:
+        current = _active.get(vehicle_id)
+    if current and current['trip_request_id'] != trip_request_id:
+        conn.close()
+        raise ValueError(f"vehicle {vehicle_id} is already on the route of trip request {current['trip_request_id']}")
+
+    now = datetime.datetime.utcnow().isoformat()
+    c.execute('''
+        INSERT OR REPLACE INTO trip_routes
+            (trip_request_id, vehicle_id, polyline, corridor_m, stops, status, started_at, created_at)
+        VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
+    ''', (trip_request_id, vehicle_id, encode_polyline(points), corridor_m, json.dumps(stops),
+          data.get('start_time') or now, now))
+    conn.commit()
+    conn.close()
+
+    route = _load_route(trip_request_id)
+    with _lock:
+        # Re-attaching to another vehicle stops monitoring the previous one
+        for previous_id, previous in list(_active.items()):
+            if previous['trip_request_id'] == trip_request_id and previous_id != vehicle_id:
+                del _active[previous_id]
+                _states.pop(previous_id, None)
+        _active[vehicle_id] = route
+        _states.pop(vehicle_id, None)
+    return route
+
+def evaluate_route(packet):
+    """Packet handler: check a vehicle on a planned route against its corridor
+
+    One nearest-segment lookup per packet. route_deviation fires once per
+    excursion, after ROUTE_DEVIATION_SECONDS outside the corridor.
+    unscheduled_stop fires once per stop, after ROUTE_STOP_MINUTES stopped
+    away from the route ends and planned stops.
+    """
+    vehicle_id = packet.get('vehicle_id')
+    lat, lon = packet.get('lat'), packet.get('lon')
+    if vehicle_id is None or lat is None or lon is None:
+        return []
+
+    with _lock:
+        route = _active.get(vehicle_id)
+    if route is None:
+        return []
+
+    now = _parse_timestamp(packet.get('timestamp'))
+    distance, segment, along = nearest_segment(route['index'], lat, lon)
+    speed = packet.get('speed')
+    alarms = []
+
+    with _lock:
+        if _active.get(vehicle_id) is not route:
+            return []
+        state = _states.setdefault(vehicle_id, {'off_since': None, 'deviation_alarmed': False,
+                                                'stop_since': None, 'stop_alarmed': False, 'max_deviation_m': 0.0})
+
+        if distance > route['corridor_m']:
+            state['max_deviation_m'] = max(state['max_deviation_m'], distance)
+            if state['off_since'] is None:
+                state['off_since'] = now
+            elif not state['deviation_alarmed'] and (now - state['off_since']).total_seconds() >= ROUTE_DEVIATION_SECONDS:
+                state['deviation_alarmed'] = True
+                alarms.append('route_deviation')
+        else:
+            state['off_since'] = None
+            state['deviation_alarmed'] = False
+
+        if speed is not None and speed < MOVING_SPEED_KMH:
+            if state['stop_since'] is None:
+                state['stop_since'] = now
+            elif not state['stop_alarmed'] and (now - state['stop_since']).total_seconds() >= ROUTE_STOP_MINUTES * 60:
+                state['stop_alarmed'] = True
+                if not any(_haversine_m(lat, lon, stop['lat'], stop['lon']) <= stop['radius_m']
+                           for stop in route['allowed_stops']):
+                    alarms.append('unscheduled_stop')
+        elif speed is not None:
+            state['stop_since'] = None
+            state['stop_alarmed'] = False
+        stop_since = state['stop_since']
+
+    metadata = {
+        'trip_request_id': route['trip_request_id'],
+        'distance_from_route_m': round(distance, 1),
+        'corridor_m': route['corridor_m'],
+        'route_progress_m': round(along, 1),
+        'latitude': lat,
+        'longitude': lon,
+        'timestamp': packet.get('timestamp')
+    }
+    for alarm_type in alarms:
+        if alarm_type == 'route_deviation':
+            message = f"Vehicle is {distance:.0f} m off the planned route (corridor {route['corridor_m']:.0f} m)"
+        else:
+            minutes = (now - stop_since).total_seconds() / 60
+            message = f"Unscheduled stop for {minutes:.0f} minutes on trip request {route['trip_request_id']}"
+        enhanced_log_alarm(vehicle_id, alarm_type, message, metadata=metadata)
+
+    return alarms
+
+def compute_adherence(route, end_time=None):
+    """Share of moving time inside the corridor, from the stored track
+
+    Each fix's status covers the time until the next fix (gaps over
+    ADHERENCE_MAX_GAP_SECONDS are ignored).
+    """
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT timestamp, latitude, longitude, speed FROM gps_data
+        WHERE vehicle_id = ? AND timestamp >= ? AND timestamp <= ?
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY timestamp
+    ''', (route['vehicle_id'], route['started_at'], end_time or route['ended_at'] or datetime.datetime.utcnow().isoformat()))
+    rows = c.fetchall()
+    conn.close()
+
+    inside = total = 0.0
+    max_deviation = 0.0
+    points = 0
+    for current, following in zip(rows, rows[1:]):
+        if (current[3] or 0) <= MOVING_SPEED_KMH:
+            continue
+        seconds = (_parse_timestamp(following[0]) - _parse_timestamp(current[0])).total_seconds()
+        if not 0 < seconds <= ADHERENCE_MAX_GAP_SECONDS:
+            continue
+        distance = nearest_segment(route['index'], current[1], current[2])[0]
+        max_deviation = max(max_deviation, distance)
+        total += seconds
+        points += 1
+        if distance <= route['corridor_m']:
+            inside += seconds
+
+    return {
+        'adherence_pct': round(inside / total * 100, 1) if total else None,
+        'max_deviation_m': round(max_deviation, 1),
+        'moving_seconds': total,
+        'points_checked': points
+    }
+
+def complete_route(trip_request_id, end_time=None):
+    """Stop monitoring a route and store its adherence; None if not found
+
+    The trip request is completed too, which frees its vehicle for new
+    assignments.
+    """
+    route = _load_route(trip_request_id)
+    if route is None:
+        return None
+
+    ended_at = route['ended_at'] or end_time or datetime.datetime.utcnow().isoformat()
+    result = compute_adherence(route, ended_at)
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        UPDATE trip_routes SET status = 'completed', ended_at = ?, adherence_pct = ?, max_deviation_m = ?
+        WHERE trip_request_id = ?
+    ''', (ended_at, result['adherence_pct'], result['max_deviation_m'], trip_request_id))
+    conn.commit()
+    conn.close()
+    complete_trip_request(trip_request_id, ended_at)
+
+    with _lock:
+        if _active.get(route['vehicle_id'], {}).get('trip_request_id') == trip_request_id:
+            del _active[route['vehicle_id']]
+            _states.pop(route['vehicle_id'], None)
+
+    route.update(status='completed', ended_at=ended_at, **result)
+    return route
+
+def _route_json(route, adherence=None):
+    return {
+        'trip_request_id': route['trip_request_id'],
+        'vehicle_id': route['vehicle_id'],
+        'polyline': route['polyline'],
+        'corridor_m': route['corridor_m'],
+        'stops': route['stops'],
+        'status': route['status'],
+        'started_at': route['started_at'],
+        'ended_at': route['ended_at'],
+        'adherence_pct': route['adherence_pct'],
+        'max_deviation_m': route['max_deviation_m'],
+        **(adherence or {})
+    }
+
+def add_route_plan_routes(app):
+    """Add planned route routes to Flask app"""
+
+    @app.route('/api/trip_requests/<int:trip_request_id>/route', methods=['GET', 'PUT'])
+    def trip_route_api(trip_request_id):
+        if request.method == 'PUT':
+            data = request.get_json()
+            if not data:
+                return jsonify({'error': 'No route data provided'}), 400
+            try:
+                route = attach_route(trip_request_id, data)
+            except LookupError as e:
+                return jsonify({'error': str(e)}), 404
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(_route_json(route))
+
+        route = _load_route(trip_request_id)
+        if route is None:
+            return jsonify({'error': 'No route for this trip request'}), 404
+        # Active routes report adherence so far
+        return jsonify(_route_json(route, compute_adherence(route) if route['status'] == 'active' else None))
+
+    @app.route('/api/trip_requests/<int:trip_request_id>/route/complete', methods=['POST'])
+    def complete_trip_route_api(trip_request_id):
+        data = request.get_json(silent=True) or {}
+        route = complete_route(trip_request_id, data.get('end_time'))
+        if route is None:
+            return jsonify({'error': 'No route for this trip request'}), 404
+        return jsonify(_route_json(route))
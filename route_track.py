@@ -0,0 +1,317 @@
+# Route playback: simplified, polyline-encoded vehicle tracks
+import sys
+import sqlite3
+import datetime
+import math
+import numpy as np
+from flask import request, jsonify
+
+DB = 'gps.db'
+
+# Simplification error allowed on screen, in pixels at the requested zoom
+TOLERANCE_PIXELS = 1.0
+DEFAULT_ZOOM = 14
+MAX_ZOOM = 20
+
+# Zoom levels precomputed for closed days (see precompute_route_tracks)
+PRECOMPUTE_ZOOMS = (10, 13, 16)
+
+def init_route_track_db():
+    """Create the cache table for simplified closed-day tracks"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS route_track_cache (
+            vehicle_id INTEGER,
+            day TEXT,
+            zoom INTEGER,
+            polyline TEXT,
+            point_count INTEGER,
+            original_count INTEGER,
+            start_time TEXT,
+            end_time TEXT,
+            created_at TEXT,
+            PRIMARY KEY (vehicle_id, day, zoom)
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+def zoom_tolerance_m(zoom, latitude):
+    """Ground distance covered by TOLERANCE_PIXELS at a web-mercator zoom level"""
+    meters_per_pixel = 156543.03392 * math.cos(math.radians(latitude)) / (2 ** zoom)
+    return meters_per_pixel * TOLERANCE_PIXELS
+
+def _project(latlon):
+    """Project (lat, lon) pairs to local equirectangular meters"""
+    lat0 = math.radians(float(np.mean(latlon[:, 0])))
+    x = latlon[:, 1] * 111320.0 * math.cos(lat0)
+    y = latlon[:, 0] * 110540.0
+    return np.column_stack((x, y))
+
+def simplify_track(latlon, tolerance_m):
+    """Douglas-Peucker simplification; returns indexes of the points to keep
+
+    Distances are measured to the segment (not the infinite line), so
+    out-and-back legs are preserved. Uses an explicit stack and vectorized
+    distance computation per split, so day-long 1 Hz tracks stay fast.
+    """
+    n = len(latlon)
+    if n < 3:
+        return np.arange(n)
+
+    xy = _project(latlon)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        a = xy[first]
+        d = xy[last] - a
+        seg = xy[first + 1:last] - a
+        length_sq = d[0] * d[0] + d[1] * d[1]
+        if length_sq == 0:
+            dist = np.hypot(seg[:, 0], seg[:, 1])
+        else:
+            t = np.clip((seg[:, 0] * d[0] + seg[:, 1] * d[1]) / length_sq, 0.0, 1.0)
+            dist = np.hypot(seg[:, 0] - t * d[0], seg[:, 1] - t * d[1])
+
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance_m:
+            index = first + 1 + i
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return np.flatnonzero(keep)
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+def encode_polyline(points, precision=5):
+    """Encode (lat, lon) pairs with the Google encoded polyline algorithm"""
+    factor = 10 ** precision
+    output = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        lat_i = int(round(lat * factor))
+        lon_i = int(round(lon * factor))
+        output.append(_encode_value(lat_i - prev_lat))
+        output.append(_encode_value(lon_i - prev_lon))
+        prev_lat, prev_lon = lat_i, lon_i
+    return ''.join(output)
+
+def decode_polyline(polyline, precision=5):
+    """Decode an encoded polyline back into (lat, lon) pairs"""
+    factor = 10 ** precision
+    points = []
+    index = lat = lon = 0
+    while index < len(polyline):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(polyline[index]) - 63
+                index += 1
+                result |= (b & 0x1f) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+def _load_points(vehicle_id, start, end):
+    # Stored timestamps separate date and time with either 'T' or ' ', which
+    # don't compare as strings against one another. The whole days pick the
+    # rows through the index; the exact bounds apply to a normalized copy.
+    first_day = start.date().isoformat()
+    after_last_day = (end.date() + datetime.timedelta(days=1)).isoformat()
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT timestamp, latitude, longitude FROM gps_data
+        WHERE vehicle_id = ? AND timestamp >= ? AND timestamp < ?
+          AND replace(timestamp, 'T', ' ') >= ? AND replace(timestamp, 'T', ' ') < ?
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY timestamp
+    ''', (vehicle_id, first_day, after_last_day, start.isoformat(sep=' '), end.isoformat(sep=' ')))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def build_track(vehicle_id, start, end, zoom):
+    """Load raw points for a [start, end) naive UTC window and return a simplified track segment"""
+    rows = _load_points(vehicle_id, start, end)
+    if not rows:
+        return None
+
+    latlon = np.array([(r[1], r[2]) for r in rows], dtype=float)
+    tolerance = zoom_tolerance_m(zoom, float(np.mean(latlon[:, 0])))
+    keep = simplify_track(latlon, tolerance)
+
+    return {
+        'polyline': encode_polyline(latlon[keep].tolist()),
+        'points': int(len(keep)),
+        'original_points': len(rows),
+        'start_time': rows[0][0],
+        'end_time': rows[-1][0]
+    }
+
+def _cached_day_track(vehicle_id, day, zoom):
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT polyline, point_count, original_count, start_time, end_time
+        FROM route_track_cache WHERE vehicle_id = ? AND day = ? AND zoom = ?
+    ''', (vehicle_id, day, zoom))
+    row = c.fetchone()
+    conn.close()
+
+    # Rows without a polyline are "no data" markers from older versions; a
+    # closed day can still receive late or backfilled points, so rebuild them
+    if row and row[0] is not None:
+        polyline, points, original_points, start_time, end_time = row
+        return {
+            'polyline': polyline,
+            'points': points,
+            'original_points': original_points,
+            'start_time': start_time,
+            'end_time': end_time
+        }
+
+    day_start = datetime.datetime.fromisoformat(day)
+    track = build_track(vehicle_id, day_start, day_start + datetime.timedelta(days=1), zoom)
+    if track is None:
+        return None  # Empty days aren't cached
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        INSERT OR REPLACE INTO route_track_cache
+            (vehicle_id, day, zoom, polyline, point_count, original_count, start_time, end_time, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (vehicle_id, day, zoom, track['polyline'], track['points'], track['original_points'],
+          track['start_time'], track['end_time'], datetime.datetime.utcnow().isoformat()))
+    conn.commit()
+    conn.close()
+
+    return track
+
+def parse_time(value):
+    """ISO date or datetime as a naive UTC datetime (offsets such as Z are converted)"""
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def get_route(vehicle_id, start, end, zoom=DEFAULT_ZOOM):
+    """Simplified track for [start, end) naive UTC datetimes as one polyline segment per day
+
+    Whole days that are already closed (before today, UTC) are served from
+    route_track_cache and filled on first use; partial days and today are
+    simplified on the fly.
+    """
+    today = datetime.datetime.utcnow().date()
+
+    segments = []
+    day = start.date()
+    while datetime.datetime.combine(day, datetime.time()) < end:
+        day_start = datetime.datetime.combine(day, datetime.time())
+        day_end = day_start + datetime.timedelta(days=1)
+        window_start = max(start, day_start)
+        window_end = min(end, day_end)
+
+        if window_start == day_start and window_end == day_end and day < today:
+            track = _cached_day_track(vehicle_id, day.isoformat(), zoom)
+            cached = True
+        else:
+            track = build_track(vehicle_id, window_start, window_end, zoom)
+            cached = False
+
+        if track:
+            segments.append({'date': day.isoformat(), 'cached': cached, **track})
+        day += datetime.timedelta(days=1)
+
+    return segments
+
+def precompute_route_tracks(day, zooms=PRECOMPUTE_ZOOMS):
+    """Fill the cache for every vehicle that reported on a closed day"""
+    day_start = datetime.date.fromisoformat(day)
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT DISTINCT vehicle_id FROM gps_data WHERE timestamp >= ? AND timestamp < ?
+    ''', (day_start.isoformat(), (day_start + datetime.timedelta(days=1)).isoformat()))
+    vehicle_ids = [row[0] for row in c.fetchall()]
+    conn.close()
+
+    for vehicle_id in vehicle_ids:
+        for zoom in zooms:
+            _cached_day_track(vehicle_id, day, zoom)
+
+    return len(vehicle_ids)
+
+def add_route_track_routes(app, get_vehicle_id_from_imei):
+    """Add route playback routes to Flask app"""
+
+    @app.route('/api/route')
+    def route_api():
+        """Simplified route for a vehicle and time range"""
+        imei = request.args.get('imei')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+
+        if not imei:
+            return jsonify({'error': 'IMEI parameter is required'}), 400
+        if not start_date or not end_date:
+            return jsonify({'error': 'start_date and end_date are required'}), 400
+
+        try:
+            # type=int would silently fall back to the default on a bad value
+            zoom = int(request.args['zoom']) if 'zoom' in request.args else DEFAULT_ZOOM
+            zoom = min(max(zoom, 0), MAX_ZOOM)
+            start = parse_time(start_date)
+            end = parse_time(end_date)
+        except ValueError:
+            return jsonify({'error': 'Invalid date or zoom parameter'}), 400
+
+        vehicle_id = get_vehicle_id_from_imei(imei)
+        if not vehicle_id:
+            return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        if len(end_date) == 10:
+            end += datetime.timedelta(days=1)  # Date-only end is inclusive
+        segments = get_route(vehicle_id, start, end, zoom)
+        return jsonify({
+            'imei': imei,
+            'start_date': start_date,
+            'end_date': end_date,
+            'zoom': zoom,
+            'segments': segments,
+            'total_points': sum(s['points'] for s in segments),
+            'original_points': sum(s['original_points'] for s in segments)
+        })
+
+if __name__ == '__main__':
+    # Precompute closed-day tracks, e.g. from a nightly cron job:
+    #   python route_track.py 2025-01-31
+    target_day = sys.argv[1] if len(sys.argv) > 1 else \
+        (datetime.datetime.utcnow().date() - datetime.timedelta(days=1)).isoformat()
+    init_route_track_db()
+    count = precompute_route_tracks(target_day)
+    print(f"Precomputed route tracks for {count} vehicles on {target_day}")
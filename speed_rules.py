@@ -0,0 +1,122 @@
+# Real-time speed limit enforcement on incoming packets
+import os
+import sqlite3
+import datetime
+import threading
+from enhanced_alarm import enhanced_log_alarm
+
+DB = 'gps.db'
+
+# Speed above the limit that starts a violation (absorbs GPS speed noise)
+SPEED_TOLERANCE_KMH = float(os.getenv('SPEED_TOLERANCE_KMH', 3))
+# A violation only ends once speed drops this far below the limit
+SPEED_HYSTERESIS_KMH = float(os.getenv('SPEED_HYSTERESIS_KMH', 5))
+# How long speed must stay over the limit before an alarm is raised
+SPEED_MIN_DURATION_SECONDS = float(os.getenv('SPEED_MIN_DURATION_SECONDS', 10))
+
+# vehicle_id -> active limit in km/h, kept in sync by set_speed_limit
+_limits = {}
+
+# vehicle_id -> {'state': 'over' | 'violation', 'since', 'max_speed'}
+# Vehicles under their limit have no entry.
+_episodes = {}
+
+_lock = threading.Lock()
+
+def load_speed_limits():
+    """Load every active speed limit into the in-memory cache"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT vehicle_id, speed_limit_kmh FROM speed_limits
+        WHERE is_active = 1
+        ORDER BY set_at, id
+    ''')
+    rows = c.fetchall()
+    conn.close()
+
+    with _lock:
+        _limits.clear()
+        _episodes.clear()
+        for vehicle_id, speed_limit in rows:
+            # Rows stored before the API validated limits may not parse
+            try:
+                _limits[vehicle_id] = float(speed_limit)
+            except (TypeError, ValueError):
+                print(f"Warning: ignoring invalid speed limit {speed_limit!r} for vehicle {vehicle_id}")
+
+    return len(_limits)
+
+def update_speed_limit(vehicle_id, speed_limit_kmh):
+    """Refresh the cached limit for one vehicle (None removes it)"""
+    with _lock:
+        _episodes.pop(vehicle_id, None)
+        if speed_limit_kmh is None:
+            _limits.pop(vehicle_id, None)
+        else:
+            _limits[vehicle_id] = float(speed_limit_kmh)
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        return datetime.datetime.utcnow()
+
+def evaluate_speed(packet):
+    """Check one packet against its vehicle's limit; O(1), no database access
+
+    Speed must exceed limit + SPEED_TOLERANCE_KMH continuously for
+    SPEED_MIN_DURATION_SECONDS before the episode becomes a violation and
+    one speed_violation alarm is raised. The episode stays open until
+    speed falls below limit - SPEED_HYSTERESIS_KMH, so hovering around the
+    limit does not raise repeated alarms.
+    """
+    vehicle_id = packet.get('vehicle_id')
+    speed = packet.get('speed')
+    if vehicle_id is None or speed is None:
+        return None
+
+    alarm = None
+    with _lock:
+        limit = _limits.get(vehicle_id)
+        if limit is None:
+            return None
+
+        episode = _episodes.get(vehicle_id)
+        now = _parse_timestamp(packet.get('timestamp'))
+
+        if speed > limit + SPEED_TOLERANCE_KMH:
+            if episode is None:
+                _episodes[vehicle_id] = {'state': 'over', 'since': now, 'max_speed': speed}
+            else:
+                episode['max_speed'] = max(episode['max_speed'], speed)
+                duration = (now - episode['since']).total_seconds()
+                if episode['state'] == 'over' and duration >= SPEED_MIN_DURATION_SECONDS:
+                    episode['state'] = 'violation'
+                    alarm = (limit, episode['max_speed'], duration)
+        elif speed < limit - SPEED_HYSTERESIS_KMH:
+            _episodes.pop(vehicle_id, None)
+        elif episode is not None and episode['state'] == 'over':
+            # Dipped back to the limit before the minimum duration: just noise
+            del _episodes[vehicle_id]
+
+    if alarm:
+        limit, max_speed, duration = alarm
+        enhanced_log_alarm(
+            vehicle_id,
+            'speed_violation',
+            f"Speed {max_speed:.0f} km/h exceeded limit of {limit:.0f} km/h for {duration:.0f}s",
+            metadata={
+                'speed_limit': limit,
+                'max_speed': max_speed,
+                'duration_seconds': round(duration, 1),
+                'latitude': packet.get('lat'),
+                'longitude': packet.get('lon'),
+                'timestamp': packet.get('timestamp')
+            }
+        )
+        return 'violation'
+
+    return None
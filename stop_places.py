@@ -0,0 +1,472 @@
+# Recurring stop places: parking events of the whole fleet clustered with DBSCAN
+#
+# Closed parking events are stored in parking_stops as they are found,
+# one scan per vehicle from where the previous run stopped. Each stop is
+# filed in a grid of PLACE_EPS_M cells, and DBSCAN is run incrementally:
+# a new stop only touches the stops within 2 * eps of it, so a run costs
+# the new events, not the history. Stops of one cluster share a place_id;
+# noise stops have none.
+import os
+import math
+import time
+import sqlite3
+import datetime
+import threading
+from flask import request, jsonify
+
+DB = 'gps.db'
+
+# DBSCAN parameters: stops within PLACE_EPS_M of each other are neighbours;
+# a stop with PLACE_MIN_STOPS neighbours (itself included) is a core stop
+PLACE_EPS_M = float(os.getenv('PLACE_EPS_M', 75))
+PLACE_MIN_STOPS = int(os.getenv('PLACE_MIN_STOPS', 3))
+PLACE_REFRESH_MINUTES = float(os.getenv('PLACE_REFRESH_MINUTES', 60))
+
+EARTH_RADIUS_M = 6371008.8
+CELL_DEG = math.degrees(PLACE_EPS_M / EARTH_RADIUS_M)
+
+_run_lock = threading.Lock()
+_job = []
+
+def init_stop_places_db():
+    """Create the stop, place and scan progress tables"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS parking_stops (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vehicle_id INTEGER,
+            start_time TEXT,
+            end_time TEXT,
+            latitude REAL,
+            longitude REAL,
+            duration_minutes INTEGER,
+            event_type TEXT,
+            cell_x INTEGER,
+            cell_y INTEGER,
+            neighbor_count INTEGER DEFAULT 0,
+            place_id INTEGER,
+            UNIQUE (vehicle_id, start_time)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_parking_stops_cell ON parking_stops (cell_y, cell_x)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_parking_stops_place ON parking_stops (place_id, start_time)')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stop_places (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            latitude REAL,
+            longitude REAL,
+            stop_count INTEGER,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stop_place_progress (
+            vehicle_id INTEGER PRIMARY KEY,
+            scanned_until TEXT
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+# --- Grid and distances ---
+
+def _cell(lat, lon):
+    return int(math.floor(lon / CELL_DEG)), int(math.floor(lat / CELL_DEG))
+
+def _distance_m(a, b):
+    """Equirectangular distance; exact enough at the scale of PLACE_EPS_M"""
+    lat = math.radians((a[0] + b[0]) / 2)
+    dy = math.radians(b[0] - a[0])
+    dx = math.radians(b[1] - a[1]) * math.cos(lat)
+    return EARTH_RADIUS_M * math.hypot(dx, dy)
+
+def _cell_span(lat, radius_m):
+    """Cells to search either side of a point, in (x, y), for a radius"""
+    cos_lat = max(math.cos(math.radians(min(abs(lat) + 2 * CELL_DEG, 89.9))), 1e-6)
+    return int(math.ceil(radius_m / PLACE_EPS_M / cos_lat)), int(math.ceil(radius_m / PLACE_EPS_M))
+
+def _cells_around(lat, lon, radius_m):
+    cx, cy = _cell(lat, lon)
+    span_x, span_y = _cell_span(lat, radius_m)
+    return [(x, y) for y in range(cy - span_y, cy + span_y + 1) for x in range(cx - span_x, cx + span_x + 1)]
+
+# --- Collecting stops ---
+
+def _scan_cutoff(c, vehicle_id):
+    """Latest timestamp up to which every parking event of a vehicle is closed
+
+    If the vehicle is stopped right now, its stop is still open, so the
+    scan ends at the last moving point; the next run starts there again.
+    """
+    c.execute('SELECT timestamp, speed FROM gps_data WHERE vehicle_id = ? ORDER BY timestamp DESC LIMIT 1', (vehicle_id,))
+    last = c.fetchone()
+    if not last or last[1] is None:
+        return None
+    if last[1] >= 1.0:
+        return last[0]
+    c.execute('''
+        SELECT timestamp FROM gps_data WHERE vehicle_id = ? AND speed >= 1.0
+        ORDER BY timestamp DESC LIMIT 1
+    ''', (vehicle_id,))
+    moving = c.fetchone()
+    return moving[0] if moving else None
+
+def collect_stops(iter_parking_events):
+    """Store the parking events closed since the last run; returns the new stop ids
+
+    iter_parking_events(imei, start_date, end_date) is the parking report's
+    event detector, so places are built from exactly the reported events.
+    """
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        SELECT v.id, v.imei, p.scanned_until FROM vehicles v
+        LEFT JOIN stop_place_progress p ON p.vehicle_id = v.id
+    ''')
+    vehicles = c.fetchall()
+
+    new_ids = []
+    for vehicle_id, imei, scanned_until in vehicles:
+        cutoff = _scan_cutoff(c, vehicle_id)
+        if not cutoff or (scanned_until and cutoff <= scanned_until):
+            continue
+        # Detect first, then write: inserting while the detector streams the
+        # history would hold the write lock and block ingest for the whole scan
+        events = list(iter_parking_events(imei, scanned_until, cutoff))
+        for event in events:
+            cell_x, cell_y = _cell(event['latitude'], event['longitude'])
+            c.execute('''
+                INSERT OR IGNORE INTO parking_stops
+                    (vehicle_id, start_time, end_time, latitude, longitude, duration_minutes, event_type, cell_x, cell_y)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (vehicle_id, event['start_time'], event['end_time'], event['latitude'], event['longitude'],
+                  event['duration_minutes'], event['event_type'], cell_x, cell_y))
+            if c.rowcount:
+                new_ids.append(c.lastrowid)
+        c.execute('INSERT OR REPLACE INTO stop_place_progress (vehicle_id, scanned_until) VALUES (?, ?)',
+                  (vehicle_id, cutoff))
+        conn.commit()
+
+    conn.close()
+    return new_ids
+
+# --- Incremental DBSCAN ---
+
+def _load_region(c, new_ids):
+    """New stops plus every stored stop within 2 * eps of one
+
+    That is all DBSCAN needs: a stop whose core status changes lies
+    within eps of a new stop, and its own neighbours within eps of it.
+    """
+    stops = {}
+    for chunk in range(0, len(new_ids), 500):
+        ids = new_ids[chunk:chunk + 500]
+        c.execute(f'''
+            SELECT id, latitude, longitude, neighbor_count, place_id FROM parking_stops
+            WHERE id IN ({','.join('?' * len(ids))})
+        ''', ids)
+        for row in c.fetchall():
+            stops[row[0]] = list(row[1:])
+
+    rows = {}
+    for stop_id in new_ids:
+        lat, lon = stops[stop_id][0], stops[stop_id][1]
+        for x, y in _cells_around(lat, lon, 2 * PLACE_EPS_M):
+            rows.setdefault(y, set()).add(x)
+    for y, xs in rows.items():
+        xs = sorted(xs)
+        for chunk in range(0, len(xs), 500):
+            part = xs[chunk:chunk + 500]
+            c.execute(f'''
+                SELECT id, latitude, longitude, neighbor_count, place_id FROM parking_stops
+                WHERE cell_y = ? AND cell_x IN ({','.join('?' * len(part))})
+            ''', [y] + part)
+            for row in c.fetchall():
+                stops.setdefault(row[0], list(row[1:]))
+    return stops
+
+def cluster_stops(new_ids):
+    """Fold new stops into the places; returns counts of what changed
+
+    Neighbour counts of the new stops and of stored stops near them are
+    updated. Stops that become core either join the place of a
+    neighbouring core, start a new place, or merge the places they
+    connect. Non-core stops next to a core take its place as border
+    stops.
+    """
+    if not new_ids:
+        return {'new_stops': 0, 'new_places': 0, 'merged_places': 0}
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    stops = _load_region(c, new_ids)
+
+    grid = {}
+    for stop_id, (lat, lon, _, _) in stops.items():
+        grid.setdefault(_cell(lat, lon), []).append(stop_id)
+
+    def neighbours(stop_id):
+        lat, lon = stops[stop_id][0], stops[stop_id][1]
+        found = []
+        for cell in _cells_around(lat, lon, PLACE_EPS_M):
+            for other in grid.get(cell, ()):
+                if _distance_m(stops[stop_id], stops[other]) <= PLACE_EPS_M:
+                    found.append(other)
+        return found
+
+    # Neighbour counts: new stops from scratch, stored stops incremented
+    new_set = set(new_ids)
+    before = {stop_id: stops[stop_id][2] for stop_id in stops}
+    placed = {stop_id: stops[stop_id][3] for stop_id in stops}
+    near = {}
+    for stop_id in new_ids:
+        near[stop_id] = neighbours(stop_id)
+        stops[stop_id][2] = len(near[stop_id])
+        for other in near[stop_id]:
+            if other not in new_set:
+                stops[other][2] += 1
+
+    def is_core(stop_id):
+        return stops[stop_id][2] >= PLACE_MIN_STOPS
+
+    became_core = [stop_id for stop_id in stops
+                   if is_core(stop_id) and (stop_id in new_set or before[stop_id] < PLACE_MIN_STOPS)]
+
+    # Union-find over the new cores and the places of the cores they touch
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    core_set = set(became_core)
+    for stop_id in became_core:
+        find(('stop', stop_id))
+        for other in near.get(stop_id) or neighbours(stop_id):
+            if not is_core(other):
+                continue
+            if other in core_set or stops[other][3] is None:
+                union(('stop', stop_id), ('stop', other))
+            else:
+                union(('stop', stop_id), ('place', stops[other][3]))
+
+    groups = {}
+    for node in list(parent):
+        groups.setdefault(find(node), []).append(node)
+
+    now = datetime.datetime.utcnow().isoformat()
+    touched = set()
+    merged = 0
+    created = 0
+    remap = {}
+    for nodes in groups.values():
+        places = sorted(node[1] for node in nodes if node[0] == 'place')
+        if places:
+            place_id = places[0]
+            # One new core can join several places into one
+            for other in places[1:]:
+                c.execute('UPDATE parking_stops SET place_id = ? WHERE place_id = ?', (place_id, other))
+                c.execute('DELETE FROM stop_places WHERE id = ?', (other,))
+                remap[other] = place_id
+                merged += 1
+        else:
+            c.execute('INSERT INTO stop_places (created_at, updated_at) VALUES (?, ?)', (now, now))
+            place_id = c.lastrowid
+            created += 1
+        for node in nodes:
+            if node[0] == 'stop':
+                stops[node[1]][3] = place_id
+        touched.add(place_id)
+
+    for stop_id, stop in stops.items():
+        if stop[3] in remap:
+            stop[3] = remap[stop[3]]
+        if placed[stop_id] in remap:
+            placed[stop_id] = remap[placed[stop_id]]
+
+    # Border stops: non-core stops next to a core take its place
+    for stop_id in list(new_ids) + [other for core in became_core for other in near.get(core) or neighbours(core)]:
+        if is_core(stop_id) or stops[stop_id][3] is not None:
+            continue
+        for other in near.get(stop_id) or neighbours(stop_id):
+            if is_core(other):
+                stops[stop_id][3] = stops[other][3]
+                touched.add(stops[other][3])
+                break
+
+    c.executemany('UPDATE parking_stops SET neighbor_count = ?, place_id = ? WHERE id = ?',
+                  [(stop[2], stop[3], stop_id) for stop_id, stop in stops.items()
+                   if stop_id in new_set or stop[2] != before[stop_id] or stop[3] != placed[stop_id]])
+
+    for place_id in touched:
+        c.execute('''
+            UPDATE stop_places SET
+                latitude = (SELECT AVG(latitude) FROM parking_stops WHERE place_id = ?),
+                longitude = (SELECT AVG(longitude) FROM parking_stops WHERE place_id = ?),
+                stop_count = (SELECT COUNT(*) FROM parking_stops WHERE place_id = ?),
+                updated_at = ?
+            WHERE id = ?
+        ''', (place_id, place_id, place_id, now, place_id))
+
+    conn.commit()
+    conn.close()
+    return {'new_stops': len(new_ids), 'new_places': created, 'merged_places': merged}
+
+def update_stop_places(iter_parking_events):
+    """Collect new parking events and cluster them; None if a run is already going
+
+    Every clustered stop counts itself as a neighbour, so stops still at
+    neighbor_count 0 are the ones to cluster, including any left by an
+    interrupted run.
+    """
+    if not _run_lock.acquire(blocking=False):
+        return None
+    try:
+        collect_stops(iter_parking_events)
+        conn = sqlite3.connect(DB)
+        c = conn.cursor()
+        c.execute('SELECT id FROM parking_stops WHERE neighbor_count = 0 ORDER BY id')
+        pending = [row[0] for row in c.fetchall()]
+        conn.close()
+        return cluster_stops(pending)
+    finally:
+        _run_lock.release()
+
+def start_stop_place_job(iter_parking_events):
+    """Run update_stop_places every PLACE_REFRESH_MINUTES in a background thread"""
+    if _job:
+        return
+
+    def run():
+        while True:
+            try:
+                result = update_stop_places(iter_parking_events)
+                if result and result['new_stops']:
+                    print(f"Stop places: {result['new_stops']} new stops, {result['new_places']} new places, "
+                          f"{result['merged_places']} merged")
+            except Exception as e:
+                print(f"Error updating stop places: {e}")
+            time.sleep(PLACE_REFRESH_MINUTES * 60)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    _job.append(thread)
+
+# --- Queries ---
+
+def get_place_ids(vehicle_id, start_date=None, end_date=None):
+    """{start_time: place_id} of a vehicle's clustered stops, for annotating parking events"""
+    query = 'SELECT start_time, place_id FROM parking_stops WHERE vehicle_id = ?'
+    params = [vehicle_id]
+    if start_date:
+        query += ' AND start_time >= ?'
+        params.append(start_date)
+    if end_date:
+        query += ' AND start_time <= ?'
+        params.append(end_date)
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute(query, params)
+    place_ids = dict(c.fetchall())
+    conn.close()
+    return place_ids
+
+def get_place_stats(place_id=None, vehicle_id=None, start_date=None, end_date=None, limit=None):
+    """Dwell statistics per place, busiest (most total dwell time) first"""
+    query = '''
+        SELECT s.place_id, p.latitude, p.longitude,
+               COUNT(*), COUNT(DISTINCT s.vehicle_id),
+               SUM(s.duration_minutes), AVG(s.duration_minutes), MAX(s.duration_minutes),
+               SUM(s.event_type = 'parked'), SUM(s.event_type = 'idling'),
+               MIN(s.start_time), MAX(s.end_time)
+        FROM parking_stops s
+        JOIN stop_places p ON p.id = s.place_id
+        WHERE s.place_id IS NOT NULL
+    '''
+    params = []
+    if place_id is not None:
+        query += ' AND s.place_id = ?'
+        params.append(place_id)
+    if vehicle_id is not None:
+        query += ' AND s.vehicle_id = ?'
+        params.append(vehicle_id)
+    if start_date:
+        query += ' AND s.start_time >= ?'
+        params.append(start_date)
+    if end_date:
+        query += ' AND s.start_time <= ?'
+        params.append(end_date)
+    query += ' GROUP BY s.place_id ORDER BY SUM(s.duration_minutes) DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+
+    return [{
+        'place_id': row[0],
+        'latitude': row[1],
+        'longitude': row[2],
+        'stops': row[3],
+        'vehicles': row[4],
+        'total_dwell_minutes': row[5],
+        'avg_dwell_minutes': round(row[6], 1),
+        'max_dwell_minutes': row[7],
+        'parked_events': row[8],
+        'idling_events': row[9],
+        'first_seen': row[10],
+        'last_seen': row[11]
+    } for row in rows]
+
+def add_stop_place_routes(app, iter_parking_events, get_vehicle_id_from_imei):
+    """Add stop place routes to Flask app"""
+
+    @app.route('/api/places')
+    def places_api():
+        imei = request.args.get('imei')
+        vehicle_id = None
+        if imei:
+            vehicle_id = get_vehicle_id_from_imei(imei)
+            if not vehicle_id:
+                return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        places = get_place_stats(vehicle_id=vehicle_id, start_date=request.args.get('start_date'),
+                                 end_date=request.args.get('end_date'), limit=request.args.get('limit', type=int))
+        return jsonify({
+            'imei': imei,
+            'start_date': request.args.get('start_date'),
+            'end_date': request.args.get('end_date'),
+            'places': places
+        })
+
+    @app.route('/api/places/<int:place_id>')
+    def place_api(place_id):
+        places = get_place_stats(place_id=place_id, start_date=request.args.get('start_date'),
+                                 end_date=request.args.get('end_date'))
+        if not places:
+            return jsonify({'error': 'Place not found'}), 404
+        return jsonify(places[0])
+
+    @app.route('/api/places/refresh', methods=['POST'])
+    def refresh_places_api():
+        result = update_stop_places(iter_parking_events)
+        if result is None:
+            return jsonify({'error': 'A place update is already running'}), 409
+        return jsonify(result)
@@ -0,0 +1,359 @@
+# Nearest-available-vehicle ranking and batch assignment for trip requests
+import os
+import sqlite3
+import datetime
+import numpy as np
+from flask import request, jsonify
+from db_helpers import load_rows
+from live_positions import get_nearby, MAX_NEARBY_RADIUS_M
+from idle_tracker import get_idle_status
+
+DB = 'gps.db'
+
+# Ranking cost is in km: straight-line distance to the pickup plus these penalties
+DEPARTMENT_PENALTY_KM = float(os.getenv('ASSIGN_DEPARTMENT_PENALTY_KM', 5))  # vehicle of another department
+MOVING_PENALTY_KM = float(os.getenv('ASSIGN_MOVING_PENALTY_KM', 2))          # vehicle currently driving
+# First search radius around the pickup; doubled until enough vehicles are found
+START_RADIUS_M = 2000
+# Candidates per request considered by batch assignment
+BATCH_CANDIDATES = int(os.getenv('ASSIGN_BATCH_CANDIDATES', 10))
+
+ASSIGN_METHODS = ('hungarian', 'greedy')
+
+def init_trip_assignment_db():
+    """Add pickup coordinates and completion time to trip_requests"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+
+    columns = [row[1] for row in c.execute('PRAGMA table_info(trip_requests)')]
+    if 'pickup_lat' not in columns:
+        c.execute('ALTER TABLE trip_requests ADD COLUMN pickup_lat REAL')
+    if 'pickup_lon' not in columns:
+        c.execute('ALTER TABLE trip_requests ADD COLUMN pickup_lon REAL')
+    if 'completed_at' not in columns:
+        c.execute('ALTER TABLE trip_requests ADD COLUMN completed_at TEXT')
+
+    conn.commit()
+    conn.close()
+
+def _busy_vehicles():
+    """Vehicles on an approved trip request or following a planned route
+
+    A request stays approved until it is completed (complete_trip_request,
+    or completing its planned route), which frees the vehicle.
+    """
+    rows = load_rows(DB, '''
+        SELECT vehicle_id FROM trip_requests WHERE status = 'approved' AND vehicle_id IS NOT NULL
+        UNION
+        SELECT vehicle_id FROM trip_routes WHERE status = 'active'
+    ''', ())
+    return {row[0] for row in rows}
+
+def _vehicle_details(vehicle_ids):
+    """vehicle_id -> (status, department, license_plate) for the given ids"""
+    details = {}
+    ids = list(vehicle_ids)
+    # Stay under SQLite's bound-parameter limit
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        for vehicle_id, status, department, license_plate in load_rows(
+                DB, f"SELECT id, status, department, license_plate FROM vehicles WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk):
+            details[vehicle_id] = (status, department, license_plate)
+    return details
+
+def _candidate(vehicle_id, details, department, distance_m=None, position=None):
+    status, vehicle_department, license_plate = details
+    idle = get_idle_status(vehicle_id)
+    state = idle[0]['idle_status'] if idle else None
+
+    cost = (distance_m or 0) / 1000
+    if department and vehicle_department != department:
+        cost += DEPARTMENT_PENALTY_KM
+    if state == 'moving':
+        cost += MOVING_PENALTY_KM
+
+    return {
+        'vehicle_id': vehicle_id,
+        'license_plate': license_plate,
+        'department': vehicle_department,
+        'idle_status': state,
+        'distance_km': round(distance_m / 1000, 3) if distance_m is not None else None,
+        'lat': position['lat'] if position else None,
+        'lon': position['lon'] if position else None,
+        'last_update': position['timestamp'] if position else None,
+        'cost': round(cost, 3)
+    }
+
+def rank_candidates(pickup_lat, pickup_lon, department=None, k=5, busy=None):
+    """Top-k available vehicles for a pickup point, lowest cost first
+
+    Searches the live position index in growing circles. Penalties only add
+    to the distance, so once k vehicles cost no more than the search radius
+    nothing outside it can beat them and the search stops. Vehicles must be
+    'active' in the vehicles table and not busy on another trip. Without a
+    pickup point, vehicles are ranked by penalties alone.
+    """
+    busy = _busy_vehicles() if busy is None else busy
+
+    if pickup_lat is None or pickup_lon is None:
+        rows = load_rows(DB, "SELECT id, status, department, license_plate FROM vehicles WHERE status = 'active'", ())
+        candidates = [_candidate(row[0], row[1:], department) for row in rows if row[0] not in busy]
+        candidates.sort(key=lambda c: (c['cost'], c['vehicle_id']))
+        return candidates[:k]
+
+    radius = START_RADIUS_M
+    known = {}
+    while True:
+        hits = get_nearby(pickup_lat, pickup_lon, radius)
+        new_ids = [hit['vehicle_id'] for hit in hits if hit['vehicle_id'] not in known and hit['vehicle_id'] not in busy]
+        known.update(_vehicle_details(new_ids))
+
+        candidates = [_candidate(hit['vehicle_id'], known[hit['vehicle_id']], department, hit['distance_m'], hit)
+                      for hit in hits
+                      if hit['vehicle_id'] in known and known[hit['vehicle_id']][0] == 'active']
+        candidates.sort(key=lambda c: (c['cost'], c['vehicle_id']))
+        settled = len(candidates) >= k and candidates[k - 1]['cost'] <= radius / 1000
+        if settled or radius >= MAX_NEARBY_RADIUS_M:
+            return candidates[:k]
+        radius = min(radius * 2, MAX_NEARBY_RADIUS_M)
+
+def _hungarian(cost):
+    """Minimum-cost assignment of rows to columns of a numpy matrix (rows <= columns)
+
+    Shortest augmenting path version of the Hungarian algorithm, with the
+    column scans vectorized: O(n²) numpy steps over m columns.
+    Returns the column assigned to each row.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, dtype=int)  # column -> row (1-based, 0 = free); column 0 is virtual
+    way = np.zeros(m + 1, dtype=int)
+    for row in range(1, n + 1):
+        owner[0] = row
+        column = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[column] = True
+            current_row = owner[column]
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            free = ~used[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = column
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_slack[~used] -= delta
+            column = next_column
+            if owner[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+
+    assignment = [None] * n
+    for j in range(1, m + 1):
+        if owner[j]:
+            assignment[owner[j] - 1] = j - 1
+    return assignment
+
+def plan_assignments(requests, method='hungarian'):
+    """Match pending requests to vehicles; returns [(request, candidate or None)]
+
+    Each request only considers its BATCH_CANDIDATES best vehicles, so the
+    matrix stays small. 'greedy' repeatedly takes the cheapest remaining
+    pair. 'hungarian' minimises the total cost over the whole batch.
+    Requests without a pickup point are left unassigned.
+    """
+    if method not in ASSIGN_METHODS:
+        raise ValueError(f"method must be one of {', '.join(ASSIGN_METHODS)}")
+
+    busy = _busy_vehicles()
+    options = [rank_candidates(r['pickup_lat'], r['pickup_lon'], r['department'], BATCH_CANDIDATES, busy)
+               if r['pickup_lat'] is not None and r['pickup_lon'] is not None else []
+               for r in requests]
+    vehicles = sorted({c['vehicle_id'] for candidates in options for c in candidates})
+    if not vehicles:
+        return [(r, None) for r in requests]
+
+    column = {vehicle_id: j for j, vehicle_id in enumerate(vehicles)}
+    by_pair = {(i, column[c['vehicle_id']]): c for i, candidates in enumerate(options) for c in candidates}
+
+    chosen = {}
+    if method == 'greedy':
+        taken = set()
+        for (i, j), candidate in sorted(by_pair.items(), key=lambda item: (item[1]['cost'], item[0])):
+            if i not in chosen and j not in taken:
+                chosen[i] = candidate
+                taken.add(j)
+    else:
+        # Pairs outside a request's candidate list get a cost no real pair can reach;
+        # dummy columns let requests stay unassigned when vehicles run out
+        blocked = 1 + 10 * max(c['cost'] for c in by_pair.values()) + len(requests)
+        cost = np.full((len(requests), len(vehicles) + len(requests)), blocked, dtype=float)
+        cost[:, len(vehicles):] = blocked / 2
+        for (i, j), candidate in by_pair.items():
+            cost[i, j] = candidate['cost']
+        for i, j in enumerate(_hungarian(cost)):
+            if j < len(vehicles) and (i, j) in by_pair:
+                chosen[i] = by_pair[(i, j)]
+
+    return [(r, chosen.get(i)) for i, r in enumerate(requests)]
+
+def _request_rows(where, params):
+    rows = load_rows(DB, f'''
+        SELECT id, department, status, pickup_lat, pickup_lon, vehicle_id FROM trip_requests
+        WHERE {where} ORDER BY request_date, id
+    ''', params)
+    return [{'id': r[0], 'department': r[1], 'status': r[2], 'pickup_lat': r[3], 'pickup_lon': r[4],
+             'vehicle_id': r[5]} for r in rows]
+
+def approve_trip_request(request_id, approved_by, vehicle_id):
+    """Approve a pending request with a vehicle; returns False if it is no longer pending"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('SELECT license_plate FROM vehicles WHERE id = ?', (vehicle_id,))
+    row = c.fetchone()
+    c.execute('''
+        UPDATE trip_requests
+        SET status = 'approved', approved_by = ?, approved_at = ?, vehicle_id = ?, vehicle_assigned = ?
+        WHERE id = ? AND status = 'pending'
+    ''', (approved_by, datetime.datetime.utcnow().isoformat(), vehicle_id, row[0] if row else None, request_id))
+    success = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return success
+
+def complete_trip_request(request_id, end_time=None):
+    """Mark an approved request completed; returns False if it is not approved"""
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
+    c.execute('''
+        UPDATE trip_requests SET status = 'completed', completed_at = ?
+        WHERE id = ? AND status = 'approved'
+    ''', (end_time or datetime.datetime.utcnow().isoformat(), request_id))
+    success = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return success
+
+def add_trip_assignment_routes(app, get_vehicle_id_from_imei):
+    """Add trip assignment routes to Flask app"""
+
+    @app.route('/api/trip_requests/<int:request_id>/candidates')
+    def trip_request_candidates_api(request_id):
+        k = min(max(request.args.get('k', 5, type=int), 1), 100)
+        rows = _request_rows('id = ?', (request_id,))
+        if not rows:
+            return jsonify({'error': 'Trip request not found'}), 404
+        trip = rows[0]
+        return jsonify({
+            'request_id': request_id,
+            'pickup_lat': trip['pickup_lat'],
+            'pickup_lon': trip['pickup_lon'],
+            'candidates': rank_candidates(trip['pickup_lat'], trip['pickup_lon'], trip['department'], k)
+        })
+
+    @app.route('/api/trip_requests/<int:request_id>/approve', methods=['POST'])
+    def approve_trip_request_api(request_id):
+        data = request.get_json() or {}
+        if not data.get('approved_by'):
+            return jsonify({'error': 'approved_by is required'}), 400
+
+        rows = _request_rows('id = ?', (request_id,))
+        if not rows:
+            return jsonify({'error': 'Trip request not found'}), 404
+        trip = rows[0]
+        if trip['status'] != 'pending':
+            return jsonify({'error': f"Trip request is {trip['status']}"}), 409
+
+        vehicle_id = data.get('vehicle_id')
+        # The dashboard sends the vehicle's IMEI as vehicle_assigned
+        if vehicle_id is None and data.get('vehicle_assigned'):
+            vehicle_id = get_vehicle_id_from_imei(data['vehicle_assigned'])
+            if not vehicle_id:
+                return jsonify({'error': 'Vehicle not found for IMEI'}), 404
+
+        if vehicle_id is None:
+            best = rank_candidates(trip['pickup_lat'], trip['pickup_lon'], trip['department'], 1)
+            if not best:
+                return jsonify({'error': 'No available vehicle'}), 409
+            vehicle_id = best[0]['vehicle_id']
+        else:
+            try:
+                vehicle_id = int(vehicle_id)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'vehicle_id must be an integer'}), 400
+            details = _vehicle_details([vehicle_id]).get(vehicle_id)
+            if details is None:
+                return jsonify({'error': f'Vehicle {vehicle_id} not found'}), 404
+            if details[0] != 'active':
+                return jsonify({'error': f'Vehicle {vehicle_id} is not active'}), 409
+            if vehicle_id in _busy_vehicles():
+                return jsonify({'error': f'Vehicle {vehicle_id} is already on a trip'}), 409
+
+        if not approve_trip_request(request_id, data['approved_by'], vehicle_id):
+            return jsonify({'error': 'Trip request is no longer pending'}), 409
+        return jsonify({'success': True, 'request_id': request_id, 'vehicle_id': vehicle_id})
+
+    @app.route('/api/trip_requests/<int:request_id>/complete', methods=['POST'])
+    def complete_trip_request_api(request_id):
+        data = request.get_json(silent=True) or {}
+        rows = _request_rows('id = ?', (request_id,))
+        if not rows:
+            return jsonify({'error': 'Trip request not found'}), 404
+        if not complete_trip_request(request_id, data.get('end_time')):
+            return jsonify({'error': f"Trip request is {rows[0]['status']}"}), 409
+        return jsonify({'success': True, 'request_id': request_id, 'vehicle_id': rows[0]['vehicle_id']})
+
+    @app.route('/api/trip_requests/assign', methods=['POST'])
+    def assign_trip_requests_api():
+        """Batch-assign pending requests; dry_run only returns the plan"""
+        data = request.get_json() or {}
+        method = data.get('method', 'hungarian')
+        dry_run = bool(data.get('dry_run'))
+        if not dry_run and not data.get('approved_by'):
+            return jsonify({'error': 'approved_by is required unless dry_run is set'}), 400
+
+        request_ids = data.get('request_ids')
+        if request_ids is not None and (not isinstance(request_ids, list) or not all(
+                isinstance(request_id, int) and not isinstance(request_id, bool) for request_id in request_ids)):
+            return jsonify({'error': 'request_ids must be a list of integers'}), 400
+        if request_ids:
+            trips = _request_rows(f"status = 'pending' AND id IN ({','.join('?' * len(request_ids))})",
+                                  list(request_ids))
+        else:
+            trips = _request_rows("status = 'pending'", ())
+
+        try:
+            plan = plan_assignments(trips, method)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        assignments = []
+        for trip, candidate in plan:
+            assigned = candidate is not None
+            if assigned and not dry_run:
+                assigned = approve_trip_request(trip['id'], data['approved_by'], candidate['vehicle_id'])
+            assignments.append({
+                'request_id': trip['id'],
+                'has_pickup': trip['pickup_lat'] is not None and trip['pickup_lon'] is not None,
+                'vehicle_id': candidate['vehicle_id'] if assigned else None,
+                'license_plate': candidate['license_plate'] if assigned else None,
+                'distance_km': candidate['distance_km'] if assigned else None,
+                'cost': candidate['cost'] if assigned else None
+            })
+
+        return jsonify({
+            'method': method,
+            'dry_run': dry_run,
+            'assigned': sum(1 for a in assignments if a['vehicle_id'] is not None),
+            'total_cost': round(sum(a['cost'] for a in assignments if a['cost'] is not None), 3),
+            'assignments': assignments
+        })